@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+Adaptive quadtree grid for walkability scoring
+
+Starts from a coarse grid and only splits the cells that contain POIs or
+whose four children score meaningfully differently, down to a minimum
+cell size. Children are scored against the nearby-POI candidates of their
+parent, so each level only looks at POIs that can still matter.
+"""
+
+import math
+
+import geopandas as gpd
+import numpy as np
+import shapely
+
+from grid import clip_cells, grid_cells
+from scoring import POINTS, THRESHOLDS, as_kernel
+
+# Lower-left corner offsets of the 4 children of a cell, in half cell sizes
+_CHILD_OFFSETS = np.array([(0, 0), (1, 0), (0, 1), (1, 1)])
+
+
+def _score(centroids, cell_idx, poi_idx, poi_geoms, pois, kernel):
+    """Raw score of each centroid from its candidate pairs"""
+    dists = shapely.distance(centroids[cell_idx], poi_geoms[poi_idx])
+    weights = kernel.pair_points(dists, poi_idx, pois)
+    return np.bincount(cell_idx, weights=weights, minlength=len(centroids)).astype(kernel.dtype)
+
+
+def build_adaptive_grid(study_area, pois, max_size=2000, min_size=125, tolerance=3,
+                        thresholds=THRESHOLDS, points=POINTS, kernel=None):
+    """
+    Build and score an adaptive quadtree grid of a study area
+
+    A cell is split into 4 children when it contains at least one POI or
+    when the raw scores of its children differ by more than `tolerance`,
+    until cells reach `min_size`. Cells are clipped to the boundary and
+    scored at their centroid, like the uniform grid.
+
+    Parameters:
+    -----------
+    study_area : GeoDataFrame
+        Study area, in a projected CRS (meters)
+    pois : GeoDataFrame
+        Points of interest, in the same CRS
+    max_size : float
+        Size of the starting cells in meters (default: 2000)
+    min_size : float
+        Smallest cell size in meters (default: 125)
+    tolerance : float
+        Largest raw score spread between children that still leaves their
+        parent unsplit (default: 3)
+    thresholds : sequence of float
+        Increasing distance thresholds in meters
+    points : sequence of int
+        Points awarded for each threshold band
+    kernel : Kernel, optional
+        Scoring kernel replacing `thresholds` and `points`
+
+    Returns:
+    --------
+    grid : GeoDataFrame
+        Cells with `cell_size`, `centroid` and `raw_score` columns
+    """
+    boundary = study_area.geometry.union_all()
+    shapely.prepare(boundary)
+    kernel = as_kernel(kernel, thresholds, points)
+    poi_geoms = np.asarray(pois.geometry, dtype=object)
+    radius = kernel.max_radius
+
+    # Starting level: coarse squares touching the study area
+    squares = grid_cells(study_area.total_bounds, max_size)
+    size = float(max_size)
+    cells, kept = clip_cells(squares, boundary, return_index=True)
+    squares = squares[kept]
+
+    # Candidate POIs of each square: all POIs within the scoring radius of
+    # any point of the square
+    centers = shapely.centroid(squares)
+    if len(poi_geoms):
+        tree = shapely.STRtree(poi_geoms)
+        cell_idx, poi_idx = tree.query(centers, predicate="dwithin", distance=radius + size * math.sqrt(2) / 2)
+    else:
+        cell_idx = poi_idx = np.array([], dtype=np.intp)
+    centroids = shapely.centroid(cells)
+    scores = _score(centroids, cell_idx, poi_idx, poi_geoms, pois, kernel)
+
+    final_cells, final_sizes, final_centroids, final_scores = [], [], [], []
+
+    while len(cells):
+        half = size / 2
+        if half < min_size:
+            final_cells.append(cells)
+            final_sizes.append(np.full(len(cells), size))
+            final_centroids.append(centroids)
+            final_scores.append(scores)
+            break
+
+        # Children of every cell, 4 per parent
+        corners = shapely.bounds(squares)[:, :2]
+        child_corners = (corners[:, None, :] + _CHILD_OFFSETS[None, :, :] * half).reshape(-1, 2)
+        child_squares = shapely.box(
+            child_corners[:, 0], child_corners[:, 1], child_corners[:, 0] + half, child_corners[:, 1] + half
+        )
+        child_parent = np.repeat(np.arange(len(squares)), 4)
+        child_cells, child_kept = clip_cells(child_squares, boundary, return_index=True)
+        child_squares = child_squares[child_kept]
+        child_parent = child_parent[child_kept]
+        child_centroids = shapely.centroid(child_cells)
+
+        # Children inherit their parent's candidates, narrowed to their own reach
+        lookup = np.full(4 * len(squares), -1)
+        lookup[child_kept] = np.arange(len(child_kept))
+        pair_child = lookup[(4 * cell_idx[:, None] + np.arange(4)[None, :]).ravel()]
+        pair_poi = np.repeat(poi_idx, 4)
+        valid = pair_child >= 0
+        pair_child, pair_poi = pair_child[valid], pair_poi[valid]
+        reach = radius + half * math.sqrt(2) / 2
+        near = shapely.distance(shapely.centroid(child_squares)[pair_child], poi_geoms[pair_poi]) <= reach
+        pair_child, pair_poi = pair_child[near], pair_poi[near]
+        child_scores = _score(child_centroids, pair_child, pair_poi, poi_geoms, pois, kernel)
+
+        # Split parents holding POIs or whose children disagree
+        spread_max = np.full(len(squares), -np.inf)
+        spread_min = np.full(len(squares), np.inf)
+        np.maximum.at(spread_max, child_parent, child_scores)
+        np.minimum.at(spread_min, child_parent, child_scores)
+        has_poi = np.zeros(len(squares), dtype=bool)
+        has_poi[cell_idx[shapely.intersects(squares[cell_idx], poi_geoms[poi_idx])]] = True
+        split = has_poi | (spread_max - spread_min > tolerance)
+
+        # Unsplit parents are final
+        final_cells.append(cells[~split])
+        final_sizes.append(np.full(int((~split).sum()), size))
+        final_centroids.append(centroids[~split])
+        final_scores.append(scores[~split])
+
+        # Children of split parents form the next level
+        next_children = split[child_parent]
+        renumber = np.full(len(child_cells), -1)
+        renumber[next_children] = np.arange(int(next_children.sum()))
+        keep_pairs = next_children[pair_child]
+        cell_idx, poi_idx = renumber[pair_child[keep_pairs]], pair_poi[keep_pairs]
+        squares = child_squares[next_children]
+        cells = child_cells[next_children]
+        centroids = child_centroids[next_children]
+        scores = child_scores[next_children]
+        size = half
+
+    return gpd.GeoDataFrame(
+        {
+            'cell_size': np.concatenate(final_sizes) if final_sizes else np.array([]),
+            'centroid': gpd.GeoSeries(
+                np.concatenate(final_centroids) if final_centroids else [], crs=study_area.crs
+            ),
+            'raw_score': np.concatenate(final_scores) if final_scores else np.array([], dtype=np.int64),
+        },
+        geometry=np.concatenate(final_cells) if final_cells else [],
+        crs=study_area.crs,
+    )
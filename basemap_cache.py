@@ -0,0 +1,368 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk basemap tile cache
+
+`ctx.add_basemap` downloads its tiles again for every figure, and when a
+download fails the figure silently has no basemap. This module keeps the
+tiles in a size-capped SQLite store, evicting the least recently used ones,
+keyed by provider, zoom and tile x/y. The tiles of all the study areas are
+prefetched concurrently before plotting, and the figures are drawn from the
+store only, so re-rendering a figure needs no network at all. In offline
+mode nothing is downloaded.
+
+Providers are URL templates ("https://host/{z}/{x}/{y}.png") or
+xyzservices providers such as `ctx.providers.CartoDB.Positron`; a local
+stand-in tile server works the same way:
+
+    cache = BasemapCache(offline=False)
+    zoom = cache.prefetch(POSITRON, grid.total_bounds)
+    cache.add_basemap(ax, POSITRON, zoom=zoom)
+"""
+
+import io
+import math
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+import osmnx as ox
+import requests
+from PIL import Image
+from requests.adapters import HTTPAdapter
+
+# Default store, next to the osmnx responses
+DEFAULT_PATH = os.path.join(ox.settings.cache_folder, "basemap_tiles.sqlite")
+
+# Basemap of the comparison figures
+POSITRON = {
+    'name': "CartoDB.Positron",
+    'url': "https://a.basemaps.cartocdn.com/light_all/{z}/{x}/{y}.png",
+    'attribution': "(C) OpenStreetMap contributors (C) CARTO",
+}
+
+# Half the width of the Web Mercator world, in meters
+_ORIGIN = 20037508.342789244
+TILE_PIXELS = 256
+
+
+def tile_bounds(z, x, y):
+    """
+    Bounds of an XYZ tile in EPSG:3857
+
+    Returns:
+    --------
+    (minx, miny, maxx, maxy) : tuple of float
+    """
+    size = 2 * _ORIGIN / 2 ** z
+    minx = -_ORIGIN + x * size
+    maxy = _ORIGIN - y * size
+    return minx, maxy - size, minx + size, maxy
+
+
+def tiles_for_bounds(bounds, z):
+    """
+    XYZ tiles covering bounds given in EPSG:3857
+
+    Returns:
+    --------
+    tiles : list of (x, y) tuples
+    """
+    minx, miny, maxx, maxy = bounds
+    size = 2 * _ORIGIN / 2 ** z
+    last = 2 ** z - 1
+    x0 = min(max(int((minx + _ORIGIN) // size), 0), last)
+    x1 = min(max(int((maxx + _ORIGIN) // size), 0), last)
+    y0 = min(max(int((_ORIGIN - maxy) // size), 0), last)
+    y1 = min(max(int((_ORIGIN - miny) // size), 0), last)
+    return [(x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+
+
+def _provider(provider):
+    """(name, url template, attribution) of a provider"""
+    if isinstance(provider, str):
+        return provider, provider, ""
+    if hasattr(provider, "build_url"):
+        # xyzservices TileProvider (a dict with its own URL builder)
+        url = provider.build_url(x="{x}", y="{y}", z="{z}")
+        return provider.get('name', url), url, provider.get('attribution', "")
+    return provider.get('name', provider['url']), provider['url'], provider.get('attribution', "")
+
+
+def _lonlat(x, y):
+    """Longitude and latitude of a point in EPSG:3857"""
+    lon = x / _ORIGIN * 180
+    lat = math.degrees(2 * math.atan(math.exp(y / _ORIGIN * math.pi)) - math.pi / 2)
+    return lon, lat
+
+
+def auto_zoom(bounds):
+    """
+    Zoom level contextily would pick for bounds in EPSG:3857
+
+    Same rule as `contextily.tile._calculate_zoom`, on the bounds in
+    longitude and latitude: the smallest of the zooms fitting their width
+    and their height.
+
+    Returns:
+    --------
+    zoom : int
+    """
+    minx, miny, maxx, maxy = bounds
+    west, south = _lonlat(minx, miny)
+    east, north = _lonlat(maxx, maxy)
+    width = max(east - west, 1e-9)
+    height = max(north - south, 1e-9)
+    zoom = min(math.ceil(math.log2(360 * 2 / width)), math.ceil(math.log2(360 * 2 / height)))
+    return int(min(max(zoom, 0), 19))
+
+
+class BasemapCache:
+    """
+    Size-capped LRU store of map tiles, with concurrent prefetching
+
+    Parameters:
+    -----------
+    path : str
+        SQLite file (default: cache/basemap_tiles.sqlite)
+    max_bytes : int
+        Largest total size of the stored tiles; the least recently used
+        tiles are evicted beyond it (default: 500 MB)
+    offline : bool
+        Never download, only read the store
+    max_workers : int
+        Downloads in flight while prefetching (default: 8)
+    timeout : float
+        HTTP timeout in seconds (default: 10)
+    session : requests.Session, optional
+        Session to use (default: a new one with a pool of `max_workers`
+        connections)
+    """
+
+    def __init__(self, path=DEFAULT_PATH, max_bytes=500 * 2 ** 20, offline=False, max_workers=8, timeout=10,
+                 session=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.max_workers = max_workers
+        self.timeout = timeout
+
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        # Rendering processes read the same file: wait for their locks
+        self._db = sqlite3.connect(path, timeout=60)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS tiles (provider TEXT, z INTEGER, x INTEGER, y INTEGER, data BLOB, "
+            "size INTEGER, last_used REAL, PRIMARY KEY (provider, z, x, y))"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS tiles_last_used ON tiles (last_used)")
+        self._db.commit()
+
+        if session is None and not offline:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers.update(ox._http._get_http_headers())
+        self.session = session
+
+    def close(self):
+        self._db.close()
+
+    def __len__(self):
+        return self._db.execute("SELECT COUNT(*) FROM tiles").fetchone()[0]
+
+    def size(self):
+        """Total size of the stored tiles in bytes"""
+        return self._db.execute("SELECT COALESCE(SUM(size), 0) FROM tiles").fetchone()[0]
+
+    def _read(self, name, z, x, y):
+        row = self._db.execute(
+            "SELECT data FROM tiles WHERE provider = ? AND z = ? AND x = ? AND y = ?", (name, z, x, y)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def _touch(self, name, tiles):
+        """Mark tiles (z, x, y) as used, in one transaction"""
+        if tiles:
+            now = time.time()
+            self._db.executemany(
+                "UPDATE tiles SET last_used = ? WHERE provider = ? AND z = ? AND x = ? AND y = ?",
+                [(now, name, z, x, y) for z, x, y in tiles]
+            )
+            self._db.commit()
+
+    def get(self, provider, z, x, y):
+        """Stored tile (encoded image bytes), or None; marks it as used"""
+        name = _provider(provider)[0]
+        data = self._read(name, z, x, y)
+        if data is not None:
+            self._touch(name, [(z, x, y)])
+        return data
+
+    def put(self, provider, z, x, y, data):
+        """Store a tile, then evict the least recently used tiles over the size cap"""
+        self._put_many(provider, [((z, x, y), data)])
+
+    def _put_many(self, provider, tiles):
+        name = _provider(provider)[0]
+        now = time.time()
+        self._db.executemany(
+            "INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(name, z, x, y, data, len(data), now) for (z, x, y), data in tiles]
+        )
+        excess = self.size() - self.max_bytes
+        if excess > 0:
+            # Oldest first, until enough bytes are freed
+            victims, freed = [], 0
+            for rowid, size in self._db.execute("SELECT rowid, size FROM tiles ORDER BY last_used, rowid"):
+                if freed >= excess:
+                    break
+                victims.append((rowid,))
+                freed += size
+            self._db.executemany("DELETE FROM tiles WHERE rowid = ?", victims)
+        self._db.commit()
+
+    def _download(self, url):
+        response = self.session.get(url, timeout=self.timeout)
+        response.raise_for_status()
+        return response.content
+
+    def prefetch(self, provider, bounds, zoom=None):
+        """
+        Download the missing tiles of some areas, concurrently
+
+        Parameters:
+        -----------
+        provider : str, dict or xyzservices.TileProvider
+            Tile source
+        bounds : tuple or list of tuples
+            (minx, miny, maxx, maxy) of every area, in EPSG:3857
+        zoom : int or list of int, optional
+            Zoom of every area (default: `auto_zoom` of its bounds)
+
+        Returns:
+        --------
+        zooms : list of int
+            Zoom used for every area, to draw them with `add_basemap`
+        """
+        bounds = [bounds] if np.ndim(bounds) == 1 else list(bounds)
+        if zoom is None or np.ndim(zoom) == 0:
+            zooms = [auto_zoom(b) if zoom is None else zoom for b in bounds]
+        else:
+            zooms = list(zoom)
+
+        wanted = {(z, x, y) for b, z in zip(bounds, zooms) for x, y in tiles_for_bounds(b, z)}
+        missing = [tile for tile in sorted(wanted) if not self._has(provider, *tile)]
+        if self.offline or not missing:
+            if missing:
+                print(f"  Basemap: {len(missing)} of {len(wanted)} tiles not cached (offline)")
+            return zooms
+
+        url = _provider(provider)[1]
+        fetched, failed = [], 0
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self._download, url.format(z=z, x=x, y=y)): (z, x, y) for z, x, y in missing}
+            for future in as_completed(futures):
+                try:
+                    fetched.append((futures[future], future.result()))
+                except requests.RequestException:
+                    failed += 1
+        # SQLite writes stay in this thread
+        self._put_many(provider, fetched)
+
+        print(f"  Basemap: {len(fetched)} tiles downloaded, {len(wanted) - len(missing)} cached"
+              + (f", {failed} failed" if failed else ""))
+        return zooms
+
+    def _has(self, provider, z, x, y):
+        return self._db.execute(
+            "SELECT 1 FROM tiles WHERE provider = ? AND z = ? AND x = ? AND y = ?", (_provider(provider)[0], z, x, y)
+        ).fetchone() is not None
+
+    def mosaic(self, provider, bounds, zoom):
+        """
+        Stored tiles covering bounds, assembled into one image
+
+        Tiles missing from the store (not prefetched, or in offline mode
+        never downloaded) are downloaded unless offline, and are left
+        transparent otherwise. The tiles drawn are marked as used in one
+        transaction.
+
+        Returns:
+        --------
+        image : ndarray
+            (rows, cols, 4) uint8 RGBA array
+        extent : tuple
+            (minx, maxx, miny, maxy) of the image in EPSG:3857
+        missing : int
+            Number of tiles left transparent
+        """
+        tiles = tiles_for_bounds(bounds, zoom)
+        xs = sorted({x for x, _ in tiles})
+        ys = sorted({y for _, y in tiles})
+        image = np.zeros((len(ys) * TILE_PIXELS, len(xs) * TILE_PIXELS, 4), dtype=np.uint8)
+
+        if not self.offline:
+            # Only downloads the tiles not stored yet
+            self.prefetch(provider, bounds, zoom)
+
+        name = _provider(provider)[0]
+        missing, used = 0, []
+        for x, y in tiles:
+            data = self._read(name, zoom, x, y)
+            if data is None:
+                missing += 1
+                continue
+            used.append((zoom, x, y))
+            tile = np.asarray(Image.open(io.BytesIO(data)).convert("RGBA").resize((TILE_PIXELS, TILE_PIXELS)))
+            row, col = (y - ys[0]) * TILE_PIXELS, (x - xs[0]) * TILE_PIXELS
+            image[row:row + TILE_PIXELS, col:col + TILE_PIXELS] = tile
+        self._touch(name, used)
+
+        minx, _, _, maxy = tile_bounds(zoom, xs[0], ys[0])
+        _, miny, maxx, _ = tile_bounds(zoom, xs[-1], ys[-1])
+        return image, (minx, maxx, miny, maxy), missing
+
+    def add_basemap(self, ax, provider=POSITRON, zoom=None, alpha=0.5, attribution=True):
+        """
+        Draw the basemap under the current view of an axes in EPSG:3857
+
+        Replaces `ctx.add_basemap`, reading the tiles from the store.
+
+        Parameters:
+        -----------
+        ax : matplotlib Axes
+            Axes whose limits are set (plot the data first)
+        provider : str, dict or xyzservices.TileProvider
+            Tile source (default: CartoDB Positron)
+        zoom : int, optional
+            Zoom level; pass the one returned by `prefetch` (default:
+            `auto_zoom` of the view)
+        alpha : float
+            Opacity of the basemap
+        attribution : bool
+            Write the provider attribution in the corner
+
+        Returns:
+        --------
+        missing : int
+            Number of tiles that could not be drawn
+        """
+        (minx, maxx), (miny, maxy) = ax.get_xlim(), ax.get_ylim()
+        bounds = (minx, miny, maxx, maxy)
+        zoom = auto_zoom(bounds) if zoom is None else zoom
+        image, extent, missing = self.mosaic(provider, bounds, zoom)
+
+        ax.imshow(image, extent=extent, origin="upper", interpolation="bilinear", alpha=alpha, zorder=-1)
+        ax.set_xlim(minx, maxx)
+        ax.set_ylim(miny, maxy)
+        text = _provider(provider)[2]
+        if attribution and text:
+            ax.text(0.005, 0.005, text, transform=ax.transAxes, fontsize=5, alpha=0.7, ha="left", va="bottom")
+        if missing:
+            print(f"  Basemap: {missing} tiles missing from the figure")
+        return missing
@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""
+Resumable command-line batch runner
+
+Reads the cities to process from a CSV or YAML file and writes each
+city's scored grid and POIs to the output folder as soon as the city is
+done. A rerun skips the cities whose grid is already there, so a batch
+interrupted at city 40 of 60 restarts at city 40.
+
+City list formats:
+
+    CSV (header required; shapefile and continent are optional):
+        name,shapefile,continent
+        "Paris, France",,Europe
+        Sao Paolo,data/sao_paolo.geojson,South America
+
+    YAML (a list of the same fields, or {name: continent}):
+        - name: Paris, France
+          continent: Europe
+        - name: Sao Paolo
+          shapefile: data/sao_paolo.geojson
+
+Usage:
+    python batch.py cities.csv results/ --workers 4
+"""
+
+import argparse
+import csv
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import geopandas as gpd
+
+try:
+    import yaml
+except ImportError:  # only needed for YAML city lists
+    yaml = None
+
+from pipeline import DEFAULT_CACHE_DIR
+from was_six_cities import calculate_walkability, calculate_walkability_from_shapefile
+
+# Columns written with the POIs, when present
+POI_COLUMNS = ["name", "public_transport", "railway", "highway", "amenity", "n_merged", "original_geom_type"]
+
+
+def read_city_list(path):
+    """
+    Read the cities of a batch from a CSV or YAML file
+
+    Parameters:
+    -----------
+    path : str
+        .csv, .yaml or .yml file
+
+    Returns:
+    --------
+    cities : list of dict
+        {'name', 'shapefile', 'continent'} of every city, in file order;
+        missing fields are None
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension in (".yaml", ".yml"):
+        if yaml is None:
+            raise ImportError("Reading a YAML city list requires PyYAML (pip install pyyaml)")
+        with open(path, encoding="utf-8") as f:
+            rows = yaml.safe_load(f) or []
+        if isinstance(rows, dict):
+            rows = [{"name": name, "continent": continent} for name, continent in rows.items()]
+    else:
+        with open(path, encoding="utf-8", newline="") as f:
+            rows = list(csv.DictReader(f))
+
+    cities, names = [], set()
+    for row in rows:
+        name = (row.get("name") or "").strip()
+        if not name:
+            continue
+        if name in names:
+            raise ValueError(f"City listed twice: {name}")
+        names.add(name)
+        cities.append({
+            "name": name,
+            "shapefile": (row.get("shapefile") or "").strip() or None,
+            "continent": (row.get("continent") or "").strip() or None,
+        })
+    return cities
+
+
+def city_slug(name):
+    """File name stem of a city's results"""
+    return re.sub(r"[^\w.-]+", "_", name).strip("_")
+
+
+def result_paths(output_dir, name):
+    """Grid, POI and trace paths of a city's results"""
+    stem = os.path.join(output_dir, city_slug(name))
+    return {"grid": f"{stem}.gpkg", "pois": f"{stem}_pois.gpkg", "trace": f"{stem}_trace.json"}
+
+
+def is_done(output_dir, name):
+    """Whether a city's results are complete; the grid is written last"""
+    return os.path.exists(result_paths(output_dir, name)["grid"])
+
+
+def _write_atomic(gdf, path):
+    tmp_path = f"{path}.{os.getpid()}.tmp.gpkg"
+    gdf.to_file(tmp_path, driver="GPKG")
+    os.replace(tmp_path, path)
+
+
+def process_city(city, output_dir, grid_size=500, min_grid_size=None, cache_dir=DEFAULT_CACHE_DIR, scoring="vector",
+                 merge_distance=None, poi_points=None):
+    """
+    Score one city and write its results
+
+    Runs in a worker process; the grid is written to disk there instead of
+    being sent back.
+
+    Returns:
+    --------
+    status : dict
+        {'name', 'ok', 'cells', 'pois'}
+    """
+    paths = result_paths(output_dir, city["name"])
+    options = dict(grid_size=grid_size, min_grid_size=min_grid_size, trace_path=paths["trace"], cache_dir=cache_dir,
+                   scoring=scoring, merge_distance=merge_distance, poi_points=poi_points)
+    if city["shapefile"]:
+        grid, pois = calculate_walkability_from_shapefile(city["shapefile"], city["name"], **options)
+    else:
+        grid, pois = calculate_walkability(city["name"], **options)
+    if grid is None:
+        return {"name": city["name"], "ok": False}
+
+    # POIs first: the grid file marks the city as complete
+    pois = pois[[c for c in POI_COLUMNS if c in pois.columns] + ["geometry"]].reset_index()
+    _write_atomic(pois, paths["pois"])
+
+    grid = grid.drop(columns=["centroid"], errors="ignore")
+    grid["place"] = city["name"]
+    grid["continent"] = city["continent"]
+    _write_atomic(grid, paths["grid"])
+    return {"name": city["name"], "ok": True, "cells": len(grid), "pois": len(pois)}
+
+
+def run_batch(cities, output_dir, grid_size=500, min_grid_size=None, workers=None, force=False,
+              cache_dir=DEFAULT_CACHE_DIR, scoring="vector", merge_distance=None, poi_points=None):
+    """
+    Process the cities not done yet, in parallel
+
+    Parameters:
+    -----------
+    cities : list of dict
+        Cities as returned by `read_city_list`
+    output_dir : str
+        Folder of the results
+    grid_size : int
+        Size of grid cells in meters (default: 500)
+    min_grid_size : int
+        Smallest cell size of an adaptive grid (default: uniform grid)
+    workers : int
+        Number of worker processes (default: number of CPU cores)
+    force : bool
+        Also reprocess the cities already done
+    cache_dir : str
+        Folder of the cached pipeline stages (None: no cache)
+    scoring : str
+        "vector" (exact) or "raster" (FFT convolution, for fine grids)
+    merge_distance : float
+        If given, merge the features of a same stop closer than this many
+        meters
+    poi_points : str
+        If given, score POIs as points: "representative" or "entrances"
+
+    Returns:
+    --------
+    statuses : list of dict
+        Status of every processed city, in completion order
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    todo = [city for city in cities if force or not is_done(output_dir, city["name"])]
+    print(f"{len(cities) - len(todo)} of {len(cities)} cities already done, {len(todo)} to process")
+    if not todo:
+        return []
+
+    workers = workers or min(len(todo), os.cpu_count() or 1)
+    statuses = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(
+                process_city, city, output_dir, grid_size, min_grid_size, cache_dir, scoring, merge_distance,
+                poi_points
+            ): city
+            for city in todo
+        }
+        for future in as_completed(futures):
+            name = futures[future]["name"]
+            try:
+                status = future.result()
+            except Exception as e:
+                # The worker itself failed (crash, write error...)
+                print(f"  ✗ Error processing {name}: {str(e)}")
+                status = {"name": name, "ok": False}
+            statuses.append(status)
+            print(f"[{len(statuses)}/{len(todo)}] {name}: {'done' if status['ok'] else 'failed'}")
+
+    return statuses
+
+
+def read_results(output_dir, cities):
+    """
+    Read back the results of the cities done so far
+
+    Returns:
+    --------
+    results : dict
+        {place_name: {'grid', 'pois', 'continent'}}, like
+        `calculate_walkability_batch`
+    """
+    results = {}
+    for city in cities:
+        paths = result_paths(output_dir, city["name"])
+        if os.path.exists(paths["grid"]):
+            results[city["name"]] = {
+                "grid": gpd.read_file(paths["grid"]),
+                "pois": gpd.read_file(paths["pois"]),
+                "continent": city["continent"],
+            }
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Resumable walkability batch over a list of cities")
+    parser.add_argument("city_list", help="CSV or YAML file of cities (name, shapefile, continent)")
+    parser.add_argument("output_dir", help="folder of the per-city results")
+    parser.add_argument("--grid-size", type=int, default=500, help="cell size in meters")
+    parser.add_argument("--min-grid-size", type=int, help="smallest cell size of an adaptive grid")
+    parser.add_argument("--scoring", choices=("vector", "raster"), default="vector",
+                        help="exact distances or FFT convolution (fine grids)")
+    parser.add_argument("--merge-distance", type=float,
+                        help="merge the features of a same stop closer than this many meters")
+    parser.add_argument("--poi-points", choices=("representative", "entrances"),
+                        help="score POIs as points inside stations, or as their subway entrances")
+    parser.add_argument("--workers", type=int, help="worker processes (default: CPU cores)")
+    parser.add_argument("--force", action="store_true", help="reprocess the cities already done")
+    parser.add_argument("--no-cache", action="store_true", help="do not cache the pipeline stages")
+    args = parser.parse_args(argv)
+
+    cities = read_city_list(args.city_list)
+    statuses = run_batch(
+        cities, args.output_dir, args.grid_size, args.min_grid_size, args.workers, args.force,
+        cache_dir=None if args.no_cache else DEFAULT_CACHE_DIR, scoring=args.scoring,
+        merge_distance=args.merge_distance, poi_points=args.poi_points
+    )
+
+    failed = [status["name"] for status in statuses if not status["ok"]]
+    if failed:
+        print(f"\n✗ {len(failed)} cities failed (rerun to retry): {', '.join(failed)}")
+        return 1
+    print("\n✓ All cities done")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
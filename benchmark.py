@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+"""
+Offline benchmark of the walkability pipeline
+
+Times every stage separately (grid generation, clipping, POI filtering,
+scoring, normalization and rendering) on synthetic cities of controlled
+size, or on the Overpass responses saved in `cache/`, without any network
+access. Results are written to a JSON report so runs can be compared
+between versions.
+
+Usage:
+    python benchmark.py --cells 1000 10000 100000 --pois 100 1000 10000
+    python benchmark.py --replay cache --output bench_cache.json
+"""
+
+import argparse
+import glob
+import io
+import json
+import math
+import os
+import platform
+import time
+from datetime import datetime, timezone
+
+import branca.colormap as cm
+import folium
+import geopandas as gpd
+import matplotlib
+import numpy as np
+import osmnx as ox
+import pandas as pd
+import shapely
+
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt  # noqa: E402
+
+from grid import clip_cells, grid_cells  # noqa: E402
+from poi_store import _normalize_tags, _polygonal  # noqa: E402
+from rendering import grid_layer  # noqa: E402
+from scoring import score_cells  # noqa: E402
+from transport_pois import TRANSPORT_TAGS, collapse_stops, filter_transport_pois  # noqa: E402
+
+# Tags of the synthetic POIs: transport features kept by the filter and
+# unrelated features it has to drop
+_SYNTHETIC_TAGS = [
+    ("public_transport", "stop_position"),
+    ("public_transport", "station"),
+    ("railway", "station"),
+    ("railway", "tram_stop"),
+    ("amenity", "bus_station"),
+    ("amenity", "cafe"),
+    ("highway", "crossing"),
+]
+
+# Tags the osmnx responses of cache/ may have been queried with
+_REPLAY_TAGS = [
+    TRANSPORT_TAGS,
+    {
+        "public_transport": ["station", "stop_position", "platform"],
+        "railway": ["station", "halt", "tram_stop", "subway_entrance"],
+        "highway": ["bus_stop"],
+    },
+]
+
+
+
+def _matches(element, tags):
+    """Whether an Overpass element matches any pair of a normalized tags dict"""
+    element_tags = element.get("tags", {})
+    return any(
+        key in element_tags and (value is True or element_tags[key] in value)
+        for key, value in tags.items()
+    )
+
+
+def _intersect_tags(tag_sets):
+    """Tag pairs shared by every normalized tags dict of `tag_sets`"""
+    common = dict(tag_sets[0])
+    for tags in tag_sets[1:]:
+        for key in list(common):
+            value = tags.get(key)
+            if value is None:
+                del common[key]
+            elif common[key] is True:
+                common[key] = value
+            elif value is not True:
+                common[key] = sorted(set(common[key]) & set(value))
+                if not common[key]:
+                    del common[key]
+    return common
+
+
+def infer_coverage(elements, known_tags):
+    """
+    Estimate the area and tags an Overpass response was queried with
+
+    Only an estimate, good enough to replay the responses of `cache/`: the
+    elements of a response cannot prove which tags were queried, which is
+    why `PoiStore` never answers from such a guess. Only the top-level
+    elements are considered: the nodes of returned ways and the members of
+    returned relations come with the `(._;>;)` recursion, not because they
+    match the query.
+
+    - The area is the concave hull of the top-level elements.
+    - The tags are the pairs shared by every tags dict of `known_tags` that
+      all top-level elements match.
+
+    Parameters:
+    -----------
+    elements : list of dict
+        Overpass JSON elements
+    known_tags : sequence of dict
+        osmnx tags dicts the response may have been queried with
+
+    Returns:
+    --------
+    coverage : shapely geometry
+        Estimated query area
+    tags : dict
+        Estimated query tags, {key: True or [values]}
+    """
+    coords = {}
+    members = set()
+    for element in elements:
+        if element["type"] == "node":
+            coords[element["id"]] = (element["lon"], element["lat"])
+        elif element["type"] == "way":
+            members.update(("node", n) for n in element.get("nodes", []))
+        elif element["type"] == "relation":
+            members.update((m["type"], m["ref"]) for m in element.get("members", []))
+    top = [e for e in elements if e.get("tags") and (e["type"], e["id"]) not in members]
+
+    points = []
+    for element in top:
+        # Location of the element: its own coordinates or those of its nodes
+        if element["type"] == "node":
+            points.append(coords[element["id"]])
+        elif element["type"] == "way":
+            points.extend(coords[n] for n in element.get("nodes", []) if n in coords)
+    if not points:
+        return shapely.Polygon(), {}
+    coverage = _polygonal(shapely.concave_hull(shapely.MultiPoint(points), ratio=0.2))
+
+    consistent = [tags for tags in map(_normalize_tags, known_tags) if all(_matches(e, tags) for e in top)]
+    return coverage, _intersect_tags(consistent) if consistent else {}
+
+def synthetic_city(n_cells, n_pois, grid_size=500, seed=0):
+    """
+    Irregular study area and tagged POIs of a given size
+
+    The boundary is a wobbly disc whose area holds about `n_cells` cells;
+    POIs are spread uniformly inside it, with one in ten duplicated to
+    exercise the deduplication.
+
+    Parameters:
+    -----------
+    n_cells : int
+        Approximate number of grid cells
+    n_pois : int
+        Number of POIs
+    grid_size : float
+        Size of grid cells in meters
+    seed : int
+        Random seed
+
+    Returns:
+    --------
+    study_area : GeoDataFrame
+        Boundary in EPSG:3857
+    pois : GeoDataFrame
+        Raw features in EPSG:3857, indexed by (element, id) like osmnx
+    """
+    rng = np.random.default_rng(seed)
+    radius = math.sqrt(n_cells * grid_size ** 2 / math.pi)
+
+    # Boundary: a disc with a few low-frequency bumps and some noise
+    angles = np.linspace(0, 2 * math.pi, 256, endpoint=False)
+    bumps = 1 + 0.15 * np.sin(3 * angles + rng.uniform(0, 2 * math.pi)) + rng.normal(0, 0.02, len(angles))
+    boundary = shapely.Polygon(np.column_stack([radius * bumps * np.cos(angles), radius * bumps * np.sin(angles)]))
+    boundary = shapely.make_valid(boundary)
+    study_area = gpd.GeoDataFrame(geometry=[boundary], crs="EPSG:3857")
+
+    # POIs inside the boundary, drawn in batches until there are enough
+    minx, miny, maxx, maxy = boundary.bounds
+    points = np.empty(0, dtype=object)
+    while len(points) < n_pois:
+        batch = shapely.points(rng.uniform(minx, maxx, 2 * n_pois), rng.uniform(miny, maxy, 2 * n_pois))
+        points = np.concatenate([points, batch[shapely.contains_xy(boundary, *shapely.get_coordinates(batch).T)]])
+    points = points[:n_pois]
+    n_duplicates = n_pois // 10
+    points[-n_duplicates or len(points):] = points[:n_duplicates]
+
+    kinds = rng.integers(0, len(_SYNTHETIC_TAGS), n_pois)
+    columns = {key: pd.Series(None, index=range(n_pois), dtype=object) for key, _ in _SYNTHETIC_TAGS}
+    for i, (key, value) in enumerate(_SYNTHETIC_TAGS):
+        columns[key][kinds == i] = value
+    index = pd.MultiIndex.from_arrays([["node"] * n_pois, np.arange(n_pois)], names=["element", "id"])
+    pois = gpd.GeoDataFrame(
+        {key: column.to_numpy() for key, column in columns.items()}, geometry=points, index=index, crs="EPSG:3857"
+    )
+    return study_area, pois
+
+
+def replay_city(path):
+    """
+    Study area and POIs of an Overpass response saved in the osmnx cache
+
+    The study area is the coverage estimated from the response (see
+    `infer_coverage`).
+
+    Returns:
+    --------
+    study_area, pois : GeoDataFrame, or (None, None) if the file is not
+        an Overpass response with tagged features
+    """
+    with open(path, encoding="utf-8") as f:
+        response = json.load(f)
+    if not isinstance(response, dict) or not response.get("elements"):
+        return None, None
+
+    coverage, tags = infer_coverage(response["elements"], _REPLAY_TAGS)
+    if coverage.is_empty or not tags:
+        return None, None
+    try:
+        pois = ox.features._create_gdf([response], coverage, tags)
+    except Exception:
+        return None, None
+
+    study_area = gpd.GeoDataFrame(geometry=[coverage], crs="EPSG:4326").to_crs(epsg=3857)
+    return study_area, pois.to_crs(epsg=3857)
+
+
+def _timed(stages, name, repeat, func, *args, **kwargs):
+    """Run `func` `repeat` times, keep its best time in `stages` and its last result"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    stages[name] = best
+    return result
+
+
+def _normalize(raw_score):
+    if raw_score.max() > raw_score.min():
+        return 100 * (raw_score - raw_score.min()) / (raw_score.max() - raw_score.min())
+    return raw_score * 0.0
+
+
+def _render_folium(grid):
+    colormap = cm.LinearColormap(colors=["#d7191c", "#ffffbf", "#1a9641"], vmin=0, vmax=100)
+    carte = folium.Map(location=[0, 0], zoom_start=12, tiles=None)
+    grid_layer(grid.to_crs(epsg=4326), "WAS", colormap, name="WAS").add_to(carte)
+    return len(carte.get_root().render())
+
+
+def _render_matplotlib(grid):
+    fig, ax = plt.subplots(figsize=(8, 8))
+    grid.plot(column="WAS", cmap="RdYlGn", ax=ax, vmin=0, vmax=100, edgecolor="black", linewidth=0.3)
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format="png", dpi=100)
+    plt.close(fig)
+    return buffer.tell()
+
+
+def run_case(name, study_area, pois, grid_size=500, repeat=1, overlay=False, render_limit=100000,
+             merge_distance=None):
+    """
+    Time every stage of the pipeline on one study area
+
+    Parameters:
+    -----------
+    name : str
+        Name of the case in the report
+    study_area : GeoDataFrame
+        Boundary in EPSG:3857
+    pois : GeoDataFrame
+        Raw features in EPSG:3857
+    grid_size : float
+        Size of grid cells in meters
+    repeat : int
+        Runs of each stage; the best time is kept
+    overlay : bool
+        Also time the former `gpd.overlay` clipping (slow on large grids)
+    render_limit : int
+        Largest number of cells for which rendering is timed
+    merge_distance : float, optional
+        Also time merging the features of a same stop closer than this
+        many meters, and score the merged POIs
+
+    Returns:
+    --------
+    case : dict
+        Sizes and seconds per stage
+    """
+    stages = {}
+    boundary = study_area.geometry.union_all()
+
+    cells = _timed(stages, "grid", repeat, grid_cells, study_area.total_bounds, grid_size)
+    clipped = _timed(stages, "clip", repeat, clip_cells, cells, boundary)
+    if overlay:
+        squares = gpd.GeoDataFrame({"geometry": cells}, crs=study_area.crs)
+        _timed(stages, "clip_overlay", repeat, gpd.overlay, squares, study_area, how="intersection")
+
+    transport = _timed(stages, "filter", repeat, filter_transport_pois, pois)
+    if merge_distance:
+        transport = _timed(stages, "collapse", repeat, collapse_stops, transport, merge_distance)
+    grid = gpd.GeoDataFrame({"geometry": clipped}, crs=study_area.crs)
+    grid["centroid"] = _timed(stages, "centroids", repeat, lambda: grid.geometry.centroid)
+    grid["raw_score"] = _timed(stages, "score", repeat, score_cells, grid["centroid"], transport.geometry)
+    grid["WAS"] = _timed(stages, "normalize", repeat, _normalize, grid["raw_score"])
+
+    if len(grid) <= render_limit:
+        render = grid[["WAS", "geometry"]]
+        _timed(stages, "render_folium", repeat, _render_folium, render)
+        _timed(stages, "render_matplotlib", repeat, _render_matplotlib, render)
+
+    stages["total"] = sum(stages.values())
+    print(f"  {name}: {len(grid)} cells, {len(transport)}/{len(pois)} POIs, {stages['total']:.2f} s")
+    return {
+        "name": name,
+        "grid_size": grid_size,
+        "squares": len(cells),
+        "cells": len(grid),
+        "pois": len(pois),
+        "transport_pois": len(transport),
+        "seconds": stages,
+    }
+
+
+def environment():
+    """Versions and machine the benchmark ran with"""
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "shapely": shapely.__version__,
+        "geopandas": gpd.__version__,
+        "osmnx": ox.__version__,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmark of the walkability pipeline")
+    parser.add_argument("--cells", type=int, nargs="+", default=[1000, 10000, 100000],
+                        help="approximate grid sizes of the synthetic cities")
+    parser.add_argument("--pois", type=int, nargs="+", default=[100, 1000, 10000],
+                        help="POI counts of the synthetic cities, paired with --cells")
+    parser.add_argument("--grid-size", type=float, default=500, help="cell size in meters")
+    parser.add_argument("--replay", metavar="FOLDER",
+                        help="benchmark the Overpass responses of this osmnx cache folder instead")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per stage, best time kept")
+    parser.add_argument("--overlay", action="store_true", help="also time the former gpd.overlay clipping")
+    parser.add_argument("--render-limit", type=int, default=100000,
+                        help="skip rendering above this many cells")
+    parser.add_argument("--merge-distance", type=float,
+                        help="also merge the features of a same stop closer than this many meters")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark.json", help="JSON report path")
+    args = parser.parse_args(argv)
+
+    cases = []
+    options = dict(grid_size=args.grid_size, repeat=args.repeat, overlay=args.overlay,
+                   render_limit=args.render_limit, merge_distance=args.merge_distance)
+
+    if args.replay:
+        for path in sorted(glob.glob(os.path.join(args.replay, "*.json"))):
+            study_area, pois = replay_city(path)
+            if study_area is not None:
+                cases.append(run_case(os.path.basename(path), study_area, pois, **options))
+    else:
+        if len(args.cells) != len(args.pois):
+            parser.error("--cells and --pois need the same number of values")
+        for n_cells, n_pois in zip(args.cells, args.pois):
+            study_area, pois = synthetic_city(n_cells, n_pois, args.grid_size, args.seed)
+            cases.append(run_case(f"synthetic_{n_cells}_{n_pois}", study_area, pois, **options))
+
+    report = {"environment": environment(), "cases": cases}
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to {args.output}")
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent store of study-area boundaries
+
+Geocoded boundaries are saved in a GeoPackage with their query string,
+OSM id and retrieval time, so repeat runs start computing without asking
+Nominatim again. Entries older than the TTL are geocoded again; if that
+fails, the stale boundary is used. Boundaries read from shapefiles or
+GeoJSON files can be registered under a name too, and are reloaded when
+the file changes; they are kept apart from the geocoded ones, so a file
+registered under the name of a geocoded place does not replace it.
+"""
+
+import os
+from datetime import datetime, timedelta, timezone
+
+import geopandas as gpd
+import osmnx as ox
+import pandas as pd
+
+GEOCODED = 'nominatim'
+FILE = 'file'
+
+# Default store, next to the osmnx responses
+DEFAULT_PATH = os.path.join(ox.settings.cache_folder, "boundaries.gpkg")
+
+_COLUMNS = ["query", "source", "path", "osm_type", "osm_id", "display_name", "retrieved"]
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+class BoundaryStore:
+    """
+    GeoPackage of study-area boundaries, one row per query and source, in
+    EPSG:4326
+
+    Parameters:
+    -----------
+    path : str
+        GeoPackage file (default: cache/boundaries.gpkg)
+    ttl_days : float
+        Age after which a geocoded boundary is fetched again (default: 90);
+        None keeps boundaries forever
+    """
+
+    def __init__(self, path=DEFAULT_PATH, ttl_days=90):
+        self.path = path
+        self.ttl = None if ttl_days is None else timedelta(days=ttl_days)
+        self._rows = self._read()
+
+    def _read(self):
+        """Rows of the file, by (source, query)"""
+        if not os.path.exists(self.path):
+            return {}
+        rows = {}
+        for row in gpd.read_file(self.path).to_dict('records'):
+            # Integer columns with missing values come back as floats
+            row['osm_id'] = None if pd.isna(row['osm_id']) else int(row['osm_id'])
+            rows[(row['source'], row['query'])] = row
+        return rows
+
+    def _save(self):
+        # Keep the rows other processes saved meanwhile (newest wins), then
+        # replace the file atomically
+        for key, row in self._read().items():
+            if key not in self._rows or row['retrieved'] > self._rows[key]['retrieved']:
+                self._rows[key] = row
+
+        table = gpd.GeoDataFrame(list(self._rows.values()), columns=_COLUMNS + ["geometry"], crs="EPSG:4326")
+        table['osm_id'] = table['osm_id'].astype("Int64")
+        folder = os.path.dirname(self.path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        tmp_path = f"{os.path.splitext(self.path)[0]}.{os.getpid()}.tmp.gpkg"
+        table.to_file(tmp_path, driver="GPKG", layer="boundaries")
+        os.replace(tmp_path, self.path)
+
+    def _put(self, query, geometry, source, **fields):
+        self._rows[(source, query)] = {
+            **{column: None for column in _COLUMNS},
+            **fields,
+            'query': query,
+            'source': source,
+            'retrieved': _now().isoformat(),
+            'geometry': geometry,
+        }
+        self._save()
+        return self._rows[(source, query)]
+
+    @staticmethod
+    def _to_gdf(row, cached):
+        gdf = gpd.GeoDataFrame(
+            {'query': [row['query']], 'osm_id': [row['osm_id']], 'display_name': [row['display_name']]},
+            geometry=[row['geometry']], crs="EPSG:4326",
+        )
+        gdf.attrs['boundary'] = {
+            **{column: row[column] for column in _COLUMNS},
+            'cached': cached,
+        }
+        return gdf
+
+    def _expired(self, row):
+        if self.ttl is None:
+            return False
+        return datetime.fromisoformat(row['retrieved']) + self.ttl < _now()
+
+    def __contains__(self, query):
+        return (GEOCODED, query) in self._rows or (FILE, query) in self._rows
+
+    def names(self):
+        """Queries and names held by the store"""
+        return list(dict.fromkeys(query for _, query in self._rows))
+
+    def get(self, query, refresh=False):
+        """
+        Boundary of a place, geocoded only when missing or expired
+
+        Parameters:
+        -----------
+        query : str
+            Nominatim query (e.g. "Paris, France"), or name of a registered
+            file when no boundary was geocoded under that name
+        refresh : bool
+            Geocode again even if the stored boundary is fresh
+
+        Returns:
+        --------
+        boundary : GeoDataFrame
+            One (multi)polygon in EPSG:4326; its metadata (OSM id,
+            retrieval time, whether it came from the store) is in
+            `boundary.attrs['boundary']`
+        """
+        row = self._rows.get((GEOCODED, query))
+        if row is None and (FILE, query) in self._rows:
+            return self.add_file(self._rows[(FILE, query)]['path'], query)
+        if row is not None and not refresh and not self._expired(row):
+            return self._to_gdf(row, cached=True)
+
+        try:
+            geocoded = ox.geocode_to_gdf(query).to_crs(epsg=4326)
+        except Exception:
+            if row is None:
+                raise
+            print(f"  Geocoding {query} failed, using the boundary stored on {row['retrieved']}")
+            return self._to_gdf(row, cached=True)
+
+        first = geocoded.iloc[0]
+        row = self._put(
+            query, geocoded.geometry.union_all(), GEOCODED,
+            osm_type=first.get('osm_type'), osm_id=None if pd.isna(first.get('osm_id')) else int(first['osm_id']),
+            display_name=first.get('display_name'),
+        )
+        return self._to_gdf(row, cached=False)
+
+    def add_file(self, path, name=None):
+        """
+        Register the boundary of a shapefile or GeoJSON file
+
+        The file is read again only when it changed since it was stored.
+
+        Parameters:
+        -----------
+        path : str
+            Boundary file; several features are merged into one
+        name : str, optional
+            Name to look it up with `get` (default: the file name); a
+            boundary geocoded under the same name is kept, and `get`
+            still returns it
+
+        Returns:
+        --------
+        boundary : GeoDataFrame
+            Same as `get`
+        """
+        name = name or os.path.splitext(os.path.basename(path))[0]
+        path = os.path.abspath(path)
+        row = self._rows.get((FILE, name))
+        if row is not None and row['path'] == path and os.path.exists(path):
+            modified = datetime.fromtimestamp(os.path.getmtime(path), timezone.utc)
+            if modified <= datetime.fromisoformat(row['retrieved']):
+                return self._to_gdf(row, cached=True)
+
+        boundary = gpd.read_file(path).to_crs(epsg=4326)
+        row = self._put(name, boundary.geometry.union_all(), FILE, path=path)
+        return self._to_gdf(row, cached=False)
+
+
+_default_store = None
+
+
+def default_store():
+    """Store at the default path, created on first use"""
+    global _default_store
+    if _default_store is None:
+        _default_store = BoundaryStore()
+    return _default_store
+
+
+def get_boundary(query):
+    """`BoundaryStore.get` on the default store"""
+    return default_store().get(query)
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+Fast grid generation and clipping
+
+Builds all the grid cells of a study area in one array operation, keeps
+the cells lying fully inside the boundary untouched and only runs a real
+polygon intersection on the cells that cross the boundary.
+"""
+
+import math
+
+import geopandas as gpd
+import numpy as np
+import shapely
+
+
+def grid_shape(bounds, grid_size):
+    """
+    Number of columns and rows needed to cover `bounds`
+
+    Parameters:
+    -----------
+    bounds : tuple
+        (minx, miny, maxx, maxy) of the area to cover
+    grid_size : float
+        Size of grid cells in meters
+
+    Returns:
+    --------
+    n_cols, n_rows : int
+    """
+    minx, miny, maxx, maxy = bounds
+    n_cols = max(int(math.ceil((maxx - minx) / grid_size)), 0)
+    n_rows = max(int(math.ceil((maxy - miny) / grid_size)), 0)
+    return n_cols, n_rows
+
+
+def grid_cells(bounds, grid_size, cols=None, rows=None):
+    """
+    Create square cells covering `bounds`, anchored on its lower-left corner
+
+    Cells are ordered column by column (x outer, y inner), like the former
+    nested `while` loops.
+
+    Parameters:
+    -----------
+    bounds : tuple
+        (minx, miny, maxx, maxy) of the area to cover
+    grid_size : float
+        Size of grid cells in meters
+    cols, rows : range, optional
+        Column and row indices to create (default: all of them). Used to
+        build one part of a larger grid with the same cell alignment.
+
+    Returns:
+    --------
+    cells : ndarray of shapely Polygons
+    """
+    minx, miny = bounds[0], bounds[1]
+    n_cols, n_rows = grid_shape(bounds, grid_size)
+    cols = np.arange(n_cols) if cols is None else np.asarray(cols)
+    rows = np.arange(n_rows) if rows is None else np.asarray(rows)
+
+    # Lower-left corners of every cell, x outer / y inner
+    col_idx, row_idx = np.meshgrid(cols, rows, indexing="ij")
+    x0 = minx + col_idx.ravel() * grid_size
+    y0 = miny + row_idx.ravel() * grid_size
+    return shapely.box(x0, y0, x0 + grid_size, y0 + grid_size)
+
+
+def _polygonal(geoms):
+    """
+    Keep only the polygonal part of intersection results
+
+    Mirrors `gpd.overlay(..., keep_geom_type=True)`: cells touching the
+    boundary along an edge or a corner produce lines or points, which are
+    dropped, and mixed collections are reduced to their polygons.
+    """
+    geoms = np.asarray(geoms, dtype=object)
+    type_ids = shapely.get_type_id(geoms)
+
+    # GeometryCollections: keep their polygon members only
+    for i in np.flatnonzero(type_ids == 7):
+        parts = shapely.get_parts(geoms[i])
+        parts = parts[np.isin(shapely.get_type_id(parts), (3, 6))]
+        geoms[i] = shapely.union_all(parts) if len(parts) else shapely.Polygon()
+
+    keep = np.isin(shapely.get_type_id(geoms), (3, 6)) & ~shapely.is_empty(geoms)
+    return geoms, keep
+
+
+def clip_cells(cells, boundary, return_index=False):
+    """
+    Clip grid cells to a boundary polygon
+
+    Cells fully inside the boundary are kept as they are; only the cells
+    crossing its edge are intersected.
+
+    Parameters:
+    -----------
+    cells : array-like of shapely Polygons
+        Grid cells
+    boundary : shapely geometry
+        Study area, in the same CRS as the cells
+    return_index : bool
+        Also return the positions in `cells` of the kept cells
+
+    Returns:
+    --------
+    clipped : ndarray of shapely Polygons
+        Clipped cells, in the order of `cells`
+    index : ndarray
+        Positions of the kept cells (only if `return_index`)
+    """
+    cells = np.asarray(cells, dtype=object)
+    if len(cells) == 0:
+        return (cells, np.array([], dtype=np.intp)) if return_index else cells
+
+    # Only cells whose box touches the boundary can survive
+    tree = shapely.STRtree(cells)
+    candidates = np.sort(tree.query(boundary, predicate="intersects"))
+    cells = cells[candidates]
+
+    # Interior cells are kept untouched, edge cells are really intersected
+    shapely.prepare(boundary)
+    inside = shapely.contains_properly(boundary, cells)
+    clipped = cells.copy()
+    clipped[~inside] = shapely.intersection(cells[~inside], boundary)
+
+    clipped, keep = _polygonal(clipped)
+    if return_index:
+        return clipped[keep], candidates[keep]
+    return clipped[keep]
+
+
+def build_grid(study_area, grid_size):
+    """
+    Build the grid of a study area, clipped to its boundary
+
+    Replacement for the `box()` loops followed by
+    `gpd.overlay(grid, study_area, how='intersection')`. The boundary
+    attribute columns are not copied onto the cells.
+
+    Parameters:
+    -----------
+    study_area : GeoDataFrame
+        Study area, in a projected CRS (meters)
+    grid_size : float
+        Size of grid cells in meters
+
+    Returns:
+    --------
+    grid : GeoDataFrame
+        Clipped grid cells
+    """
+    boundary = study_area.geometry.union_all()
+    cells = grid_cells(study_area.total_bounds, grid_size)
+    cells = clip_cells(cells, boundary)
+    return gpd.GeoDataFrame({'geometry': cells}, crs=study_area.crs)
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental re-scoring of a walkability grid when its POIs change
+
+A POI only contributes to the cells within the largest distance threshold
+of it, so when a few stops are added, removed or moved, the raw scores of
+all other cells stay the same. The POI sets are compared by OSM id (and by
+weight, for kernels weighting POIs by tag) and only the contributions of
+the changed POIs are removed from or added to the cells they reach, found
+by querying an STRtree of the centroids with the changed POIs only.
+"""
+
+import numpy as np
+import shapely
+
+from scoring import POINTS, THRESHOLDS, as_kernel
+
+
+def diff_pois(old_pois, new_pois, kernel=None):
+    """
+    Compare two POI sets by OSM id
+
+    POIs are matched on their index (`element`, `id` for osmnx features).
+    A POI whose geometry changed, or whose tags changed its weight under
+    `kernel`, is reported both as removed (old version) and as added (new
+    version).
+
+    Parameters:
+    -----------
+    old_pois, new_pois : GeoDataFrame
+        POIs before and after the update, in the same CRS
+    kernel : Kernel, optional
+        Scoring kernel, whose `poi_weights` are compared too
+
+    Returns:
+    --------
+    removed : GeoDataFrame
+        POIs of `old_pois` to take out of the scores
+    added : GeoDataFrame
+        POIs of `new_pois` to add to the scores
+    """
+    common = old_pois.index.intersection(new_pois.index)
+    moved = ~shapely.equals_exact(
+        np.asarray(old_pois.geometry.loc[common], dtype=object),
+        np.asarray(new_pois.geometry.loc[common], dtype=object),
+        tolerance=0,
+    )
+
+    # A retagged POI only matters through its weight
+    old_weights = None if kernel is None else kernel.poi_weights(old_pois)
+    if old_weights is not None:
+        new_weights = kernel.poi_weights(new_pois)
+        moved |= (old_weights[old_pois.index.get_indexer(common)] !=
+                  new_weights[new_pois.index.get_indexer(common)])
+    moved = common[moved]
+
+    removed = old_pois[~old_pois.index.isin(common) | old_pois.index.isin(moved)]
+    added = new_pois[~new_pois.index.isin(common) | new_pois.index.isin(moved)]
+    return removed, added
+
+
+def _contributions(centroids, tree, pois, kernel):
+    """Points brought by `pois` to each centroid within reach, as (cells, points)"""
+    geoms = np.asarray(pois.geometry, dtype=object)
+    # Padded by 1 m like `cell_poi_pairs`, then filtered on the exact distance
+    poi_idx, cell_idx = tree.query(geoms, predicate="dwithin", distance=kernel.max_radius + 1.0)
+    dists = shapely.distance(centroids[cell_idx], geoms[poi_idx])
+    keep = dists <= kernel.max_radius
+    cell_idx, poi_idx, dists = cell_idx[keep], poi_idx[keep], dists[keep]
+    return cell_idx, kernel.pair_points(dists, poi_idx, pois)
+
+
+def _centroids(grid):
+    if 'centroid' in grid.columns:
+        return np.asarray(grid['centroid'], dtype=object)
+    return np.asarray(grid.geometry.centroid, dtype=object)
+
+
+def centroid_tree(grid):
+    """
+    STRtree of the centroids of a grid, for `rescore_incremental`
+
+    Building it is the only step of an update proportional to the size of
+    the grid; build it once and pass it to each update of the grid.
+    """
+    return shapely.STRtree(_centroids(grid))
+
+
+def rescore_incremental(grid, old_pois, new_pois, thresholds=THRESHOLDS, points=POINTS, kernel=None, tree=None):
+    """
+    Update a scored grid after its POI set changed
+
+    Gives the same `raw_score` as scoring the grid from scratch with
+    `new_pois`, in time proportional to the number of changed POIs. `WAS`
+    is then renormalized over the whole grid; when the raw score min or max
+    moved, every `WAS` value shifts even if its raw score did not.
+
+    Parameters:
+    -----------
+    grid : GeoDataFrame
+        Grid returned by `calculate_walkability` (`raw_score` column, and
+        `centroid` if present, otherwise cell centroids are used)
+    old_pois : GeoDataFrame
+        POIs the grid was scored with
+    new_pois : GeoDataFrame
+        Updated POIs, filtered the same way
+    thresholds : sequence of float
+        Increasing distance thresholds in meters
+    points : sequence of int
+        Points awarded for each threshold band
+    kernel : Kernel, optional
+        Scoring kernel the grid was scored with, replacing `thresholds`
+        and `points`
+    tree : STRtree, optional
+        STRtree of the grid centroids (see `centroid_tree`), to reuse across
+        successive updates of the same grid; built here otherwise
+
+    Returns:
+    --------
+    grid : GeoDataFrame
+        Updated copy of the grid
+    changed : Index
+        Labels of the cells whose raw score changed
+    """
+    kernel = as_kernel(kernel, thresholds, points)
+    grid = grid.copy()
+    removed, added = diff_pois(old_pois.to_crs(grid.crs), new_pois.to_crs(grid.crs), kernel)
+
+    centroids = _centroids(grid)
+    tree = tree if tree is not None else shapely.STRtree(centroids)
+
+    # Only the cells near a changed POI get a non-zero delta
+    delta = np.zeros(len(grid), dtype=kernel.dtype)
+    cell_idx, weights = _contributions(centroids, tree, removed, kernel)
+    np.subtract.at(delta, cell_idx, weights.astype(kernel.dtype))
+    cell_idx, weights = _contributions(centroids, tree, added, kernel)
+    np.add.at(delta, cell_idx, weights.astype(kernel.dtype))
+
+    grid['raw_score'] = grid['raw_score'].to_numpy() + delta
+    changed = grid.index[delta != 0]
+
+    # Normalize scores to 0-100
+    if len(new_pois) > 0 and grid['raw_score'].max() > grid['raw_score'].min():
+        grid["WAS"] = 100 * (grid['raw_score'] - grid['raw_score'].min()) / \
+                      (grid['raw_score'].max() - grid['raw_score'].min())
+    else:
+        grid["WAS"] = 0
+
+    return grid, changed
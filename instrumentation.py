@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Per-stage timing and memory instrumentation
+
+A `Trace` records, for every stage of a run, its wall time, how much the
+resident memory of the process grew during the stage, the current and
+peak RSS of the process when it ended and the number of rows it received
+and produced. The peak is the process's since it started (the OS keeps no
+per-stage peak): it only tells a stage apart when it grew during it. The trace can be attached to a result, written as a
+JSON file and forwarded to other metrics systems through hooks, called
+with each stage record as soon as the stage ends.
+"""
+
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+try:
+    import psutil
+except ImportError:  # optional, the resource module is used instead
+    psutil = None
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# Hooks called with every stage record of every trace, e.g. to forward
+# them to a metrics system: hook(trace_name, record)
+HOOKS = []
+
+
+def add_hook(hook):
+    """Register `hook(trace_name, record)` for the stages of every trace"""
+    HOOKS.append(hook)
+
+
+def _to_mb(value):
+    return None if value is None else round(value / 2 ** 20, 1)
+
+
+def memory_usage():
+    """
+    Current resident memory of the process and its peak since the process
+    started, in MB
+
+    Returns:
+    --------
+    rss_mb, process_peak_rss_mb : float or None
+        None when the platform gives no way to measure it
+    """
+    rss = peak = None
+    if psutil is not None:
+        info = psutil.Process().memory_info()
+        rss = info.rss
+        peak = getattr(info, "peak_wset", None)  # Windows only
+    if peak is None and resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Kilobytes on Linux, bytes on macOS
+        if sys.platform != "darwin":
+            peak *= 1024
+    if rss is not None and peak is not None:
+        # The peak is sampled coarser than the current value
+        peak = max(peak, rss)
+    return _to_mb(rss), _to_mb(peak)
+
+
+class Trace:
+    """
+    Stage records of one run
+
+    Parameters:
+    -----------
+    name : str
+        Name of the run (e.g. the place name)
+    hooks : sequence of callable, optional
+        Called as hook(name, record) when a stage ends, besides `HOOKS`
+    verbose : bool
+        Print one line per stage as it ends
+    """
+
+    def __init__(self, name, hooks=(), verbose=False):
+        self.name = name
+        self.hooks = list(hooks)
+        self.verbose = verbose
+        self.stages = []
+        self._current = None
+        self._started = self._ended = time.perf_counter()
+
+    def start(self, stage, rows_in=None):
+        """Start a stage, ending the current one if any"""
+        if self._current is not None:
+            self.stop()
+        rss, peak = memory_usage()
+        self._current = {
+            "stage": stage, "rows_in": rows_in, "_start": time.perf_counter(), "_rss": rss, "_peak": peak,
+        }
+
+    def stop(self, rows_out=None, error=None, **fields):
+        """
+        End the current stage
+
+        Parameters:
+        -----------
+        rows_out : int, optional
+            Number of rows the stage produced
+        error : str, optional
+            Error that interrupted the stage
+        **fields
+            Extra values to record (e.g. cached=True)
+
+        Returns:
+        --------
+        record : dict
+            {'stage', 'seconds', 'rss_delta_mb', 'rss_mb', 'process_peak_rss_mb',
+            'peak_grew', 'rows_in', 'rows_out'} (and 'error' when the stage
+            failed); `rss_delta_mb` is the RSS growth over the stage, and
+            `peak_grew` whether the process peak was reached during it
+        """
+        record, self._current = self._current, None
+        if record is None:
+            return None
+
+        self._ended = time.perf_counter()
+        record["seconds"] = round(self._ended - record.pop("_start"), 6)
+        rss_start, peak_start = record.pop("_rss"), record.pop("_peak")
+        record["rss_mb"], record["process_peak_rss_mb"] = memory_usage()
+        record["rss_delta_mb"] = None if rss_start is None else round(record["rss_mb"] - rss_start, 1)
+        record["peak_grew"] = None if peak_start is None else record["process_peak_rss_mb"] > peak_start
+        record["rows_out"] = rows_out
+        record.update(fields)
+        if error is not None:
+            record["error"] = error
+        self.stages.append(record)
+
+        if self.verbose:
+            rows = "" if rows_out is None else f", {rows_out} rows"
+            print(f"    {record['stage']}: {record['seconds']:.2f} s{rows}")
+        for hook in HOOKS + self.hooks:
+            hook(self.name, record)
+        return record
+
+    @contextmanager
+    def stage(self, stage, rows_in=None):
+        """
+        Record the stage run inside a `with` block
+
+        The block may set `rows_out` and extra fields on the yielded dict.
+        A stage raising an exception is recorded with its error.
+        """
+        self.start(stage, rows_in)
+        fields = {"rows_out": None}
+        try:
+            yield fields
+        except Exception as e:
+            self.stop(error=str(e), **fields)
+            raise
+        self.stop(**fields)
+
+    def to_dict(self):
+        """Trace as plain, JSON-serializable data"""
+        return {
+            "name": self.name,
+            "pid": os.getpid(),
+            "seconds": round(self._ended - self._started, 6),
+            "stages": [dict(record) for record in self.stages],
+        }
+
+    def save(self, path):
+        """Write the trace as a JSON file"""
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, indent=2, ensure_ascii=False)
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+Load test of the walkability query service
+
+Opens keep-alive connections to a running `service.py` and sends random
+point, box and summary queries inside the bounds of the cities it serves,
+as fast as the service answers. Latency percentiles, throughput and
+errors are printed per endpoint and written to a JSON report, next to the
+environment like `benchmark.py`.
+
+Usage:
+    python service.py results/ --port 8080 &
+    python loadtest.py --port 8080 --requests 20000 --concurrency 32
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from urllib.parse import quote
+
+import numpy as np
+
+from benchmark import environment
+
+# Share of point, box and summary queries
+DEFAULT_MIX = (0.8, 0.15, 0.05)
+
+
+async def _request(reader, writer, host, target):
+    """Send one GET on an open connection; return (status, body)"""
+    writer.write(f"GET {target} HTTP/1.1\r\nHost: {host}\r\nConnection: keep-alive\r\n\r\n".encode("latin-1"))
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        key, _, value = line.decode("latin-1").partition(":")
+        if key.strip().lower() == "content-length":
+            length = int(value)
+    return status, await reader.readexactly(length)
+
+
+def make_queries(cities, n, mix=DEFAULT_MIX, box_size=0.01, seed=0):
+    """
+    Random queries inside the bounds of the served cities
+
+    Parameters:
+    -----------
+    cities : list of dict
+        City summaries of `GET /cities`
+    n : int
+        Number of queries
+    mix : tuple of float
+        Shares of /score, /cells and /cities/<name> queries
+    box_size : float
+        Side of the /cells boxes in degrees (default: 0.01, about 1 km)
+    seed : int
+
+    Returns:
+    --------
+    queries : list of (endpoint, target)
+    """
+    rng = np.random.default_rng(seed)
+    mix = np.asarray(mix, dtype=float) / sum(mix)
+    kinds = rng.choice(["score", "cells", "city"], size=n, p=mix)
+    picks = rng.integers(len(cities), size=n)
+    u = rng.random((n, 2))
+
+    queries = []
+    for kind, pick, (a, b) in zip(kinds, picks, u):
+        city = cities[pick]
+        min_lon, min_lat, max_lon, max_lat = city['bounds']
+        lon, lat = min_lon + a * (max_lon - min_lon), min_lat + b * (max_lat - min_lat)
+        if kind == "score":
+            target = f"/score?lat={lat:.6f}&lon={lon:.6f}"
+        elif kind == "cells":
+            target = f"/cells?bbox={lon:.6f},{lat:.6f},{lon + box_size:.6f},{lat + box_size:.6f}"
+        else:
+            target = f"/cities/{quote(city['name'])}"
+        queries.append((kind, target))
+    return queries
+
+
+async def _client(host, port, queries, results):
+    """One keep-alive connection working through a shared query list"""
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        while queries:
+            kind, target = queries.pop()
+            started = time.perf_counter()
+            try:
+                status, _ = await _request(reader, writer, host, target)
+            except (ConnectionError, asyncio.IncompleteReadError, ValueError, IndexError):
+                # Reconnect and count the query as failed
+                results.append((kind, time.perf_counter() - started, None))
+                writer.close()
+                reader, writer = await asyncio.open_connection(host, port)
+                continue
+            results.append((kind, time.perf_counter() - started, status))
+    finally:
+        writer.close()
+
+
+def _stats(latencies, statuses, seconds):
+    latencies = np.asarray(latencies) * 1000
+    ok = sum(status is not None and status < 500 for status in statuses)
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99]) if len(latencies) else (np.nan,) * 3
+    return {
+        'requests': len(latencies),
+        'errors': len(latencies) - ok,
+        'not_found': sum(status == 404 for status in statuses),
+        'p50_ms': round(float(p50), 3),
+        'p90_ms': round(float(p90), 3),
+        'p99_ms': round(float(p99), 3),
+        'max_ms': round(float(latencies.max(initial=0)), 3),
+        'throughput': round(len(latencies) / seconds, 1),
+    }
+
+
+async def run_load_test(host="127.0.0.1", port=8080, requests=10000, concurrency=32, mix=DEFAULT_MIX, seed=0):
+    """
+    Hammer a running service with random queries
+
+    Parameters:
+    -----------
+    host, port
+        Address of the service
+    requests : int
+        Number of queries to send
+    concurrency : int
+        Number of simultaneous connections
+    mix : tuple of float
+        Shares of /score, /cells and /cities/<name> queries
+    seed : int
+
+    Returns:
+    --------
+    report : dict
+        Latency percentiles (ms), throughput (requests/s) and errors, over
+        all queries and per endpoint
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    status, body = await _request(reader, writer, host, "/cities")
+    writer.close()
+    cities = json.loads(body)['cities']
+    if status != 200 or not cities:
+        raise RuntimeError(f"The service at {host}:{port} serves no city")
+
+    queries = make_queries(cities, requests, mix, seed=seed)
+    results = []
+    started = time.perf_counter()
+    await asyncio.gather(*(_client(host, port, queries, results) for _ in range(concurrency)))
+    seconds = time.perf_counter() - started
+
+    report = {
+        'cities': len(cities),
+        'requests': requests,
+        'concurrency': concurrency,
+        'seconds': round(seconds, 3),
+        'all': _stats([r[1] for r in results], [r[2] for r in results], seconds),
+    }
+    for kind in ("score", "cells", "city"):
+        subset = [r for r in results if r[0] == kind]
+        if subset:
+            report[kind] = _stats([r[1] for r in subset], [r[2] for r in subset], seconds)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test of the walkability query service")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--requests", type=int, default=10000, help="number of queries to send")
+    parser.add_argument("--concurrency", type=int, default=32, help="simultaneous connections")
+    parser.add_argument("--mix", type=float, nargs=3, default=DEFAULT_MIX, metavar=("SCORE", "CELLS", "CITY"),
+                        help="shares of point, box and summary queries")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="loadtest.json", help="JSON report path")
+    args = parser.parse_args(argv)
+
+    report = asyncio.run(run_load_test(args.host, args.port, args.requests, args.concurrency, args.mix, args.seed))
+    report = {"environment": environment(), **report}
+
+    print(f"{report['requests']} requests over {report['concurrency']} connections in {report['seconds']} s")
+    for kind in ("all", "score", "cells", "city"):
+        if kind in report:
+            s = report[kind]
+            print(f"  {kind:6s} {s['throughput']:8.0f} req/s   p50 {s['p50_ms']:.2f} ms   p90 {s['p90_ms']:.2f} ms   "
+                  f"p99 {s['p99_ms']:.2f} ms   errors {s['errors']}")
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to {args.output}")
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+Walking-network distance scoring
+
+Straight-line distances overrate cells across rivers, rail yards and
+motorways. This mode measures the distance between cells and POIs along a
+walking graph (e.g. saved by `ox.save_graphml`) instead:
+
+1. POIs and cell centroids are snapped to their nearest graph node.
+2. Bounded Dijkstra searches run from the distinct POI nodes, cut off at
+   the largest threshold, `batch_size` (64) source nodes per
+   `csgraph.dijkstra` call. Its output is dense (batch_size x number of
+   graph nodes float64), so batches are shrunk to hold at most
+   `MAX_BATCH_ENTRIES` distances, and only the nodes each search reached
+   are kept from it.
+3. The reached nodes are mapped to the cells snapped to them through a
+   node -> cells index, and every POI within reach of a cell adds the
+   points of its band (or of any other scoring kernel). Memory follows
+   the number of (POI, cell) pairs within reach, not POIs x cells.
+
+Network distance = POI snap distance + path length + centroid snap
+distance, in meters.
+"""
+
+import functools
+import os
+
+import numpy as np
+import osmnx as ox
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from scipy.spatial import cKDTree
+
+from scoring import POINTS, THRESHOLDS, as_kernel
+
+# Largest dense Dijkstra output of a batch (2**24 float64: 128 MB)
+MAX_BATCH_ENTRIES = 2 ** 24
+
+
+@functools.lru_cache(maxsize=4)
+def _load_projected_graph(path, mtime_ns):
+    return ox.project_graph(ox.load_graphml(path))
+
+
+def load_walk_graph(path):
+    """
+    Load a walking graph saved as GraphML and project it to UTM
+
+    Graphs are cached by path and modification time, so the pipeline's
+    runs only parse a file once; the graph returned is shared and must
+    not be modified.
+
+    Parameters:
+    -----------
+    path : str
+        GraphML file, as written by `ox.save_graphml`
+
+    Returns:
+    --------
+    G : networkx.MultiDiGraph
+        Projected graph, edge `length` in meters
+    """
+    path = os.path.abspath(path)
+    return _load_projected_graph(path, os.stat(path).st_mtime_ns)
+
+
+def _ranges(starts, counts):
+    """Concatenation of range(start, start + count) for every pair"""
+    ends = np.cumsum(counts)
+    return np.repeat(starts - ends + counts, counts) + np.arange(ends[-1] if len(ends) else 0)
+
+
+def _group(keys, n):
+    """Positions sorted by key, and where the positions of each key 0..n-1 start"""
+    order = np.argsort(keys, kind="stable")
+    return order, np.searchsorted(keys[order], np.arange(n + 1))
+
+
+def _graph_arrays(G):
+    """Node coordinates and sparse adjacency (shortest parallel edge) of a graph"""
+    nodes = list(G.nodes)
+    n = len(nodes)
+    position = {node: i for i, node in enumerate(nodes)}
+    xy = np.array([(G.nodes[node]['x'], G.nodes[node]['y']) for node in nodes])
+
+    rows, cols, lengths = [], [], []
+    for u, v, length in G.edges(data='length'):
+        rows.append(position[u])
+        cols.append(position[v])
+        lengths.append(length)
+
+    # Keep the shortest of parallel edges; zero lengths would be read as
+    # missing edges by csgraph, so they get a tiny positive length
+    key = np.array(rows, dtype=np.int64) * n + np.array(cols, dtype=np.int64)
+    lengths = np.maximum(np.array(lengths, dtype=float), 1e-6)
+    order = np.lexsort((lengths, key))
+    key, lengths = key[order], lengths[order]
+    first = np.r_[True, key[1:] != key[:-1]]
+    key, lengths = key[first], lengths[first]
+    adjacency = csr_matrix((lengths, (key // n, key % n)), shape=(n, n))
+    return xy, adjacency
+
+
+def network_scores(G, centroids, pois, crs, thresholds=THRESHOLDS, points=POINTS, batch_size=64, kernel=None):
+    """
+    Raw walkability score of every cell using walking-network distances
+
+    Parameters:
+    -----------
+    G : networkx.MultiDiGraph
+        Projected walking graph (see `load_walk_graph`)
+    centroids : GeoSeries
+        Grid cell centroids
+    pois : GeoDataFrame or GeoSeries
+        POIs; polygons are snapped from a representative point (a
+        GeoDataFrame for kernels weighting POIs by tag)
+    crs : CRS
+        CRS of `centroids` and `pois`
+    thresholds : sequence of float
+        Increasing distance thresholds in meters
+    points : sequence of int
+        Points awarded for each threshold band
+    batch_size : int
+        Number of POI nodes searched together, lowered so that a batch's
+        dense distances (batch_size x number of graph nodes x 8 bytes) stay
+        under `MAX_BATCH_ENTRIES`
+    kernel : Kernel, optional
+        Scoring kernel replacing `thresholds` and `points`
+
+    Returns:
+    --------
+    raw_score : ndarray
+        Raw score of each cell, in the order of `centroids`
+    """
+    kernel = as_kernel(kernel, thresholds, points)
+    n_cells = len(centroids)
+    raw_score = np.zeros(n_cells, dtype=kernel.dtype)
+    if n_cells == 0 or len(pois) == 0:
+        return raw_score
+
+    xy, adjacency = _graph_arrays(G)
+    graph_crs = G.graph['crs']
+
+    # Snap POIs and centroids to their nearest node, remembering how far it is
+    tree = cKDTree(xy)
+    poi_points = pois.geometry.set_crs(crs, allow_override=True).representative_point().to_crs(graph_crs)
+    cell_points = centroids.set_crs(crs, allow_override=True).to_crs(graph_crs)
+    poi_offset, poi_node = tree.query(np.column_stack([poi_points.x, poi_points.y]))
+    cell_offset, cell_node = tree.query(np.column_stack([cell_points.x, cell_points.y]))
+
+    # One search per distinct POI node, shared by the POIs snapped to it
+    radius = kernel.max_radius
+    factors = kernel.poi_weights(pois)
+    sources, poi_source = np.unique(poi_node, return_inverse=True)
+    pois_by_source, source_start = _group(poi_source, len(sources))
+    cells_by_node, node_start = _group(cell_node, len(xy))
+    batch_size = max(1, min(batch_size, MAX_BATCH_ENTRIES // len(xy)))
+
+    weights = np.zeros(n_cells)
+    for start in range(0, len(sources), batch_size):
+        batch = sources[start:start + batch_size]
+        # Walking ignores one-ways: edges can be used in both directions
+        dist = dijkstra(adjacency, directed=False, indices=batch, limit=radius)
+
+        # Nodes reached by each search that hold cells, then their cells
+        source, node = np.nonzero(np.isfinite(dist))
+        path = dist[source, node]
+        del dist
+        n_cells_at = node_start[node + 1] - node_start[node]
+        source, node, path, n_cells_at = (a[n_cells_at > 0] for a in (source, node, path, n_cells_at))
+        cell = cells_by_node[_ranges(node_start[node], n_cells_at)]
+        source, path = np.repeat(source + start, n_cells_at), np.repeat(path, n_cells_at)
+
+        # Then the POIs snapped to each source
+        n_pois_at = source_start[source + 1] - source_start[source]
+        poi = pois_by_source[_ranges(source_start[source], n_pois_at)]
+        cell, path = np.repeat(cell, n_pois_at), np.repeat(path, n_pois_at)
+
+        values = kernel(poi_offset[poi] + path + cell_offset[cell])
+        if factors is not None:
+            values = values * factors[poi]
+        weights += np.bincount(cell, weights=values, minlength=n_cells)
+
+    raw_score += weights.astype(kernel.dtype)
+    return raw_score
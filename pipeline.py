@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+"""
+Staged walkability pipeline with on-disk caching of every stage
+
+    boundary -> grid -> POIs -> distances -> score -> normalize
+
+Each stage's output is saved under a key hashed from its own parameters
+and the keys of the stages it reads, so a rerun only recomputes the stages
+whose inputs changed. Boundaries come from the boundary store and are
+keyed by their geometry, and the stages reading the POIs by their content,
+so refreshed POIs that changed rerun everything downstream. Changing the
+points of each band, or any other scoring kernel, only reruns the score and
+normalization, and the cached distances are reused as long as the kernel
+radius stays the same.
+"""
+
+import glob
+import hashlib
+import json
+import os
+import pickle
+
+import numpy as np
+import osmnx as ox
+import pandas as pd
+import shapely
+
+from adaptive_grid import build_adaptive_grid
+from boundaries import default_store
+from grid import build_grid
+from instrumentation import Trace
+from network import load_walk_graph, network_scores
+from poi_store import features_from_polygon
+from raster import raster_score_cells
+from scoring import POINTS, THRESHOLDS, as_kernel, cell_poi_pairs
+from transport_pois import TRANSPORT_TAGS, collapse_stops, filter_transport_pois, normalize_pois
+
+# Default folder of the stage outputs, next to the osmnx responses
+DEFAULT_CACHE_DIR = os.path.join(ox.settings.cache_folder, "pipeline")
+
+# Bump to invalidate every cached stage output when their format or
+# computation changes
+PIPELINE_VERSION = 2
+
+# Stages cached in `cache_dir` (boundaries live in the boundary store)
+STAGES = ("grid", "pois", "distances", "score", "normalize")
+
+
+def _file_digest(paths):
+    """SHA-1 of the content of some files"""
+    digest = hashlib.sha1()
+    for path in paths:
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(2 ** 20), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def _frame_digest(gdf):
+    """SHA-1 of the index, attributes and geometries of a GeoDataFrame"""
+    digest = hashlib.sha1(json.dumps(list(map(str, gdf.columns))).encode("utf-8"))
+    attributes = gdf.drop(columns=gdf.geometry.name).astype(str)
+    digest.update(pd.util.hash_pandas_object(attributes, index=True).to_numpy().tobytes())
+    for wkb in shapely.to_wkb(np.asarray(gdf.geometry, dtype=object)):
+        digest.update(wkb or b"")
+    return digest.hexdigest()
+
+
+def _rows(result):
+    """Number of rows of a stage output (of its first array for a dict)"""
+    if isinstance(result, dict):
+        return len(next(iter(result.values()), ()))
+    return len(result)
+
+
+def _stage_key(stage, **inputs):
+    """Cache key of a stage from its parameters and the keys it depends on"""
+    payload = json.dumps({"stage": stage, "version": PIPELINE_VERSION, **inputs}, sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+class WalkabilityPipeline:
+    """
+    Walkability computation split into cached stages
+
+    Parameters:
+    -----------
+    grid_size : int
+        Size of grid cells in meters (default: 500)
+    min_grid_size : int
+        If given, build an adaptive grid refined down to this size; the
+        grid, distances and score stages are then computed together
+    walk_graph : str
+        GraphML walking network; if given, distances are measured along
+        it (uniform grid only), the distances and score stages are then
+        computed together
+    scoring : str
+        "vector" (exact centroid distances, default) or "raster" (FFT
+        convolution on the grid lattice, for very fine uniform grids; see
+        `raster` for its accuracy)
+    oversample : int
+        Odd number of raster pixels per cell side in "raster" scoring
+    thresholds : sequence of float
+        Increasing distance thresholds in meters
+    points : sequence of int
+        Points awarded for each threshold band
+    kernel : Kernel, optional
+        Scoring kernel replacing `thresholds` and `points` (see `scoring`)
+    tags : dict
+        OSM tags of the POIs, also used to filter the features returned
+    merge_distance : float, optional
+        If given, merge the features of a same stop closer than this
+        distance in meters, or in a same `stop_area` (see `collapse_stops`)
+    poi_points : str, optional
+        Replace the POIs by points once, so every scoring path measures
+        point distances: "representative" (a point inside each feature)
+        or "entrances" (stations by their subway entrances); see
+        `normalize_pois`
+    cache_dir : str
+        Folder of the cached stage outputs; None disables the cache
+    trace : Trace, optional
+        Records time, memory and rows of every stage (a new one per run
+        by default)
+    boundaries : BoundaryStore, optional
+        Store the study areas are geocoded or read through (default: the
+        one in the osmnx cache folder)
+    """
+
+    def __init__(self, grid_size=500, min_grid_size=None, walk_graph=None, thresholds=THRESHOLDS,
+                 points=POINTS, tags=TRANSPORT_TAGS, cache_dir=DEFAULT_CACHE_DIR, trace=None,
+                 scoring="vector", oversample=1, boundaries=None, kernel=None, merge_distance=None,
+                 poi_points=None):
+        if scoring not in ("vector", "raster"):
+            raise ValueError(f"Unknown scoring mode: {scoring}")
+        if poi_points not in (None, "representative", "entrances"):
+            raise ValueError(f"Unknown POI points mode: {poi_points}")
+        self.grid_size = grid_size
+        self.min_grid_size = min_grid_size
+        self.walk_graph = walk_graph
+        self.scoring = scoring
+        self.oversample = oversample
+        self.kernel = as_kernel(kernel, thresholds, points)
+        self.tags = tags
+        self.merge_distance = merge_distance
+        self.poi_points = poi_points
+        self.cache_dir = cache_dir
+        self.trace = trace
+        self.boundaries = boundaries
+
+    def _path(self, stage, key):
+        return os.path.join(self.cache_dir, stage, f"{key}.pkl")
+
+    def _cached(self, trace, stage, key, compute, refresh, rows_in=None):
+        """Output of `stage` for `key`, loaded from the cache or computed and saved"""
+        with trace.stage(stage, rows_in=rows_in) as record:
+            path = self._path(stage, key) if self.cache_dir else None
+            if path and stage not in refresh and os.path.exists(path):
+                with open(path, "rb") as f:
+                    result = pickle.load(f)
+                record["cached"] = True
+            else:
+                result = compute()
+                record["cached"] = False
+                if path:
+                    # Replace atomically so concurrent runs never read half a file
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    tmp_path = f"{path}.{os.getpid()}.tmp"
+                    with open(tmp_path, "wb") as f:
+                        pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+                    os.replace(tmp_path, path)
+            record["rows_out"] = _rows(result)
+        return result
+
+    def clear_cache(self, stages=STAGES):
+        """Delete the cached outputs of some stages"""
+        if not self.cache_dir:
+            return
+        for stage in stages:
+            for path in glob.glob(os.path.join(self.cache_dir, stage, "*.pkl")):
+                os.remove(path)
+
+    def _boundary(self, trace, place_name, shapefile_path, refresh):
+        """Study area in EPSG:3857, a single (multi)polygon, from the boundary store"""
+        store = self.boundaries or default_store()
+        with trace.stage("boundary") as record:
+            if shapefile_path is None:
+                study_area = store.get(place_name, refresh="boundary" in refresh)
+            else:
+                study_area = store.add_file(shapefile_path, place_name)
+            record['cached'] = study_area.attrs['boundary']['cached']
+            record['rows_out'] = len(study_area)
+        return study_area.to_crs(epsg=3857)
+
+    def _pois(self, study_area, refresh=False):
+        """Filtered POIs of the study area, in EPSG:3857 (fetched again from Overpass with `refresh`)"""
+        polygon = study_area.to_crs(epsg=4326).geometry.union_all()
+        pois = features_from_polygon(polygon, self.tags, refresh=refresh)
+        pois = filter_transport_pois(pois, self.tags).to_crs(epsg=3857)
+        # Merge stops while stop areas are still polygons
+        if self.merge_distance:
+            pois = collapse_stops(pois, self.merge_distance)
+        if self.poi_points:
+            pois = normalize_pois(pois, entrances=self.poi_points == "entrances")
+        return pois
+
+    def _grid(self, study_area):
+        grid = build_grid(study_area, self.grid_size)
+        grid['centroid'] = grid.geometry.centroid
+        return grid
+
+    def _distances(self, grid, pois):
+        """Cell, POI and distance of every (cell, POI) pair within the kernel radius"""
+        cell_idx, poi_idx, dists = cell_poi_pairs(grid['centroid'], pois.geometry, self.kernel.max_radius)
+        return {'cell_idx': cell_idx, 'poi_idx': poi_idx, 'dists': dists}
+
+    def _score(self, grid, pois, distances):
+        weights = self.kernel.pair_points(distances['dists'], distances['poi_idx'], pois)
+        return np.bincount(distances['cell_idx'], weights=weights, minlength=len(grid)).astype(self.kernel.dtype)
+
+    def _raster_score(self, study_area, grid, pois):
+        return raster_score_cells(
+            grid['centroid'], pois, study_area.total_bounds, self.grid_size,
+            oversample=self.oversample, kernel=self.kernel
+        )
+
+    def _network_score(self, grid, pois):
+        return network_scores(
+            load_walk_graph(self.walk_graph), grid['centroid'], pois, grid.crs, kernel=self.kernel
+        )
+
+    @staticmethod
+    def _normalize(raw_score, n_pois):
+        """Scores rescaled to 0-100"""
+        raw_score = np.asarray(raw_score, dtype=float)
+        if n_pois > 0 and len(raw_score) and raw_score.max() > raw_score.min():
+            return 100 * (raw_score - raw_score.min()) / (raw_score.max() - raw_score.min())
+        return np.zeros(len(raw_score))
+
+    def run(self, place_name=None, shapefile_path=None, refresh=()):
+        """
+        Compute the walkability grid of a place, reusing cached stages
+
+        Parameters:
+        -----------
+        place_name : str
+            Place to geocode (and name of the run)
+        shapefile_path : str, optional
+            Boundary file to use instead of geocoding `place_name`
+        refresh : sequence of str
+            Stages to recompute even if cached (e.g. ("pois",) after OSM
+            updates, which fetches the POIs from Overpass again instead of
+            the POI store); the stages reading the POIs are keyed by their
+            content, so they rerun whenever the refreshed POIs differ
+
+        Returns:
+        --------
+        grid : GeoDataFrame
+            Grid with `centroid`, `raw_score` and `WAS` columns; the trace
+            is in `grid.attrs['trace']` and the stage keys in
+            `grid.attrs['stages']`
+        pois : GeoDataFrame
+            Points of interest
+        """
+        trace = self.trace or Trace(place_name or shapefile_path)
+        refresh = set(refresh)
+        keys = {}
+
+        # The boundary store is the cache of this stage; the boundary is
+        # keyed by its content, so a refreshed boundary invalidates the rest
+        study_area = self._boundary(trace, place_name, shapefile_path, refresh)
+        keys['boundary'] = _stage_key(
+            "boundary", geometry=hashlib.sha1(shapely.to_wkb(study_area.geometry.union_all())).hexdigest()
+        )
+
+        keys['pois'] = _stage_key(
+            "pois", boundary=keys['boundary'], tags=self.tags, merge_distance=self.merge_distance,
+            poi_points=self.poi_points
+        )
+        pois = self._cached(
+            trace, "pois", keys['pois'], lambda: self._pois(study_area, refresh="pois" in refresh), refresh
+        )
+        # Downstream stages depend on the POIs themselves, not on how they
+        # were asked for: a refresh that changed them invalidates the rest
+        pois_digest = _frame_digest(pois)
+
+        if self.min_grid_size is None:
+            keys['grid'] = _stage_key("grid", boundary=keys['boundary'], grid_size=self.grid_size)
+            grid = self._cached(trace, "grid", keys['grid'], lambda: self._grid(study_area), refresh)
+
+            if self.walk_graph is None and self.scoring == "raster":
+                # The convolution needs no pairwise distances
+                keys['score'] = _stage_key(
+                    "raster_score", grid=keys['grid'], pois=pois_digest, oversample=self.oversample,
+                    kernel=self.kernel.params()
+                )
+                raw_score = self._cached(
+                    trace, "score", keys['score'], lambda: self._raster_score(study_area, grid, pois), refresh,
+                    rows_in=len(pois)
+                )
+            elif self.walk_graph is None:
+                # Distances only depend on the kernel radius, so kernel sweeps
+                # under it reuse them
+                keys['distances'] = _stage_key(
+                    "distances", grid=keys['grid'], pois=pois_digest, radius=self.kernel.max_radius
+                )
+                distances = self._cached(
+                    trace, "distances", keys['distances'], lambda: self._distances(grid, pois), refresh,
+                    rows_in=len(pois)
+                )
+                keys['score'] = _stage_key(
+                    "score", distances=keys['distances'], kernel=self.kernel.params()
+                )
+                raw_score = self._cached(
+                    trace, "score", keys['score'], lambda: self._score(grid, pois, distances), refresh
+                )
+            else:
+                keys['score'] = _stage_key(
+                    "score", grid=keys['grid'], pois=pois_digest, walk_graph=_file_digest([self.walk_graph]),
+                    kernel=self.kernel.params()
+                )
+                raw_score = self._cached(
+                    trace, "score", keys['score'], lambda: self._network_score(grid, pois), refresh,
+                    rows_in=len(pois)
+                )
+        else:
+            # The adaptive grid is refined from the scores, it is one stage
+            keys['grid'] = keys['score'] = _stage_key(
+                "adaptive_grid", boundary=keys['boundary'], pois=pois_digest, grid_size=self.grid_size,
+                min_grid_size=self.min_grid_size, kernel=self.kernel.params()
+            )
+            grid = self._cached(
+                trace, "grid", keys['grid'],
+                lambda: build_adaptive_grid(study_area, pois, self.grid_size, self.min_grid_size,
+                                            kernel=self.kernel),
+                refresh, rows_in=len(pois)
+            )
+            raw_score = grid['raw_score'].to_numpy()
+
+        keys['normalize'] = _stage_key("normalize", score=keys['score'], n_pois=len(pois))
+        was = self._cached(
+            trace, "normalize", keys['normalize'], lambda: self._normalize(raw_score, len(pois)), refresh
+        )
+
+        grid = grid.copy()
+        grid['raw_score'] = raw_score
+        grid['WAS'] = was
+        grid.attrs['trace'] = trace.to_dict()
+        grid.attrs['stages'] = keys
+        return grid, pois
@@ -0,0 +1,390 @@
+# -*- coding: utf-8 -*-
+"""
+Spatially-aware POI store built on the Overpass responses in `cache/`
+
+osmnx caches every Overpass response under the hash of its exact query, so
+a query for a district misses even when a cached city-wide response already
+holds all of its POIs. This store keeps an index of what each response
+covers (an area in EPSG:4326 and a tag set) and answers
+`features_from_polygon` from any cached superset, only going to the network
+for the part of the polygon that nothing covers.
+
+Index file: `<cache_folder>/poi_index.json`. Responses fetched through the
+store are saved next to it as `pois_<hash>.json`, in the Overpass format,
+with the query they answer in `pois_<hash>.query.json`. The responses osmnx
+cached itself are indexed when a query asks for exactly what they answer:
+their file names are the hashes of the Overpass requests, so the store
+rebuilds the requests osmnx would send for the polygon and tags and looks
+them up. Their elements alone cannot tell which tags were asked for (a
+response holding only stations matches a query for every transport tag),
+so they are never indexed from their content.
+"""
+
+import glob
+import hashlib
+import json
+import os
+import re
+from collections import OrderedDict
+
+import geopandas as gpd
+import osmnx as ox
+import requests
+import shapely
+from osmnx._errors import InsufficientResponseError
+
+INDEX_NAME = "poi_index.json"
+
+# Remainders smaller than this share of the query area are slivers left by
+# floating point differences between boundaries, not real gaps
+SLIVER_RATIO = 1e-6
+
+_STORE_FILE = re.compile(r"^pois_[0-9a-f]{40}\.json$")
+
+
+def _normalize_tags(tags):
+    """Turn an osmnx tags dict into {key: True or sorted list of values}"""
+    normalized = {}
+    for key, value in tags.items():
+        if value is True:
+            normalized[key] = True
+        elif isinstance(value, str):
+            normalized[key] = [value]
+        else:
+            normalized[key] = sorted(set(value))
+    return normalized
+
+
+def _tags_cover(entry_tags, tags):
+    """Whether a response queried with `entry_tags` holds every feature of `tags`"""
+    for key, value in tags.items():
+        covered = entry_tags.get(key)
+        if covered is True:
+            continue
+        if covered is None or value is True or not set(value) <= set(covered):
+            return False
+    return True
+
+
+def _polygonal(geom):
+    """Keep the (Multi)Polygon part of a geometry, as osmnx queries require"""
+    if geom.geom_type in ("Polygon", "MultiPolygon"):
+        return geom
+    parts = [g for g in getattr(geom, "geoms", []) if g.geom_type in ("Polygon", "MultiPolygon")]
+    return shapely.union_all(parts) if parts else shapely.Polygon()
+
+
+class PoiStore:
+    """
+    Local store of Overpass POI responses, indexed by area and tag set
+
+    Parameters:
+    -----------
+    cache_folder : str
+        Folder holding the Overpass JSON responses (default: osmnx's cache)
+    fetch : callable, optional
+        fetch(polygon, tags) -> iterable of Overpass JSON responses, used
+        for the uncovered part of a query (default: osmnx's downloader)
+    """
+
+    def __init__(self, cache_folder=None, fetch=None):
+        self.cache_folder = str(cache_folder or ox.settings.cache_folder)
+        self.fetch = fetch or ox._overpass._download_overpass_features
+        self.index_path = os.path.join(self.cache_folder, INDEX_NAME)
+        self.entries = []
+        self._load_index()
+        self.scan()
+
+    @staticmethod
+    def _known(entries):
+        # Entries whose tags were inferred by earlier versions are not trusted
+        return [e for e in entries if not e.get("inferred")]
+
+    def _load_index(self):
+        if os.path.exists(self.index_path):
+            with open(self.index_path, encoding="utf-8") as f:
+                self.entries = self._known(json.load(f).get("entries", []))
+        self._geometries = [shapely.from_wkt(e["coverage"]) for e in self.entries]
+
+    def _save_index(self):
+        # Keep the entries other processes saved meanwhile, then replace the
+        # index atomically so a reader never sees a half-written file
+        if os.path.exists(self.index_path):
+            with open(self.index_path, encoding="utf-8") as f:
+                on_disk = json.load(f)
+            known = {tuple(e["files"]) for e in self.entries}
+            for entry in self._known(on_disk.get("entries", [])):
+                # Entries superseded by a refresh had their files removed
+                exists = all(os.path.exists(os.path.join(self.cache_folder, n)) for n in entry["files"])
+                if tuple(entry["files"]) not in known and exists:
+                    self.entries.append(entry)
+                    self._geometries.append(shapely.from_wkt(entry["coverage"]))
+
+        os.makedirs(self.cache_folder, exist_ok=True)
+        index = {"entries": self.entries}
+        tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def _add_entry(self, files, coverage, tags):
+        self.entries.append({
+            "files": files,
+            "coverage": coverage.wkt,
+            "bounds": list(coverage.bounds),
+            "tags": tags,
+        })
+        self._geometries.append(coverage)
+
+    def scan(self):
+        """
+        Index the responses saved by a store that are not indexed yet
+
+        Their query is read from the `.query.json` sidecar written with
+        them, e.g. after the index file was deleted; responses without one
+        are left out.
+        """
+        indexed = {name for entry in self.entries for name in entry["files"]}
+        changed = False
+        for path in sorted(glob.glob(os.path.join(self.cache_folder, "pois_*.json"))):
+            name = os.path.basename(path)
+            query_path = f"{os.path.splitext(path)[0]}.query.json"
+            if not _STORE_FILE.match(name) or name in indexed or not os.path.exists(query_path):
+                continue
+            with open(query_path, encoding="utf-8") as f:
+                query = json.load(f)
+            self._add_entry([name], shapely.from_wkt(query["polygon"]), query["tags"])
+            changed = True
+
+        if changed:
+            self._save_index()
+
+    def _osmnx_responses(self, polygon, tags):
+        """
+        Index the responses osmnx cached for exactly `polygon` and `tags`
+
+        Returns whether all the requests osmnx sends for this query (one per
+        piece of the subdivided polygon) were found in the cache folder.
+        """
+        url = ox.settings.overpass_url.rstrip("/") + "/interpreter"
+        files = []
+        for coord_str in ox._overpass._make_overpass_polygon_coord_strs(polygon):
+            data = OrderedDict(data=ox._overpass._create_overpass_features_query(coord_str, tags))
+            prepared_url = str(requests.Request("GET", url, params=data).prepare().url)
+            name = f"{hashlib.sha1(prepared_url.encode('utf-8')).hexdigest()}.json"
+            if not os.path.exists(os.path.join(self.cache_folder, name)):
+                return False
+            files.append(name)
+
+        if files not in [e["files"] for e in self.entries]:
+            self._add_entry(files, polygon, _normalize_tags(tags))
+            self._save_index()
+        return True
+
+    def _remainder(self, polygon, matching):
+        """Part of `polygon` the entries of `matching` leave out"""
+        if not matching:
+            return polygon
+        union = shapely.union_all([self._geometries[i] for i in matching])
+        return _polygonal(polygon.difference(union))
+
+    def _matching(self, polygon, tags):
+        """Positions of the entries intersecting `polygon` that cover `tags`"""
+        if not self._geometries:
+            return []
+        tree = shapely.STRtree(self._geometries)
+        hits = sorted(tree.query(polygon, predicate="intersects"))
+        return [i for i in hits if _tags_cover(self.entries[i]["tags"], tags)]
+
+    def covered(self, polygon, tags):
+        """
+        Part of `polygon` the store can answer offline for `tags`
+
+        Parameters:
+        -----------
+        polygon : shapely (Multi)Polygon
+            Query area in EPSG:4326
+        tags : dict
+            osmnx tags dict
+
+        Returns:
+        --------
+        covered : shapely geometry
+        """
+        tags = _normalize_tags(tags)
+        matching = self._matching(polygon, tags)
+        if not matching:
+            return shapely.Polygon()
+        union = shapely.union_all([self._geometries[i] for i in matching])
+        return polygon.intersection(union)
+
+    def add_response(self, response_jsons, polygon, tags):
+        """
+        Save Overpass responses for `polygon` / `tags` and index them
+
+        Parameters:
+        -----------
+        response_jsons : iterable of dict
+            Overpass JSON responses
+        polygon : shapely (Multi)Polygon
+            Area the responses were queried for, in EPSG:4326
+        tags : dict
+            osmnx tags dict the responses were queried with
+
+        Returns:
+        --------
+        elements : list of dict
+            All elements of the responses
+        """
+        tags = _normalize_tags(tags)
+        elements = [e for r in response_jsons for e in r.get("elements", [])]
+
+        key = hashlib.sha1((polygon.wkt + json.dumps(tags, sort_keys=True)).encode("utf-8")).hexdigest()
+        name = f"pois_{key}.json"
+        os.makedirs(self.cache_folder, exist_ok=True)
+        with open(os.path.join(self.cache_folder, name), "w", encoding="utf-8") as f:
+            json.dump({"elements": elements}, f)
+        # The query goes last: a response is only reused once it is known
+        with open(os.path.join(self.cache_folder, f"pois_{key}.query.json"), "w", encoding="utf-8") as f:
+            json.dump({"polygon": polygon.wkt, "tags": tags}, f)
+
+        self._add_entry([name], polygon, tags)
+        self._save_index()
+        return elements
+
+    def _drop_superseded(self, polygon, tags):
+        """Remove the responses within `polygon` for tags covered by `tags`"""
+        superseded = [
+            i for i in self._matching(polygon, {})
+            if _tags_cover(tags, self.entries[i]["tags"]) and self._geometries[i].within(polygon)
+        ]
+        for i in sorted(superseded, reverse=True):
+            for name in self.entries[i]["files"]:
+                for path in (name, f"{os.path.splitext(name)[0]}.query.json"):
+                    if os.path.exists(os.path.join(self.cache_folder, path)):
+                        os.remove(os.path.join(self.cache_folder, path))
+            del self.entries[i]
+            del self._geometries[i]
+
+    def _load_elements(self, entry_ids, bounds=None):
+        """
+        Elements of the given entries, deduplicated by OSM type and id
+
+        With `bounds` (min_lon, min_lat, max_lon, max_lat), only the nodes
+        inside them, the ways with a node inside them and the relations are
+        kept, with the members osmnx needs to build their geometry, so a
+        small query on a large response only converts its own features.
+        """
+        elements = {}
+        for i in entry_ids:
+            for name in self.entries[i]["files"]:
+                with open(os.path.join(self.cache_folder, name), encoding="utf-8") as f:
+                    for element in json.load(f)["elements"]:
+                        elements[(element["type"], element["id"])] = element
+        if bounds is None:
+            return list(elements.values())
+
+        min_lon, min_lat, max_lon, max_lat = bounds
+        keep = {
+            key for key, e in elements.items()
+            if key[0] == "node" and min_lon <= e["lon"] <= max_lon and min_lat <= e["lat"] <= max_lat
+        }
+        ways = {
+            key for key, e in elements.items()
+            if key[0] == "way" and any(("node", n) in keep for n in e.get("nodes", ()))
+        }
+        relations = {key for key in elements if key[0] == "relation"}
+        for key in relations:
+            ways.update(
+                ("way", m["ref"]) for m in elements[key].get("members", []) if ("way", m["ref"]) in elements
+            )
+            keep.update(
+                ("node", m["ref"]) for m in elements[key].get("members", []) if ("node", m["ref"]) in elements
+            )
+        for key in ways:
+            keep.update(("node", n) for n in elements[key].get("nodes", []) if ("node", n) in elements)
+        keep |= ways | relations
+        return [e for key, e in elements.items() if key in keep]
+
+    def features_from_polygon(self, polygon, tags, refresh=False):
+        """
+        Drop-in replacement for `ox.features_from_polygon`
+
+        Answers from cached responses covering the polygon and the tags,
+        and only queries the network for the uncovered remainder.
+
+        Parameters:
+        -----------
+        polygon : shapely (Multi)Polygon
+            Query area in EPSG:4326
+        tags : dict
+            osmnx tags dict
+        refresh : bool
+            Ignore the cached responses and osmnx's own cache, and fetch the
+            whole polygon again (e.g. after OSM updates). The new response
+            replaces the older ones lying within the polygon.
+
+        Returns:
+        --------
+        pois : GeoDataFrame
+            Features, multi-indexed by element type and OSM id. Empty when
+            nothing matches.
+        """
+        normalized = _normalize_tags(tags)
+        matching = [] if refresh else self._matching(polygon, normalized)
+        remainder = self._remainder(polygon, matching)
+        if not refresh and remainder.area > SLIVER_RATIO * polygon.area and self._osmnx_responses(polygon, tags):
+            # The very same query went through osmnx before
+            matching = self._matching(polygon, normalized)
+            remainder = self._remainder(polygon, matching)
+        elements = {(e["type"], e["id"]): e for e in self._load_elements(matching, polygon.bounds)}
+
+        # Fetch whatever no cached response covers
+        if not remainder.is_empty and remainder.area > SLIVER_RATIO * polygon.area:
+            print(f"  Fetching POIs for {100 * remainder.area / polygon.area:.0f}% of the area not in cache")
+            use_cache = ox.settings.use_cache
+            ox.settings.use_cache = use_cache and not refresh
+            try:
+                responses = list(self.fetch(remainder, tags))
+            finally:
+                ox.settings.use_cache = use_cache
+            if refresh:
+                # Only once the new response is in hand
+                self._drop_superseded(remainder, normalized)
+            fetched = self.add_response(responses, remainder, tags)
+            for element in fetched:
+                elements[(element["type"], element["id"])] = element
+
+        # Same conversion and spatial/tag filtering as osmnx
+        try:
+            return ox.features._create_gdf([{"elements": list(elements.values())}], polygon, tags)
+        except InsufficientResponseError:
+            return gpd.GeoDataFrame(geometry=[], crs=ox.settings.default_crs)
+
+
+_default_store = None
+
+
+def features_from_polygon(polygon, tags, refresh=False):
+    """
+    `PoiStore.features_from_polygon` on a store over osmnx's cache folder
+
+    The store is created on first use.
+    """
+    global _default_store
+    if _default_store is None:
+        _default_store = PoiStore()
+    return _default_store.features_from_polygon(polygon, tags, refresh=refresh)
+
+
+def configure_default_store(**kwargs):
+    """
+    Replace the store used by `features_from_polygon`
+
+    Takes the `PoiStore` arguments, e.g. `fetch=OverpassFetcher(...).fetch`
+    to download the missing POIs concurrently or from another server.
+    Only affects the current process.
+    """
+    global _default_store
+    _default_store = PoiStore(**kwargs)
+    return _default_store
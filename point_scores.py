@@ -0,0 +1,412 @@
+# -*- coding: utf-8 -*-
+"""
+Batch scoring of arbitrary point sets
+
+Scores addresses, listings or any other locations with the walkability
+rule of the grids (400 / 800 / 1200 m by default), without building a
+grid. The POIs of each city are indexed once. The points are then scored
+in chunks of coordinate arrays across a process pool, and the chunks are
+streamed back in input order, so files of millions of points never sit
+in memory at once.
+
+Scores are on the scale of the city's grid: `raw_score` uses the same
+points, and `WAS` is rescaled with the grid's raw score range (clipped to
+0-100). A point goes to the city whose grid has a cell holding it; points
+outside every grid get no score.
+
+    scorers = load_scorers("results/")
+    scores = score_points(lon, lat, scorers)
+
+Usage:
+    python point_scores.py listings.csv scores.parquet --results results/ --lon-column lng
+"""
+
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from pyproj import CRS, Transformer
+from scipy.spatial import cKDTree
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # only needed for Parquet files
+    pa = pq = None
+
+from results import read_result, result_files, result_names
+from scoring import POINTS, THRESHOLDS, as_kernel, cell_poi_pairs, point_pairs
+
+# Points scored per task
+CHUNK_SIZE = 200000
+
+
+class PointScorer:
+    """
+    POIs of a city, indexed to score any set of points
+
+    Parameters:
+    -----------
+    pois : GeoDataFrame
+        POIs in a projected CRS; with their tag columns for kernels
+        weighting POIs by tag
+    thresholds : sequence of float
+        Increasing distance thresholds in meters
+    points : sequence of int
+        Points awarded for each threshold band
+    kernel : Kernel, optional
+        Scoring kernel replacing `thresholds` and `points`
+    score_range : (float, float), optional
+        Smallest and largest raw score of the city's grid, to rescale the
+        scores to WAS (default: no WAS)
+    bounds : (min_lon, min_lat, max_lon, max_lat), optional
+        Area the scorer covers (default: the grid, or the POIs padded by
+        the kernel radius)
+    name : str, optional
+        City name
+    grid : ScoredGrid, optional
+        Grid of the city, in the CRS of the POIs; only the points in one of
+        its cells are covered
+    """
+
+    def __init__(self, pois, thresholds=THRESHOLDS, points=POINTS, kernel=None, score_range=None, bounds=None,
+                 name=None, grid=None):
+        if pois.crs is None or CRS.from_user_input(pois.crs).is_geographic:
+            raise ValueError("POIs must be in a projected CRS, in meters")
+        if grid is not None and grid.crs != CRS.from_user_input(pois.crs):
+            raise ValueError("The grid must be in the CRS of the POIs")
+        self.kernel = as_kernel(kernel, thresholds, points)
+        self.name = name
+        self.crs = pois.crs
+        self.score_range = score_range
+        self.grid = grid
+        self._geometry = np.asarray(pois.geometry, dtype=object)
+        self._weights = self.kernel.poi_weights(pois)
+        self._points_only = bool((shapely.get_type_id(self._geometry) == 0).all())
+        self._xy = shapely.get_coordinates(self._geometry) if self._points_only else None
+
+        if bounds is None and grid is not None and len(grid):
+            bounds = Transformer.from_crs(self.crs, "EPSG:4326", always_xy=True).transform_bounds(*grid.bounds)
+        elif bounds is None:
+            minx, miny, maxx, maxy = shapely.total_bounds(self._geometry)
+            pad = self.kernel.max_radius
+            bounds = Transformer.from_crs(self.crs, "EPSG:4326", always_xy=True).transform_bounds(
+                minx - pad, miny - pad, maxx + pad, maxy + pad
+            )
+        self.bounds = tuple(float(b) for b in bounds)
+        self._tree = None
+        self._transformer = None
+
+    def __getstate__(self):
+        # Indexes are rebuilt in each worker rather than pickled
+        return {**self.__dict__, '_tree': None, '_transformer': None}
+
+    def _project(self, lon, lat):
+        if self._transformer is None:
+            self._transformer = Transformer.from_crs("EPSG:4326", self.crs, always_xy=True)
+        return self._transformer.transform(lon, lat)
+
+    def covers(self, lon, lat):
+        """Mask of the points inside `bounds`, and in a cell of `grid` when there is one"""
+        min_lon, min_lat, max_lon, max_lat = self.bounds
+        inside = (lon >= min_lon) & (lon <= max_lon) & (lat >= min_lat) & (lat <= max_lat)
+        if self.grid is not None:
+            candidates = np.flatnonzero(inside)
+            inside[candidates] = self.grid.locate(*self._project(lon[candidates], lat[candidates])) >= 0
+        return inside
+
+    def raw_scores(self, x, y):
+        """
+        Raw scores of points given in the CRS of the POIs
+
+        Parameters:
+        -----------
+        x, y : array-like
+            Projected coordinates
+
+        Returns:
+        --------
+        raw_score : ndarray
+            Same as the `raw_score` of grid cells at these points
+        """
+        xy = np.column_stack([np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)])
+        if self._tree is None and len(self._geometry):
+            self._tree = cKDTree(self._xy) if self._points_only else shapely.STRtree(self._geometry)
+        if self._points_only:
+            point_idx, poi_idx, dists = point_pairs(xy, self._xy, self.kernel.max_radius, tree=self._tree)
+        else:
+            point_idx, poi_idx, dists = cell_poi_pairs(
+                shapely.points(xy), self._geometry, self.kernel.max_radius, tree=self._tree
+            )
+
+        weights = self.kernel(dists)
+        if self._weights is not None:
+            weights = weights * self._weights[poi_idx]
+        return np.bincount(point_idx, weights=weights, minlength=len(xy)).astype(self.kernel.dtype)
+
+    def scores(self, lon, lat):
+        """
+        Raw scores and WAS of points given in longitude and latitude
+
+        Returns:
+        --------
+        raw_score, was : ndarray
+            WAS is NaN without `score_range`
+        """
+        raw_score = self.raw_scores(*self._project(lon, lat))
+        if self.score_range is None:
+            return raw_score, np.full(len(raw_score), np.nan)
+        low, high = self.score_range
+        if high > low:
+            was = np.clip(100 * (raw_score - low) / (high - low), 0, 100)
+        else:
+            was = np.zeros(len(raw_score))
+        return raw_score, was
+
+
+def load_scorers(folder, names=None, thresholds=THRESHOLDS, points=POINTS, kernel=None):
+    """
+    Scorers of the cities of a results folder
+
+    Parameters:
+    -----------
+    folder : str
+        Results folder of `batch.py` or `results.save_results`; the POIs
+        of `save_results` are representative points, so scores near large
+        stations can differ slightly from the grid's
+    names : sequence of str, optional
+        Cities to load (default: all)
+    thresholds, points, kernel
+        Scoring rule; must be the one the grids were scored with for WAS
+        to be on their scale
+
+    Returns:
+    --------
+    scorers : dict
+        {city name: PointScorer}
+    """
+    stems = result_names(folder)
+    scorers = {}
+    for path in result_files(folder):
+        name, grid, _, pois_path = read_result(path, stems)
+        if names is not None and name not in names:
+            continue
+        if pois_path is None:
+            print(f"  ✗ No POIs saved for {name}, skipped")
+            continue
+        pois = gpd.read_parquet(pois_path) if pois_path.endswith(".parquet") else gpd.read_file(pois_path)
+        score_range = (float(grid.raw_score.min()), float(grid.raw_score.max())) if len(grid) else None
+        scorers[name] = PointScorer(
+            pois.to_crs(grid.crs), thresholds, points, kernel, score_range, name=name, grid=grid
+        )
+    missing = set(names or ()) - set(scorers)
+    if missing:
+        raise KeyError(f"No results for: {', '.join(sorted(missing))}")
+    return scorers
+
+
+def _score_chunk(scorers, lon, lat):
+    """Scores of a chunk; each point goes to the first city covering it (with a grid: whose cells hold it)"""
+    raw_score = np.full(len(lon), np.nan)
+    was = np.full(len(lon), np.nan)
+    city = np.full(len(lon), None, dtype=object)
+    todo = np.ones(len(lon), dtype=bool)
+    for name, scorer in scorers.items():
+        inside = np.flatnonzero(todo & scorer.covers(lon, lat))
+        if len(inside) == 0:
+            continue
+        raw_score[inside], was[inside] = scorer.scores(lon[inside], lat[inside])
+        city[inside] = name
+        todo[inside] = False
+    return pd.DataFrame({'city': city, 'raw_score': raw_score, 'WAS': was})
+
+
+_worker_scorers = None
+
+
+def _init_worker(scorers):
+    global _worker_scorers
+    _worker_scorers = scorers
+
+
+def _score_worker(lon, lat):
+    return _score_chunk(_worker_scorers, lon, lat)
+
+
+def iter_point_scores(chunks, scorers, workers=None):
+    """
+    Score chunks of points in parallel, in order
+
+    Parameters:
+    -----------
+    chunks : iterable of (lon, lat)
+        Arrays of coordinates in EPSG:4326
+    scorers : dict
+        {city name: PointScorer}, e.g. from `load_scorers`
+    workers : int
+        Number of worker processes (default: number of CPU cores; 1 scores
+        in this process)
+
+    Yields:
+    -------
+    scores : DataFrame
+        `city`, `raw_score` and `WAS` of the points of each chunk, in
+        input order
+    """
+    workers = workers or os.cpu_count() or 1
+    chunks = ((np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64)) for lon, lat in chunks)
+    if workers == 1:
+        for lon, lat in chunks:
+            yield _score_chunk(scorers, lon, lat)
+        return
+
+    # A few chunks in flight per worker: enough to keep them busy, while
+    # the input is read lazily and results go out as soon as they are next
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(scorers,)) as executor:
+        pending = []
+        for lon, lat in chunks:
+            pending.append(executor.submit(_score_worker, lon, lat))
+            if len(pending) >= 2 * workers:
+                yield pending.pop(0).result()
+        for future in pending:
+            yield future.result()
+
+
+def score_points(lon, lat, scorers, chunk_size=CHUNK_SIZE, workers=None):
+    """
+    Score an array of points
+
+    Parameters:
+    -----------
+    lon, lat : array-like
+        Coordinates in EPSG:4326
+    scorers : dict or PointScorer
+        {city name: PointScorer}, or the scorer of a single city
+    chunk_size : int
+        Points per task (default: 200000)
+    workers : int
+        Number of worker processes (default: number of CPU cores)
+
+    Returns:
+    --------
+    scores : DataFrame
+        `city`, `raw_score` and `WAS` of every point, in input order
+    """
+    if isinstance(scorers, PointScorer):
+        scorers = {scorers.name: scorers}
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.asarray(lat, dtype=np.float64)
+    chunks = [(lon[i:i + chunk_size], lat[i:i + chunk_size]) for i in range(0, len(lon), chunk_size)]
+    workers = min(workers or os.cpu_count() or 1, max(len(chunks), 1))
+    scores = list(iter_point_scores(chunks, scorers, workers))
+    if not scores:
+        return _score_chunk(scorers, lon, lat)
+    return pd.concat(scores, ignore_index=True)
+
+
+def read_points(path, lon_column="lon", lat_column="lat", chunk_size=CHUNK_SIZE):
+    """
+    Read a CSV or Parquet file of points chunk by chunk
+
+    Yields:
+    -------
+    chunk : DataFrame
+        Up to `chunk_size` rows with all the columns of the file
+    """
+    if path.lower().endswith(".parquet"):
+        if pq is None:
+            raise ImportError("Reading Parquet files requires pyarrow (pip install pyarrow)")
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(path, chunksize=chunk_size)
+
+
+def score_file(input_path, output_path, scorers, lon_column="lon", lat_column="lat", chunk_size=CHUNK_SIZE,
+               workers=None):
+    """
+    Score the points of a CSV or Parquet file, streaming the results out
+
+    The output has every input column followed by `city`, `raw_score` and
+    `WAS`, in the format of its extension (.csv or .parquet).
+
+    Returns:
+    --------
+    n_points : int
+        Number of points scored
+    """
+    if output_path.lower().endswith(".parquet") and pq is None:
+        raise ImportError("Writing Parquet files requires pyarrow (pip install pyarrow)")
+
+    chunks = []
+
+    def coordinates():
+        # Keep the input rows until their scores come back
+        for chunk in read_points(input_path, lon_column, lat_column, chunk_size):
+            chunks.append(chunk)
+            yield chunk[lon_column].to_numpy(), chunk[lat_column].to_numpy()
+
+    tmp_path = f"{output_path}.{os.getpid()}.tmp"
+    writer, n_points = None, 0
+    try:
+        for scores in iter_point_scores(coordinates(), scorers, workers):
+            chunk = chunks.pop(0).reset_index(drop=True)
+            rows = pd.concat([chunk.drop(columns=["city", "raw_score", "WAS"], errors="ignore"), scores], axis=1)
+            if output_path.lower().endswith(".parquet"):
+                table = pa.Table.from_pandas(rows, preserve_index=False)
+                if writer is None:
+                    # Score types are fixed, even when no point of the first chunk is in a city
+                    schema = table.schema
+                    for field in (pa.field('city', pa.string()), pa.field('raw_score', pa.float64()),
+                                  pa.field('WAS', pa.float64())):
+                        schema = schema.set(schema.get_field_index(field.name), field)
+                    writer = pq.ParquetWriter(tmp_path, schema)
+                writer.write_table(table.cast(writer.schema))
+            else:
+                rows.to_csv(tmp_path, mode="w" if n_points == 0 else "a", header=n_points == 0, index=False)
+            n_points += len(rows)
+    except BaseException:
+        if writer is not None:
+            writer.close()
+            writer = None
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    finally:
+        if writer is not None:
+            writer.close()
+    if n_points:
+        os.replace(tmp_path, output_path)
+    return n_points
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Walkability scores of arbitrary points")
+    parser.add_argument("input", help="CSV or Parquet file of points")
+    parser.add_argument("output", help="CSV or Parquet file of scores")
+    parser.add_argument("--results", required=True, help="results folder of batch.py or results.save_results")
+    parser.add_argument("--city", nargs="+", help="cities whose POIs to use (default: all)")
+    parser.add_argument("--lon-column", default="lon")
+    parser.add_argument("--lat-column", default="lat")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="points per task")
+    parser.add_argument("--workers", type=int, help="worker processes (default: CPU cores)")
+    args = parser.parse_args(argv)
+
+    scorers = load_scorers(args.results, args.city)
+    print(f"Scoring with the POIs of {len(scorers)} cities")
+    started = time.perf_counter()
+    n_points = score_file(
+        args.input, args.output, scorers, args.lon_column, args.lat_column, args.chunk_size, args.workers
+    )
+    seconds = time.perf_counter() - started
+    print(f"{n_points} points scored in {seconds:.1f} s ({n_points / max(seconds, 1e-9) * 60:,.0f} points/min)")
+    print(f"Scores written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,566 @@
+# -*- coding: utf-8 -*-
+"""
+Map rendering helpers for the walkability grids
+
+The grid is drawn as a single GeoJSON FeatureCollection whose cells carry
+their colour and tooltip as properties, instead of one `folium.GeoJson`
+layer per cell. For metro-scale grids, it can instead be exported as an
+XYZ tile pyramid that the map page loads on demand.
+
+Static figures draw the grid as one image array (`imshow`) in projected
+coordinates instead of one patch per cell, and the panels of the
+multi-city comparison are rendered in parallel then composited.
+"""
+
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import folium
+import matplotlib.image as mpimg
+import numpy as np
+import shapely
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from pyproj import Transformer
+
+from basemap_cache import DEFAULT_PATH, POSITRON, TILE_PIXELS, BasemapCache, tile_bounds, tiles_for_bounds  # noqa: F401
+from results import ScoredGrid
+
+
+def score_colors(scores, colormap):
+    """
+    Colour of every score, computed once per distinct value
+
+    Parameters:
+    -----------
+    scores : array-like
+        Scores to colour
+    colormap : branca colormap
+        Colormap mapping a score to a hex colour
+
+    Returns:
+    --------
+    colors : ndarray of str
+        Hex colour of each score
+    """
+    scores = np.asarray(scores, dtype=float)
+    values, inverse = np.unique(scores, return_inverse=True)
+    palette = np.array([colormap(v) for v in values], dtype=object)
+    return palette[inverse]
+
+
+def grid_layer(grid, score_column, colormap, name, show=True, tooltip="Score: {:.1f} / 100"):
+    """
+    Build a single Folium layer holding every grid cell
+
+    Parameters:
+    -----------
+    grid : GeoDataFrame
+        Scored grid, in EPSG:4326
+    score_column : str
+        Column holding the score to display
+    colormap : branca colormap
+        Colormap used for the cell fill colour
+    name : str
+        Layer name shown in the layer control
+    show : bool
+        Whether the layer is displayed when the map opens
+    tooltip : str
+        Format of the tooltip text, filled with the score
+
+    Returns:
+    --------
+    layer : folium.GeoJson
+    """
+    # Precompute colour and tooltip as properties of each cell
+    cells = grid[[score_column, 'geometry']].copy()
+    cells['fill_color'] = score_colors(cells[score_column], colormap)
+    cells['tooltip'] = [tooltip.format(score) for score in cells[score_column]]
+
+    return folium.GeoJson(
+        cells,
+        name=name,
+        show=show,
+        style_function=lambda feature: {
+            'fillColor': feature['properties']['fill_color'],  # Colour according to the score
+            'color': 'white',                                  # White border around each cell
+            'weight': 0.5,
+            'fillOpacity': 0.6
+        },
+        tooltip=folium.GeoJsonTooltip(fields=['tooltip'], labels=False),
+    )
+
+
+def _hex_to_rgba(color, alpha):
+    color = color.lstrip('#')[:6]
+    return [int(color[i:i + 2], 16) for i in (0, 2, 4)] + [int(round(alpha * 255))]
+
+
+def _write_tile(image, output_dir, z, x, y):
+    folder = os.path.join(output_dir, str(z), str(x))
+    os.makedirs(folder, exist_ok=True)
+    mpimg.imsave(os.path.join(folder, f"{y}.png"), image)
+
+
+def _lattice_lookup(cells, cell_size, crs):
+    """
+    Function giving the cell under points, from lattice arithmetic
+
+    The grid cells are squares laid out on the lattice of their size in
+    the CRS they were built in (see `ScoredGrid.lattice`), so the cell
+    holding a point is found with one floor division and one binary search
+    per cell size (`ScoredGrid.locate`). Returns None when the cells are not
+    on such a lattice (e.g. arbitrary polygons, or a grid reprojected after
+    it was built).
+    """
+    cell_size = np.broadcast_to(np.asarray(cell_size, dtype=np.float64), (len(cells),))
+    clipped = np.flatnonzero(shapely.area(cells) < cell_size ** 2 * (1 - 1e-6))
+    whole = np.setdiff1d(np.arange(len(cells)), clipped)
+    if len(whole) == 0:
+        return None
+
+    # Scores are not needed, only the layout of the cells
+    centroids = shapely.get_coordinates(shapely.centroid(cells))
+    scored = ScoredGrid(centroids[:, 0], centroids[:, 1], np.zeros(len(cells), dtype=np.int64),
+                        np.zeros(len(cells)), cell_size, crs, clipped, cells[clipped])
+    minx, miny = scored.bounds[:2]
+    offset = (scored.x[whole] - minx) / cell_size[whole] - 0.5
+    if not np.allclose(offset, np.rint(offset), atol=1e-6):
+        return None
+    return scored.locate
+
+
+def _grid_tiles(cells, colors, output_dir, min_zoom, max_zoom, locate=None, to_grid=None):
+    """
+    Rasterize the grid cells into XYZ tiles, one PNG per non-empty tile
+
+    `cells` are in EPSG:3857. With `locate` (cell under points in the grid's
+    own CRS) and `to_grid` (transformer from EPSG:3857 to it), the pixel
+    centres are located on the grid lattice; otherwise they are queried
+    against the cells one by one.
+    """
+    tree = shapely.STRtree(cells)
+    bounds = shapely.total_bounds(cells)
+    offsets = (np.arange(TILE_PIXELS) + 0.5) / TILE_PIXELS
+    n_tiles = 0
+
+    for z in range(min_zoom, max_zoom + 1):
+        for x, y in tiles_for_bounds(bounds, z):
+            minx, miny, maxx, maxy = tile_bounds(z, x, y)
+            if len(tree.query(shapely.box(minx, miny, maxx, maxy))) == 0:
+                continue
+
+            # Cell under the centre of every pixel (rows from the top)
+            px = minx + offsets * (maxx - minx)
+            py = maxy - offsets * (maxy - miny)
+            xx, yy = np.meshgrid(px, py)
+            if locate is not None:
+                cell = locate(*to_grid.transform(xx.ravel(), yy.ravel()))
+                pixel_idx = np.flatnonzero(cell >= 0)
+                cell_idx = cell[pixel_idx]
+            else:
+                pixel_idx, cell_idx = tree.query(shapely.points(xx.ravel(), yy.ravel()), predicate="intersects")
+            if len(pixel_idx) == 0:
+                continue
+
+            image = np.zeros((TILE_PIXELS * TILE_PIXELS, 4), dtype=np.uint8)
+            image[pixel_idx] = colors[cell_idx]
+            _write_tile(image.reshape(TILE_PIXELS, TILE_PIXELS, 4), output_dir, z, x, y)
+            n_tiles += 1
+
+    return n_tiles
+
+
+def _poi_tiles(points, colors, output_dir, min_zoom, max_zoom, radius=4):
+    """Draw the POIs as dots into XYZ tiles, one PNG per non-empty tile"""
+    xs, ys = shapely.get_x(points), shapely.get_y(points)
+    bounds = (xs.min(), ys.min(), xs.max(), ys.max())
+    dy, dx = np.mgrid[-radius:radius + 1, -radius:radius + 1]
+    disc = dx ** 2 + dy ** 2 <= radius ** 2
+    n_tiles = 0
+
+    for z in range(min_zoom, max_zoom + 1):
+        for x, y in tiles_for_bounds(bounds, z):
+            minx, miny, maxx, maxy = tile_bounds(z, x, y)
+            pixel = (maxx - minx) / TILE_PIXELS
+
+            # POIs whose dot reaches into the tile
+            margin = radius * pixel
+            inside = np.flatnonzero(
+                (xs >= minx - margin) & (xs <= maxx + margin) & (ys >= miny - margin) & (ys <= maxy + margin)
+            )
+            if len(inside) == 0:
+                continue
+
+            # Pad the image by the dot radius, draw, then crop to the tile
+            size = TILE_PIXELS + 2 * radius
+            image = np.zeros((size, size, 4), dtype=np.uint8)
+            cols = np.floor((xs[inside] - minx) / pixel).astype(int) + radius
+            rows = np.floor((maxy - ys[inside]) / pixel).astype(int) + radius
+            for col, row, color in zip(cols, rows, colors[inside]):
+                # Dots only partly inside the padded image are left out
+                if col < radius or row < radius or col >= size - radius or row >= size - radius:
+                    continue
+                window = image[row - radius:row + radius + 1, col - radius:col + radius + 1]
+                window[disc] = color
+            _write_tile(image[radius:-radius, radius:-radius], output_dir, z, x, y)
+            n_tiles += 1
+
+    return n_tiles
+
+
+def export_tile_pyramid(grid, score_column, colormap, output_dir, pois=None, poi_colors=None,
+                        min_zoom=10, max_zoom=16, opacity=0.6):
+    """
+    Write the scored grid (and the POIs) as XYZ PNG tile pyramids
+
+    Layout: `<output_dir>/grid/{z}/{x}/{y}.png` and
+    `<output_dir>/pois/{z}/{x}/{y}.png`. Tiles without any cell or POI
+    are not written. The browser then only loads the tiles of the current
+    view and zoom, whatever the size of the study area.
+
+    Parameters:
+    -----------
+    grid : GeoDataFrame
+        Scored grid, in any CRS; pass it in the CRS it was built in (e.g.
+        UTM, not reprojected to EPSG:4326) for its cells to be found by
+        lattice arithmetic
+    score_column : str
+        Column holding the score to display
+    colormap : branca colormap
+        Colormap used for the cell fill colour
+    output_dir : str
+        Root folder of the pyramids
+    pois : GeoDataFrame, optional
+        POIs to draw as dots in their own pyramid
+    poi_colors : array-like of str, optional
+        Hex colour of each POI (default: dark blue)
+    min_zoom, max_zoom : int
+        Zoom levels to generate (default: 10 to 16)
+    opacity : float
+        Opacity of the grid cells (default: 0.6)
+
+    Returns:
+    --------
+    counts : dict
+        Number of tiles written per pyramid
+    """
+    colors = np.array(
+        [_hex_to_rgba(c, opacity) for c in score_colors(grid[score_column], colormap)], dtype=np.uint8
+    ).reshape(-1, 4)
+
+    # The cells are squares in the CRS of the grid, not once reprojected
+    native = np.asarray(grid.geometry, dtype=object)
+    if 'cell_size' in grid.columns:
+        cell_size = grid['cell_size'].to_numpy(dtype=np.float64)
+    else:
+        bounds = shapely.bounds(native)
+        cell_size = float(np.max(bounds[:, 2:] - bounds[:, :2])) if len(native) else 0.0
+    locate = _lattice_lookup(native, cell_size, grid.crs) if len(native) else None
+    to_grid = Transformer.from_crs("EPSG:3857", grid.crs, always_xy=True) if locate is not None else None
+
+    cells = np.asarray(grid.to_crs(epsg=3857).geometry, dtype=object)
+    counts = {
+        'grid': _grid_tiles(cells, colors, os.path.join(output_dir, 'grid'), min_zoom, max_zoom, locate, to_grid)
+    }
+
+    if pois is not None and len(pois) > 0:
+        points = np.asarray(pois.to_crs(epsg=3857).geometry.representative_point(), dtype=object)
+        if poi_colors is None:
+            poi_colors = ['#2c3e50'] * len(points)
+        colors = np.array([_hex_to_rgba(c, 0.9) for c in poi_colors], dtype=np.uint8)
+        counts['pois'] = _poi_tiles(points, colors, os.path.join(output_dir, 'pois'), min_zoom, max_zoom)
+
+    with open(os.path.join(output_dir, 'metadata.json'), 'w', encoding='utf-8') as f:
+        json.dump({'min_zoom': min_zoom, 'max_zoom': max_zoom, 'tiles': counts}, f)
+
+    return counts
+
+
+def tile_layer(url, name, max_zoom=16, show=True):
+    """
+    Folium overlay reading an XYZ tile pyramid
+
+    Parameters:
+    -----------
+    url : str
+        Tile URL template, e.g. "tiles/grid/{z}/{x}/{y}.png" (relative to
+        the saved HTML file)
+    name : str
+        Layer name shown in the layer control
+    max_zoom : int
+        Highest zoom level of the pyramid; deeper zooms reuse its tiles
+
+    Returns:
+    --------
+    layer : folium.TileLayer
+    """
+    return folium.TileLayer(
+        tiles=url,
+        attr='Walkability',
+        name=name,
+        overlay=True,
+        show=show,
+        max_native_zoom=max_zoom,
+        max_zoom=19,
+    )
+
+
+def grid_image(grid, column="WAS", oversample=1):
+    """
+    Scores of a grid as an image array, in the grid's projected CRS
+
+    Each pixel takes the score of the cell under its centre. Pixels
+    outside every cell, or outside the clipped shape of a boundary cell,
+    are NaN. Adaptive grids are drawn at their smallest cell size.
+
+    Parameters:
+    -----------
+    grid : GeoDataFrame or ScoredGrid
+        Scored square grid
+    column : str
+        Score to draw, "WAS" or "raw_score" (default: "WAS")
+    oversample : int
+        Pixels per side of the smallest cells; more pixels follow the
+        boundary more closely (default: 1)
+
+    Returns:
+    --------
+    image : ndarray
+        (rows, cols) float array, first row at the bottom
+    extent : tuple
+        (minx, maxx, miny, maxy) of the image, for `imshow(..., origin="lower")`
+    """
+    scored = grid if isinstance(grid, ScoredGrid) else ScoredGrid.from_geodataframe(grid)
+    values = {'WAS': scored.was, 'raw_score': scored.raw_score}[column].astype(np.float64)
+    if len(scored) == 0:
+        return np.full((1, 1), np.nan), (0.0, 1.0, 0.0, 1.0)
+
+    size = scored.cell_size
+    pixel = size.min() / oversample
+    clipped = scored.clipped_index
+    minx, miny, maxx, maxy = scored.bounds
+    n_cols = max(int(np.ceil((maxx - minx) / pixel - 1e-6)), 1)
+    n_rows = max(int(np.ceil((maxy - miny) / pixel - 1e-6)), 1)
+
+    # First pixel and pixels per side of every cell's square
+    side = np.rint(size / pixel).astype(np.int64)
+    col, row = scored.lattice()
+    col0, row0 = col * side, row * side
+
+    image = np.full((n_rows, n_cols), np.nan)
+    for k in np.unique(side):
+        cells = np.flatnonzero(side == k)
+        dy, dx = np.divmod(np.arange(k * k), k)
+        rows = np.clip(row0[cells, None] + dy[None, :], 0, n_rows - 1)
+        cols = np.clip(col0[cells, None] + dx[None, :], 0, n_cols - 1)
+        image[rows, cols] = values[cells, None]
+
+    # Blank the pixels of clipped squares falling outside the cell
+    if len(clipped):
+        k = side[clipped]
+        counts = k * k
+        owner = np.repeat(np.arange(len(clipped)), counts)
+        offset = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        dy, dx = np.divmod(offset, np.repeat(k, counts))
+        rows = np.clip(row0[clipped][owner] + dy, 0, n_rows - 1)
+        cols = np.clip(col0[clipped][owner] + dx, 0, n_cols - 1)
+        inside = shapely.contains_xy(
+            scored.clipped_geometry[owner], minx + (cols + 0.5) * pixel, miny + (rows + 0.5) * pixel
+        )
+        image[rows[~inside], cols[~inside]] = np.nan
+
+    return image, (minx, minx + n_cols * pixel, miny, miny + n_rows * pixel)
+
+
+def plot_grid_image(ax, grid, column="WAS", cmap="RdYlGn", vmin=0, vmax=100, alpha=0.7, oversample=1):
+    """
+    Draw a scored grid on a matplotlib axes as a single image
+
+    Drawing time depends on the image size, not on the number of cells.
+
+    Parameters:
+    -----------
+    ax : matplotlib Axes
+        Axes in the grid's projected CRS
+    grid : GeoDataFrame or ScoredGrid
+        Scored square grid
+    column, oversample
+        See `grid_image`
+    cmap, vmin, vmax, alpha
+        Passed to `imshow`
+
+    Returns:
+    --------
+    image : matplotlib AxesImage
+        For a colorbar
+    """
+    image, extent = grid_image(grid, column, oversample)
+    return ax.imshow(
+        np.ma.masked_invalid(image), extent=extent, origin="lower", interpolation="nearest",
+        cmap=cmap, vmin=vmin, vmax=vmax, alpha=alpha,
+    )
+
+
+def render_panel(grid, title, mode="image", figsize=(6.67, 7), dpi=300, basemap=True, oversample=1,
+                 basemap_cache=DEFAULT_PATH, basemap_zoom=None, offline=False, provider=POSITRON):
+    """
+    Render one panel of the comparison figure to an RGBA array
+
+    Uses its own Agg canvas, so panels can be rendered in separate
+    processes.
+
+    Parameters:
+    -----------
+    grid : ScoredGrid or GeoDataFrame
+        Scored grid in EPSG:3857
+    title : str
+        Panel title
+    mode : str
+        "image" (one `imshow`) or "polygons" (one patch per cell, as
+        `GeoDataFrame.plot` draws it)
+    figsize : tuple
+        Panel size in inches
+    dpi : int
+        Resolution
+    basemap : bool
+        Add the CartoDB Positron basemap, from the tile cache
+    oversample : int
+        Pixels per cell side in "image" mode
+    basemap_cache : str
+        SQLite file of the tile cache (see `basemap_cache`)
+    basemap_zoom : int, optional
+        Zoom of the basemap (default: picked from the view)
+    offline : bool
+        Only draw the cached tiles, never download
+    provider : str, dict or xyzservices.TileProvider
+        Tile source (default: CartoDB Positron)
+
+    Returns:
+    --------
+    rgba : ndarray
+        (height, width, 4) uint8 array
+    """
+    fig = Figure(figsize=figsize, dpi=dpi)
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+
+    if mode == "image":
+        artist = plot_grid_image(ax, grid, oversample=oversample)
+        fig.colorbar(artist, ax=ax, label='Walkability Score', shrink=0.8)
+    elif mode == "polygons":
+        cells = grid.to_geodataframe() if isinstance(grid, ScoredGrid) else grid
+        cells.plot(
+            column="WAS", cmap="RdYlGn", legend=True, ax=ax, alpha=0.7, edgecolor='black', linewidth=0.3,
+            vmin=0, vmax=100, legend_kwds={'label': 'Walkability Score', 'shrink': 0.8}
+        )
+    else:
+        raise ValueError(f"Unknown panel mode: {mode}")
+
+    if basemap:
+        cache = BasemapCache(basemap_cache, offline=offline)
+        try:
+            cache.add_basemap(ax, provider, zoom=basemap_zoom, alpha=0.5)
+        finally:
+            cache.close()
+
+    ax.set_title(title, fontsize=12, fontweight='bold')
+    ax.set_xlabel("Easting (m)", fontsize=9)
+    ax.set_ylabel("Northing (m)", fontsize=9)
+    ax.tick_params(labelsize=8)
+    fig.tight_layout()
+
+    canvas.draw()
+    return np.asarray(canvas.buffer_rgba()).copy()
+
+
+def _render_banner(text, width, dpi, height=1.0):
+    """White strip with a centred title, `width` pixels wide"""
+    fig = Figure(figsize=(width / dpi, height), dpi=dpi)
+    canvas = FigureCanvasAgg(fig)
+    fig.text(0.5, 0.5, text, ha="center", va="center", fontsize=16, fontweight='bold')
+    canvas.draw()
+    drawn = np.asarray(canvas.buffer_rgba())
+
+    # The canvas size is rounded to whole pixels
+    banner = np.full((drawn.shape[0], width, 4), 255, dtype=np.uint8)
+    banner[:, :min(width, drawn.shape[1])] = drawn[:, :width]
+    return banner
+
+
+def comparison_figure(panels, path, ncols=3, title=None, max_workers=None, **panel_options):
+    """
+    Render panels in parallel and composite them into one PNG
+
+    The basemap tiles of every panel are prefetched together first; the
+    panels then only read the tile cache.
+
+    Parameters:
+    -----------
+    panels : list of (grid, title)
+        Grid (ScoredGrid or GeoDataFrame in EPSG:3857) and title of each
+        panel; ScoredGrids are much cheaper to send to the workers
+    path : str
+        Output PNG
+    ncols : int
+        Panels per row (default: 3)
+    title : str, optional
+        Title above the panels
+    max_workers : int
+        Worker processes (default: one per panel, up to the CPU cores)
+    **panel_options
+        Passed to `render_panel` (mode, figsize, dpi, basemap, oversample,
+        basemap_cache, offline, provider)
+
+    Returns:
+    --------
+    image : ndarray
+        The composited RGBA array
+    """
+    if not panels:
+        raise ValueError("No panel to draw")
+    max_workers = max_workers or min(len(panels), os.cpu_count() or 1)
+    grids, titles = zip(*panels)
+    options = [dict(panel_options) for _ in panels]
+    if panel_options.get('basemap', True):
+        # Axes show the data plus matplotlib's margins
+        bounds = [_grid_bounds(grid, padding=0.1) for grid in grids]
+        cache = BasemapCache(panel_options.get('basemap_cache', DEFAULT_PATH),
+                             offline=panel_options.get('offline', False))
+        try:
+            zooms = cache.prefetch(panel_options.get('provider', POSITRON), bounds)
+        finally:
+            cache.close()
+        for option, zoom in zip(options, zooms):
+            option.update(basemap_zoom=zoom, offline=True)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        images = list(executor.map(_render_panel_options, grids, titles, options))
+
+    # Same figsize and dpi: every panel has the same pixel size
+    height, width = images[0].shape[:2]
+    blank = np.full((height, width, 4), 255, dtype=np.uint8)
+    nrows = -(-len(images) // ncols)
+    images += [blank] * (nrows * ncols - len(images))
+    rows = [np.concatenate(images[i:i + ncols], axis=1) for i in range(0, len(images), ncols)]
+    composite = np.concatenate(rows, axis=0)
+    if title:
+        banner = _render_banner(title, composite.shape[1], panel_options.get('dpi', 300))
+        composite = np.concatenate([banner, composite], axis=0)
+
+    mpimg.imsave(path, composite)
+    return composite
+
+
+def _grid_bounds(grid, padding=0.0):
+    """(minx, miny, maxx, maxy) of a grid, widened by `padding` of its size"""
+    if isinstance(grid, ScoredGrid):
+        minx, miny, maxx, maxy = grid.bounds
+    else:
+        minx, miny, maxx, maxy = grid.total_bounds
+    dx, dy = (maxx - minx) * padding, (maxy - miny) * padding
+    return minx - dx, miny - dy, maxx + dx, maxy + dy
+
+
+def _render_panel_options(grid, title, options):
+    return render_panel(grid, title, **options)
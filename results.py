@@ -0,0 +1,429 @@
+# -*- coding: utf-8 -*-
+"""
+Compact, columnar walkability results
+
+A `ScoredGrid` keeps what a scored grid really needs as numpy arrays:
+centroid coordinates (float64), raw scores and WAS. Cell polygons are not
+held in memory: whole square cells are rebuilt from their centroid and
+size on demand, and only the cells clipped by the boundary keep their
+geometry. Grids are saved as GeoParquet, readable by geopandas, QGIS or
+DuckDB, and loaded back without decoding any geometry.
+"""
+
+import glob
+import json
+import os
+import re
+
+import geopandas as gpd
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shapely
+from pyproj import CRS
+
+# Relative area under which a cell is considered clipped by the boundary
+_CLIPPED_TOLERANCE = 1e-9
+
+
+class ScoredGrid:
+    """
+    Scored grid stored as numpy arrays
+
+    Parameters:
+    -----------
+    x, y : array-like of float
+        Centroid coordinates of the cells
+    raw_score : array-like of int or float
+        Raw walkability score of each cell (floats for continuous kernels)
+    was : array-like of float
+        Walkability score normalized to 0-100
+    cell_size : float or array-like of float
+        Size of the square cells in meters (one per cell for adaptive grids)
+    crs : CRS
+        CRS of the coordinates
+    clipped_index : array-like of int, optional
+        Positions of the cells clipped by the boundary
+    clipped_geometry : array-like of shapely geometries, optional
+        Geometry of these cells
+    """
+
+    def __init__(self, x, y, raw_score, was, cell_size, crs, clipped_index=(), clipped_geometry=()):
+        self.x = np.asarray(x, dtype=np.float64)
+        self.y = np.asarray(y, dtype=np.float64)
+        raw_score = np.asarray(raw_score)
+        self.raw_score = raw_score.astype(np.int64 if np.issubdtype(raw_score.dtype, np.integer) else np.float64)
+        self.was = np.asarray(was, dtype=np.float64)
+        self.cell_size = np.broadcast_to(np.asarray(cell_size, dtype=np.float64), self.x.shape)
+        self.crs = CRS.from_user_input(crs)
+        self.clipped_index = np.asarray(clipped_index, dtype=np.int64)
+        self._clipped_geometry = clipped_geometry
+        self._lattice_index = None
+        self.attrs = {}
+
+    def __len__(self):
+        return len(self.x)
+
+    @classmethod
+    def from_geodataframe(cls, grid, cell_size=None):
+        """
+        Build a compact grid from the GeoDataFrame of `calculate_walkability`
+
+        Parameters:
+        -----------
+        grid : GeoDataFrame
+            Grid with `raw_score` and `WAS` columns (and `centroid`,
+            `cell_size` when present)
+        cell_size : float, optional
+            Size of the cells; read from the `cell_size` column of
+            adaptive grids, or from the largest cell otherwise
+
+        Returns:
+        --------
+        ScoredGrid
+        """
+        geoms = np.asarray(grid.geometry, dtype=object)
+        if 'centroid' in grid.columns:
+            centroids = np.asarray(grid['centroid'], dtype=object)
+        else:
+            centroids = shapely.centroid(geoms)
+
+        if 'cell_size' in grid.columns:
+            cell_size = grid['cell_size'].to_numpy(dtype=np.float64)
+        elif cell_size is None:
+            bounds = shapely.bounds(geoms)
+            cell_size = float(np.max(bounds[:, 2:] - bounds[:, :2])) if len(geoms) else 0.0
+
+        # Cells smaller than a full square were clipped and keep their shape
+        full_area = np.broadcast_to(np.asarray(cell_size, dtype=np.float64), (len(geoms),)) ** 2
+        clipped = np.flatnonzero(shapely.area(geoms) < full_area * (1 - _CLIPPED_TOLERANCE))
+
+        scored = cls(
+            shapely.get_x(centroids), shapely.get_y(centroids), grid['raw_score'].to_numpy(),
+            grid['WAS'].to_numpy(dtype=np.float64), cell_size, grid.crs, clipped, geoms[clipped],
+        )
+        scored.attrs = dict(grid.attrs)
+        return scored
+
+    @property
+    def clipped_geometry(self):
+        """Geometry of the clipped cells (decoded from WKB on first use)"""
+        if len(self._clipped_geometry) and not isinstance(self._clipped_geometry[0], shapely.Geometry):
+            self._clipped_geometry = shapely.from_wkb(np.asarray(self._clipped_geometry, dtype=object))
+        return np.asarray(self._clipped_geometry, dtype=object)
+
+    @property
+    def geometry(self):
+        """Polygons of every cell"""
+        half = self.cell_size / 2
+        cells = shapely.box(self.x - half, self.y - half, self.x + half, self.y + half)
+        cells[self.clipped_index] = self.clipped_geometry
+        return cells
+
+    @property
+    def bounds(self):
+        """(minx, miny, maxx, maxy) of the cells"""
+        half = self.cell_size / 2
+        whole = np.ones(len(self), dtype=bool)
+        whole[self.clipped_index] = False
+        clipped = shapely.bounds(self.clipped_geometry).reshape(-1, 4)
+        # Whole cells are centred on their centroid, clipped ones lie within their square
+        return (
+            min((self.x - half)[whole].min(initial=np.inf), clipped[:, 0].min(initial=np.inf)),
+            min((self.y - half)[whole].min(initial=np.inf), clipped[:, 1].min(initial=np.inf)),
+            max((self.x + half)[whole].max(initial=-np.inf), clipped[:, 2].max(initial=-np.inf)),
+            max((self.y + half)[whole].max(initial=-np.inf), clipped[:, 3].max(initial=-np.inf)),
+        )
+
+    def lattice(self):
+        """
+        Position of every cell's square on the grid lattice
+
+        The lattice starts at the lower-left corner of `bounds`, where the
+        grid was laid out from (see `grid_cells`); adaptive grid cells line
+        up on the lattice of their own size.
+
+        Returns:
+        --------
+        col, row : ndarray of int
+            Column and row of each cell, in units of its own size
+        """
+        minx, miny = self.bounds[:2]
+        col = np.floor((self.x - minx) / self.cell_size).astype(np.int64)
+        row = np.floor((self.y - miny) / self.cell_size).astype(np.int64)
+        return col, row
+
+    def _index(self):
+        """Sorted lattice keys of the cells, one table per cell size, built on first use"""
+        if self._lattice_index is None:
+            col, row = self.lattice()
+            stride = int(row.max(initial=0)) + 2
+            tables = []
+            for size in np.unique(self.cell_size):
+                cells = np.flatnonzero(self.cell_size == size)
+                keys = col[cells] * stride + row[cells]
+                order = np.argsort(keys)
+                tables.append((float(size), keys[order], cells[order]))
+            clipped_position = np.full(len(self), -1)
+            clipped_position[self.clipped_index] = np.arange(len(self.clipped_index))
+            clipped_geometry = self.clipped_geometry
+            shapely.prepare(clipped_geometry)
+            self._lattice_index = (self.bounds[:2], stride, tables, clipped_position, clipped_geometry)
+        return self._lattice_index
+
+    def locate(self, x, y):
+        """
+        Cell holding each point, by arithmetic on the grid lattice
+
+        One binary search per cell size; points in the square of a clipped
+        cell are checked against its shape.
+
+        Parameters:
+        -----------
+        x, y : array-like of float
+            Coordinates in the CRS of the grid
+
+        Returns:
+        --------
+        cells : ndarray of int
+            Position of the cell holding each point, -1 outside the grid
+        """
+        x = np.atleast_1d(np.asarray(x, dtype=np.float64))
+        y = np.atleast_1d(np.asarray(y, dtype=np.float64))
+        found = np.full(len(x), -1, dtype=np.int64)
+        if len(self) == 0:
+            return found
+        (minx, miny), stride, tables, clipped_position, clipped_geometry = self._index()
+        for size, keys, cells in tables:
+            todo = np.flatnonzero(found < 0)
+            col = np.floor((x[todo] - minx) / size)
+            row = np.floor((y[todo] - miny) / size)
+            valid = (col >= 0) & (row >= 0) & (row < stride) & np.isfinite(col)
+            todo, key = todo[valid], col[valid].astype(np.int64) * stride + row[valid].astype(np.int64)
+            i = np.minimum(np.searchsorted(keys, key), len(keys) - 1)
+            hit = keys[i] == key
+            todo, cell = todo[hit], cells[i[hit]]
+
+            clipped = clipped_position[cell]
+            inside = np.ones(len(cell), dtype=bool)
+            check = np.flatnonzero(clipped >= 0)
+            inside[check] = shapely.contains_xy(clipped_geometry[clipped[check]], x[todo[check]], y[todo[check]])
+            found[todo[inside]] = cell[inside]
+        return found
+
+    def to_geodataframe(self, centroid=False):
+        """
+        Expand to a GeoDataFrame, e.g. for plotting
+
+        Parameters:
+        -----------
+        centroid : bool
+            Also add the `centroid` point column
+
+        Returns:
+        --------
+        grid : GeoDataFrame
+            Cells with `raw_score`, `WAS` and `cell_size` columns
+        """
+        grid = gpd.GeoDataFrame(
+            {'raw_score': self.raw_score, 'WAS': self.was, 'cell_size': self.cell_size},
+            geometry=self.geometry, crs=self.crs,
+        )
+        if centroid:
+            grid['centroid'] = gpd.GeoSeries(shapely.points(self.x, self.y), crs=self.crs)
+        grid.attrs = dict(self.attrs)
+        return grid
+
+    def save(self, path):
+        """
+        Write the grid as GeoParquet
+
+        Whole square cells are written with a null geometry and rebuilt by
+        `load`; `to_geodataframe().to_parquet(path)` writes every polygon
+        for tools that need them.
+
+        Parameters:
+        -----------
+        path : str
+            .parquet file
+        """
+        geometry = np.full(len(self), None, dtype=object)
+        geometry[self.clipped_index] = shapely.to_wkb(self.clipped_geometry)
+        table = pa.table({
+            'x': self.x,
+            'y': self.y,
+            'raw_score': self.raw_score,
+            'WAS': self.was,
+            'cell_size': np.ascontiguousarray(self.cell_size),
+            'geometry': pa.array(geometry, type=pa.binary()),
+        })
+
+        geo = {
+            "version": "1.0.0",
+            "primary_column": "geometry",
+            "columns": {"geometry": {
+                "encoding": "WKB",
+                "geometry_types": ["Polygon", "MultiPolygon"],
+                "crs": self.crs.to_json_dict(),
+            }},
+        }
+        metadata = {b"geo": json.dumps(geo), b"walkability": json.dumps(self.attrs, default=str)}
+        pq.write_table(table.replace_schema_metadata(metadata), path)
+
+    @classmethod
+    def load(cls, path, memory_map=False):
+        """
+        Read a grid written by `save`
+
+        Geometries stay WKB until `geometry` or `clipped_geometry` is used.
+
+        Parameters:
+        -----------
+        path : str
+            .parquet file
+        memory_map : bool
+            Memory-map the file instead of reading it into memory first
+
+        Returns:
+        --------
+        ScoredGrid
+        """
+        table = pq.read_table(path, memory_map=memory_map)
+        metadata = table.schema.metadata or {}
+        geo = json.loads(metadata[b"geo"])
+        crs = geo["columns"][geo["primary_column"]]["crs"]
+
+        geometry = table.column('geometry')
+        clipped = np.flatnonzero(geometry.is_valid().to_numpy(zero_copy_only=False))
+        scored = cls(
+            table.column('x').to_numpy(), table.column('y').to_numpy(),
+            table.column('raw_score').to_numpy(), table.column('WAS').to_numpy(),
+            table.column('cell_size').to_numpy(), crs,
+            clipped, geometry.take(clipped).to_pylist(),
+        )
+        scored.attrs = json.loads(metadata.get(b"walkability", b"{}"))
+        return scored
+
+
+def _slug(name):
+    return re.sub(r"[^\w.-]+", "_", name).strip("_")
+
+
+def save_results(results, folder):
+    """
+    Save a `{place_name: {'grid', 'pois', 'continent'}}` results dict
+
+    Each city gets `<name>.parquet` (its `ScoredGrid`) and a
+    `<name>_pois.parquet` sidecar with the POI points; `results.json`
+    lists the cities.
+
+    Parameters:
+    -----------
+    results : dict
+        Results of `calculate_walkability_batch`, with GeoDataFrame or
+        ScoredGrid grids
+    folder : str
+        Output folder
+    """
+    os.makedirs(folder, exist_ok=True)
+    index = {}
+    for place, data in results.items():
+        grid = data['grid']
+        if not isinstance(grid, ScoredGrid):
+            grid = ScoredGrid.from_geodataframe(grid)
+        stem = _slug(place)
+        grid.save(os.path.join(folder, f"{stem}.parquet"))
+
+        pois = data.get('pois')
+        if pois is not None:
+            # Points are enough to draw and count the POIs
+            points = gpd.GeoDataFrame(geometry=pois.geometry.representative_point().to_numpy(), crs=pois.crs)
+            if 'name' in pois.columns:
+                points['name'] = pois['name'].to_numpy()
+            points.to_parquet(os.path.join(folder, f"{stem}_pois.parquet"))
+        index[place] = {'file': stem, 'continent': data.get('continent')}
+
+    with open(os.path.join(folder, "results.json"), "w", encoding="utf-8") as f:
+        json.dump(index, f, indent=2, ensure_ascii=False)
+
+
+def result_files(folder):
+    """Grid files of a results folder (GeoPackages of `batch.py` and GeoParquet of `save_results`)"""
+    paths = glob.glob(os.path.join(folder, "*.gpkg")) + glob.glob(os.path.join(folder, "*.parquet"))
+    return sorted(p for p in paths if not os.path.splitext(p)[0].endswith("_pois") and ".tmp" not in p)
+
+
+def result_names(folder):
+    """Cities listed in the `results.json` of a folder, {file stem: {'name', 'continent'}}"""
+    path = os.path.join(folder, "results.json")
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        index = json.load(f)
+    return {entry['file']: {'name': name, 'continent': entry.get('continent')} for name, entry in index.items()}
+
+
+def read_result(path, names=None):
+    """
+    Read the grid of one city from a results file
+
+    Parameters:
+    -----------
+    path : str
+        `<city>.gpkg` written by `batch.py` or `<city>.parquet` written by
+        `save_results`
+    names : dict, optional
+        {file stem: {'name', 'continent'}}, from `result_names`
+
+    Returns:
+    --------
+    name : str
+    grid : ScoredGrid
+    continent : str or None
+    pois_path : str or None
+        POI sidecar of the grid, if any
+    """
+    stem, extension = os.path.splitext(path)
+    pois_path = f"{stem}_pois{extension}"
+    pois_path = pois_path if os.path.exists(pois_path) else None
+    if extension == ".parquet":
+        entry = (names or {}).get(os.path.basename(stem), {})
+        return entry.get('name', os.path.basename(stem)), ScoredGrid.load(path), entry.get('continent'), pois_path
+
+    table = gpd.read_file(path)
+    name = table['place'].iloc[0] if 'place' in table.columns and len(table) else os.path.basename(stem)
+    continent = table['continent'].iloc[0] if 'continent' in table.columns and len(table) else None
+    return name, ScoredGrid.from_geodataframe(table), continent, pois_path
+
+
+def load_results(folder, memory_map=False, pois=True):
+    """
+    Load a results dict saved by `save_results`
+
+    Parameters:
+    -----------
+    folder : str
+        Folder written by `save_results`
+    memory_map : bool
+        Memory-map the grid files
+    pois : bool
+        Also read the POI sidecars
+
+    Returns:
+    --------
+    results : dict
+        {place_name: {'grid': ScoredGrid, 'pois', 'continent'}}
+    """
+    with open(os.path.join(folder, "results.json"), encoding="utf-8") as f:
+        index = json.load(f)
+
+    results = {}
+    for place, entry in index.items():
+        stem = os.path.join(folder, entry['file'])
+        poi_path = f"{stem}_pois.parquet"
+        results[place] = {
+            'grid': ScoredGrid.load(f"{stem}.parquet", memory_map=memory_map),
+            'pois': gpd.read_parquet(poi_path) if pois and os.path.exists(poi_path) else None,
+            'continent': entry['continent'],
+        }
+    return results
@@ -0,0 +1,396 @@
+# -*- coding: utf-8 -*-
+"""
+Walkability query service over precomputed grids
+
+Loads the scored grids of a results folder into memory and answers JSON
+queries over HTTP:
+
+    GET /score?lat=48.85&lon=2.35[&city=Paris, France]
+        score of the cell at a point
+    GET /cells?bbox=min_lon,min_lat,max_lon,max_lat[&city=...][&limit=1000]
+        scores of the cells whose centroid lies in a box
+    GET /cities               summary of every city
+    GET /cities/<name>        summary of one city
+    GET /health
+
+Both the folders written by `batch.py` (`<city>.gpkg`) and by
+`results.save_results` (`<city>.parquet` + `results.json`) are served. The
+folder is polled and the grids whose file changed are reloaded in a
+background thread, so a batch run publishes its cities as it goes.
+
+A point is located by arithmetic on the grid lattice (one binary search
+per cell size), boxes through an STRtree of the centroids, so answers
+take well under a millisecond. The server runs on asyncio streams from
+the standard library, with keep-alive connections.
+
+Usage:
+    python service.py results/ --port 8080
+    python loadtest.py --port 8080 --requests 20000 --concurrency 32
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import time
+from datetime import datetime, timezone
+from http import HTTPStatus
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import geopandas as gpd
+import numpy as np
+import shapely
+from pyproj import Transformer
+
+from results import read_result, result_files, result_names
+
+# Largest number of cells returned by a box query
+MAX_CELLS = 10000
+
+
+class CityIndex:
+    """
+    In-memory scored grid of one city, indexed for point and box queries
+
+    Parameters:
+    -----------
+    name : str
+        City name
+    grid : ScoredGrid
+        Scored grid, in a projected CRS
+    continent : str, optional
+    n_pois : int, optional
+        Number of transport POIs the grid was scored with
+    source : str, optional
+        File the grid was read from
+    """
+
+    def __init__(self, name, grid, continent=None, n_pois=None, source=None):
+        self.name = name
+        self.grid = grid
+        self.continent = continent
+        self.n_pois = n_pois
+        self.source = source
+        self.loaded_at = datetime.now(timezone.utc).isoformat()
+        self._to_grid = Transformer.from_crs("EPSG:4326", grid.crs, always_xy=True)
+        self._to_wgs84 = Transformer.from_crs(grid.crs, "EPSG:4326", always_xy=True)
+
+        # Built now rather than on the first query
+        grid.locate([], [])
+        self._centroids = shapely.STRtree(shapely.points(grid.x, grid.y))
+        minx, miny, maxx, maxy = grid.bounds
+        self.bounds = self._to_wgs84.transform_bounds(minx, miny, maxx, maxy)
+        self._summary = self._summarize()
+
+    def _summarize(self):
+        was = self.grid.was
+        return {
+            'name': self.name,
+            'continent': self.continent,
+            'cells': len(self.grid),
+            'pois': self.n_pois,
+            'was_mean': float(was.mean()) if len(was) else None,
+            'was_median': float(np.median(was)) if len(was) else None,
+            'was_min': float(was.min()) if len(was) else None,
+            'was_max': float(was.max()) if len(was) else None,
+            'cell_size': sorted({float(s) for s in np.unique(self.grid.cell_size)}),
+            'bounds': [float(b) for b in self.bounds],
+            'source': self.source,
+            'loaded_at': self.loaded_at,
+        }
+
+    def summary(self):
+        return dict(self._summary)
+
+    def covers(self, lon, lat):
+        """Whether a point lies in the bounding box of the grid"""
+        return self.bounds[0] <= lon <= self.bounds[2] and self.bounds[1] <= lat <= self.bounds[3]
+
+    def locate(self, lon, lat):
+        """Position of the cell holding a point, or None"""
+        cell = int(self.grid.locate(*self._to_grid.transform(lon, lat))[0])
+        return cell if cell >= 0 else None
+
+    def cell(self, i):
+        """JSON description of a cell"""
+        lon, lat = self._to_wgs84.transform(self.grid.x[i], self.grid.y[i])
+        return {
+            'lon': round(float(lon), 7),
+            'lat': round(float(lat), 7),
+            'WAS': float(self.grid.was[i]),
+            'raw_score': self.grid.raw_score[i].item(),
+            'cell_size': float(self.grid.cell_size[i]),
+        }
+
+    def in_bbox(self, min_lon, min_lat, max_lon, max_lat):
+        """Positions of the cells whose centroid lies in a box, in grid order"""
+        minx, miny, maxx, maxy = self._to_grid.transform_bounds(min_lon, min_lat, max_lon, max_lat)
+        return np.sort(self._centroids.query(shapely.box(minx, miny, maxx, maxy), predicate="intersects"))
+
+
+def _count_features(path):
+    """Number of features of a POI sidecar, None without one"""
+    if path is None:
+        return None
+    if path.endswith(".parquet"):
+        return len(gpd.read_parquet(path, columns=['geometry']))
+    try:
+        import pyogrio
+        return int(pyogrio.read_info(path)['features'])
+    except ImportError:
+        return len(gpd.read_file(path))
+
+
+def load_city(path, names=None):
+    """
+    Read and index the grid of one city from a results file
+
+    Parameters:
+    -----------
+    path : str
+        `<city>.gpkg` written by `batch.py` or `<city>.parquet` written by
+        `results.save_results`
+    names : dict, optional
+        {file stem: {'name', 'continent'}} read from `results.json`
+
+    Returns:
+    --------
+    city : CityIndex
+    """
+    name, grid, continent, pois_path = read_result(path, names)
+    return CityIndex(name, grid, continent, _count_features(pois_path), path)
+
+
+class WalkabilityService:
+    """
+    Scored grids of a results folder, reloaded when their files change
+
+    Parameters:
+    -----------
+    folder : str
+        Results folder of `batch.py` or `results.save_results`
+    poll_interval : float
+        Seconds between two scans of the folder (default: 5)
+    """
+
+    def __init__(self, folder, poll_interval=5.0):
+        self.folder = folder
+        self.poll_interval = poll_interval
+        self.cities = {}
+        self._files = {}
+
+    def reload(self):
+        """
+        Load the new and changed grid files, drop the deleted ones
+
+        Returns:
+        --------
+        changed : list of str
+            Names of the cities loaded or dropped
+        """
+        files = {}
+        for path in result_files(self.folder):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files[path] = (stat.st_mtime_ns, stat.st_size)
+
+        names = result_names(self.folder)
+        cities = dict(self.cities)
+        by_path = {city.source: name for name, city in cities.items()}
+        changed = []
+        for path in set(self._files) - set(files):
+            name = by_path.get(path)
+            if name is not None:
+                del cities[name]
+                changed.append(name)
+        for path, signature in files.items():
+            if self._files.get(path) == signature:
+                continue
+            try:
+                city = load_city(path, names)
+            except Exception as e:
+                # Keep serving the previous version of this city
+                print(f"  ✗ Could not load {path}: {e}")
+                files[path] = self._files.get(path)
+                continue
+            if by_path.get(path) not in (None, city.name):
+                del cities[by_path[path]]
+            cities[city.name] = city
+            changed.append(city.name)
+
+        # Swap the whole dict: requests in flight keep a consistent view
+        self._files = {path: signature for path, signature in files.items() if signature is not None}
+        self.cities = cities
+        return changed
+
+    async def watch(self):
+        """Reload the folder every `poll_interval` seconds, off the event loop"""
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            changed = await loop.run_in_executor(None, self.reload)
+            if changed:
+                print(f"  Reloaded {len(changed)} cities: {', '.join(changed)}")
+
+    def _city(self, query, lon=None, lat=None):
+        """City named in the query, or the first whose grid holds the point"""
+        cities = self.cities
+        if 'city' in query:
+            city = cities.get(query['city'])
+            if city is None:
+                raise LookupError(f"Unknown city: {query['city']}")
+            return [city]
+        return [city for city in cities.values() if lon is None or city.covers(lon, lat)]
+
+    def score(self, query):
+        lon, lat = float(query['lon']), float(query['lat'])
+        for city in self._city(query, lon, lat):
+            cell = city.locate(lon, lat)
+            if cell is not None:
+                return {'city': city.name, **city.cell(cell)}
+        raise LookupError(f"No scored cell at lat={lat}, lon={lon}")
+
+    def cells(self, query):
+        min_lon, min_lat, max_lon, max_lat = (float(v) for v in query['bbox'].split(","))
+        if min_lon > max_lon or min_lat > max_lat:
+            raise ValueError("bbox must be min_lon,min_lat,max_lon,max_lat")
+        limit = min(int(query.get('limit', 1000)), MAX_CELLS)
+        if limit < 1:
+            raise ValueError("limit must be at least 1")
+        box = shapely.box(min_lon, min_lat, max_lon, max_lat)
+
+        results, truncated = [], False
+        for city in self._city(query):
+            if not box.intersects(shapely.box(*city.bounds)):
+                continue
+            found = city.in_bbox(min_lon, min_lat, max_lon, max_lat)
+            room = limit - len(results)
+            truncated = truncated or len(found) > room
+            results += [{'city': city.name, **city.cell(i)} for i in found[:room]]
+        return {'count': len(results), 'truncated': truncated, 'cells': results}
+
+    def respond(self, method, target):
+        """
+        Answer one request
+
+        Returns:
+        --------
+        status : HTTPStatus
+        payload : dict
+        """
+        if method != "GET":
+            return HTTPStatus.METHOD_NOT_ALLOWED, {'error': "Only GET is supported"}
+        url = urlsplit(target)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        path = url.path.rstrip("/") or "/"
+
+        try:
+            if path == "/score":
+                return HTTPStatus.OK, self.score(query)
+            if path == "/cells":
+                return HTTPStatus.OK, self.cells(query)
+            if path == "/cities":
+                return HTTPStatus.OK, {'cities': [city.summary() for city in self.cities.values()]}
+            if path.startswith("/cities/"):
+                name = unquote(path[len("/cities/"):])
+                city = self.cities.get(name)
+                if city is None:
+                    raise LookupError(f"Unknown city: {name}")
+                return HTTPStatus.OK, city.summary()
+            if path == "/health":
+                return HTTPStatus.OK, {'status': "ok", 'cities': len(self.cities)}
+            return HTTPStatus.NOT_FOUND, {'error': f"Unknown path: {url.path}"}
+        except KeyError as e:
+            return HTTPStatus.BAD_REQUEST, {'error': f"Missing parameter: {e}"}
+        except ValueError as e:
+            return HTTPStatus.BAD_REQUEST, {'error': f"Bad parameter: {e}"}
+        except LookupError as e:
+            return HTTPStatus.NOT_FOUND, {'error': str(e)}
+
+    async def _handle(self, reader, writer):
+        """Serve the requests of one (keep-alive) connection"""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, _, value = line.decode("latin-1").partition(":")
+                    headers[key.strip().lower()] = value.strip()
+                if int(headers.get("content-length") or 0):
+                    await reader.readexactly(int(headers["content-length"]))
+
+                parts = request_line.decode("latin-1").split()
+                if len(parts) == 3:
+                    status, payload = self.respond(parts[0], parts[1])
+                    keep_alive = parts[2] == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                else:
+                    status, payload = HTTPStatus.BAD_REQUEST, {'error': "Malformed request line"}
+                    keep_alive = False
+
+                body = json.dumps(payload).encode("utf-8")
+                writer.write(
+                    f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+                    f"Content-Type: application/json\r\n"
+                    f"Content-Length: {len(body)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1") + body
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=8080, ready=None):
+        """
+        Load the folder, then serve until cancelled
+
+        Parameters:
+        -----------
+        host, port
+            Address to listen on (port 0: any free port)
+        ready : callable, optional
+            Called with the bound port once the server listens
+        """
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        await loop.run_in_executor(None, self.reload)
+        print(f"Loaded {len(self.cities)} cities in {time.perf_counter() - started:.1f} s")
+
+        server = await asyncio.start_server(self._handle, host, port)
+        bound = server.sockets[0].getsockname()[1]
+        print(f"Serving {self.folder} on http://{host}:{bound}")
+        if ready is not None:
+            ready(bound)
+        watcher = asyncio.create_task(self.watch())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            watcher.cancel()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Walkability query service over precomputed grids")
+    parser.add_argument("folder", help="results folder of batch.py or results.save_results")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--poll", type=float, default=5.0, help="seconds between two scans of the folder")
+    args = parser.parse_args(argv)
+
+    try:
+        asyncio.run(WalkabilityService(args.folder, args.poll).serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
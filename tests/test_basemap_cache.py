@@ -0,0 +1,103 @@
+import io
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from PIL import Image
+
+from basemap_cache import TILE_PIXELS, BasemapCache, tile_bounds
+
+
+def _png():
+    buffer = io.BytesIO()
+    Image.new("RGBA", (TILE_PIXELS, TILE_PIXELS), (200, 100, 50, 255)).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+TILE = _png()
+
+
+@pytest.fixture
+def tile_server():
+    """Stand-in tile server; yields its URL template and the paths requested"""
+    requested = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requested.append(self.path)
+            self.send_response(200)
+            self.send_header("Content-Type", "image/png")
+            self.send_header("Content-Length", str(len(TILE)))
+            self.end_headers()
+            self.wfile.write(TILE)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/{{z}}/{{x}}/{{y}}.png", requested
+    server.shutdown()
+    server.server_close()
+
+
+def _inside(z, x, y):
+    """Bounds strictly inside one tile"""
+    minx, miny, maxx, maxy = tile_bounds(z, x, y)
+    return minx + 1, miny + 1, maxx - 1, maxy - 1
+
+
+def test_cache_hits(tile_server, tmp_path):
+    url, requested = tile_server
+    # 2 x 2 tiles
+    bounds = (*_inside(12, 2074, 1410)[:2], *_inside(12, 2075, 1409)[2:])
+
+    cache = BasemapCache(str(tmp_path / "tiles.sqlite"))
+    assert cache.prefetch(url, bounds, zoom=12) == [12]
+    assert len(requested) == 4 and len(cache) == 4
+
+    image, _, missing = cache.mosaic(url, bounds, 12)
+    assert missing == 0 and image.shape == (2 * TILE_PIXELS, 2 * TILE_PIXELS, 4)
+    assert (image[..., 3] == 255).all()
+    cache.close()
+
+    # Another process drawing the same figure reads the store only
+    cache = BasemapCache(str(tmp_path / "tiles.sqlite"))
+    cache.prefetch(url, bounds, zoom=12)
+    assert cache.mosaic(url, bounds, 12)[2] == 0
+    assert len(requested) == 4
+    cache.close()
+
+
+def test_lru_eviction(tile_server, tmp_path):
+    url, requested = tile_server
+    cache = BasemapCache(str(tmp_path / "tiles.sqlite"), max_bytes=2 * len(TILE) + len(TILE) // 2)
+    cache.prefetch(url, _inside(10, 1, 1), zoom=10)
+    time.sleep(0.01)
+    cache.prefetch(url, _inside(10, 2, 1), zoom=10)
+    time.sleep(0.01)
+
+    # Drawing the first tile makes the second the least recently used
+    assert cache.mosaic(url, _inside(10, 1, 1), 10)[2] == 0
+    time.sleep(0.01)
+    cache.prefetch(url, _inside(10, 3, 1), zoom=10)
+
+    assert len(cache) == 2 and cache.size() <= cache.max_bytes
+    assert cache.get(url, 10, 1, 1) is not None
+    assert cache.get(url, 10, 2, 1) is None
+    assert cache.get(url, 10, 3, 1) is not None
+    assert len(requested) == 3
+    cache.close()
+
+
+def test_offline_never_downloads(tile_server, tmp_path):
+    url, requested = tile_server
+    cache = BasemapCache(str(tmp_path / "tiles.sqlite"), offline=True)
+    bounds = _inside(12, 2074, 1409)
+    assert cache.prefetch(url, bounds, zoom=12) == [12]
+    image, _, missing = cache.mosaic(url, bounds, 12)
+    assert missing == 1 and (image == 0).all()
+    assert requested == []
+    cache.close()
@@ -0,0 +1,143 @@
+import json
+import threading
+import time
+import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import pytest
+import shapely
+
+import overpass
+from overpass import OverpassFetcher
+
+# About 3 x 3 km in Paris
+AREA = shapely.box(2.33, 48.84, 2.37, 48.867)
+TAGS = {"railway": ["station"]}
+
+
+class StubOverpass:
+    """Stand-in Overpass server counting the queries it runs at once"""
+
+    def __init__(self, status=None, refusals=0, delay=0.0):
+        self.status = status
+        self.refusals = refusals
+        self.delay = delay
+        self.queries = []
+        self.in_flight = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def answer(self, query):
+        with self._lock:
+            self.queries.append(query)
+            if self.refusals:
+                self.refusals -= 1
+                return 429, {}
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+            n = len(self.queries)
+        time.sleep(self.delay)
+        with self._lock:
+            self.in_flight -= 1
+        # Every tile returns the station on their shared edge, and one of its own
+        return 200, {"elements": [
+            {"type": "node", "id": 1, "lat": 48.85, "lon": 2.35, "tags": {"railway": "station"}},
+            {"type": "node", "id": 1000 + n, "lat": 48.85, "lon": 2.35, "tags": {"railway": "station"}},
+        ]}
+
+
+@pytest.fixture
+def stub():
+    servers = []
+
+    def start(**kwargs):
+        state = StubOverpass(**kwargs)
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _send(self, status, body):
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path.endswith("/status") and state.status is not None:
+                    self._send(200, state.status.encode())
+                else:
+                    self._send(404, b"")
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"])).decode()
+                status, payload = state.answer(parse_qs(body)["data"][0])
+                self._send(status, json.dumps(payload).encode())
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return state, f"http://127.0.0.1:{server.server_address[1]}/api"
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def test_waits_for_a_slot_after_429(stub, monkeypatch):
+    state, endpoint = stub(status="Rate limit: 2\n0 slots available now.\n"
+                                  "Slot available after: 2026-01-01T00:00:03Z, in 3 seconds.\n", refusals=2)
+    pauses = []
+    monkeypatch.setattr(overpass, "time", types.SimpleNamespace(sleep=pauses.append))
+
+    fetcher = OverpassFetcher(endpoint, max_workers=1)
+    response = fetcher.post("[out:json];node(1);out;")
+    assert len(response["elements"]) == 2
+    assert len(state.queries) == 3
+    # The server said when a slot frees up: wait that long, plus a second
+    assert pauses == [4, 4]
+
+
+def test_gives_up_after_max_retries(stub, monkeypatch):
+    state, endpoint = stub(refusals=10)
+    monkeypatch.setattr(overpass, "time", types.SimpleNamespace(sleep=lambda seconds: None))
+    fetcher = OverpassFetcher(endpoint, max_retries=3)
+    with pytest.raises(overpass.requests.HTTPError):
+        fetcher.post("[out:json];node(1);out;")
+    assert len(state.queries) == 3
+
+
+def test_concurrency_cap_is_shared(stub):
+    state, endpoint = stub(delay=0.05)
+    fetcher = OverpassFetcher(endpoint, max_workers=3, tile_size=1000)
+    n_tiles = len(fetcher.tiles(AREA))
+    assert n_tiles > 6
+
+    # Two study areas fetched at once through the same fetcher
+    threads = [threading.Thread(target=fetcher.fetch, args=(AREA, TAGS)) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(state.queries) == 2 * n_tiles
+    assert state.peak == 3
+
+
+def test_concurrency_follows_rate_limit(stub):
+    state, endpoint = stub(status="Rate limit: 2\n2 slots available now.\n", delay=0.05)
+    fetcher = OverpassFetcher(endpoint, max_workers=8, tile_size=1000)
+    fetcher.fetch(AREA, TAGS)
+    assert state.peak == 2
+
+
+def test_tiles_are_merged_without_duplicates(stub):
+    state, endpoint = stub()
+    fetcher = OverpassFetcher(endpoint, tile_size=1000)
+    [response] = fetcher.fetch(AREA, TAGS)
+    ids = [element["id"] for element in response["elements"]]
+    assert len(ids) == len(set(ids)) == 1 + len(state.queries)
+    assert all('railway' in query and 'station' in query for query in state.queries)
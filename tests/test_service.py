@@ -0,0 +1,115 @@
+import asyncio
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import numpy as np
+import pytest
+from pyproj import Transformer
+
+from results import ScoredGrid, save_results
+from service import WalkabilityService
+
+CELL_SIZE = 100.0
+_TO_WGS84 = Transformer.from_crs("EPSG:3857", "EPSG:4326", always_xy=True)
+
+
+def _grid(was):
+    """5 x 5 cells of 100 m in EPSG:3857, scored `was` from the lower left"""
+    col, row = np.meshgrid(np.arange(5), np.arange(5), indexing="ij")
+    x = (col.ravel() + 0.5) * CELL_SIZE
+    y = (row.ravel() + 0.5) * CELL_SIZE
+    return ScoredGrid(x, y, np.arange(25), was, CELL_SIZE, "EPSG:3857")
+
+
+def _publish(folder, was):
+    save_results({'Town': {'grid': _grid(was), 'continent': "Europe"}}, folder)
+
+
+@pytest.fixture
+def server(tmp_path):
+    """Service over a temporary results folder, on a free port"""
+    _publish(tmp_path, np.linspace(0, 100, 25))
+    service = WalkabilityService(str(tmp_path), poll_interval=0.05)
+    loop = asyncio.new_event_loop()
+    bound = threading.Event()
+    port = []
+
+    def ready(p):
+        port.append(p)
+        bound.set()
+
+    task = loop.create_task(service.serve(port=0, ready=ready))
+
+    def run():
+        try:
+            loop.run_until_complete(task)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            loop.close()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    assert bound.wait(30)
+    yield tmp_path, f"http://127.0.0.1:{port[0]}"
+    loop.call_soon_threadsafe(task.cancel)
+    thread.join(10)
+
+
+def _get(url):
+    try:
+        with urllib.request.urlopen(url, timeout=10) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+def _lonlat(x, y):
+    return _TO_WGS84.transform(x, y)
+
+
+def test_score_cells_and_cities(server):
+    _, base = server
+    lon, lat = _lonlat(250, 150)
+    status, cell = _get(f"{base}/score?lon={lon}&lat={lat}")
+    assert status == 200
+    assert cell['city'] == "Town"
+    assert cell['raw_score'] == 2 * 5 + 1
+
+    lon, lat = _lonlat(-500, -500)
+    assert _get(f"{base}/score?lon={lon}&lat={lat}")[0] == 404
+    assert _get(f"{base}/score?lon=abc&lat=0")[0] == 400
+    assert _get(f"{base}/score?lat=0")[0] == 400
+
+    min_lon, min_lat = _lonlat(0, 0)
+    max_lon, max_lat = _lonlat(500, 500)
+    status, cells = _get(f"{base}/cells?bbox={min_lon},{min_lat},{max_lon},{max_lat}")
+    assert status == 200
+    assert cells['count'] == 25 and not cells['truncated']
+
+    status, cells = _get(f"{base}/cells?bbox={min_lon},{min_lat},{max_lon},{max_lat}&limit=10")
+    assert cells['count'] == 10 and cells['truncated']
+    for limit in (0, -3):
+        assert _get(f"{base}/cells?bbox={min_lon},{min_lat},{max_lon},{max_lat}&limit={limit}")[0] == 400
+
+    status, cities = _get(f"{base}/cities")
+    assert status == 200
+    assert [city['name'] for city in cities['cities']] == ["Town"]
+    assert cities['cities'][0]['cells'] == 25
+    assert _get(f"{base}/cities/Town")[1]['continent'] == "Europe"
+    assert _get(f"{base}/cities/Nowhere")[0] == 404
+
+
+def test_reload_on_change(server):
+    folder, base = server
+    lon, lat = _lonlat(50, 50)
+    assert _get(f"{base}/score?lon={lon}&lat={lat}")[1]['WAS'] == 0
+
+    _publish(folder, np.full(25, 42.0))
+    deadline = time.monotonic() + 10
+    while _get(f"{base}/score?lon={lon}&lat={lat}")[1]['WAS'] != 42 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert _get(f"{base}/score?lon={lon}&lat={lat}")[1]['WAS'] == 42
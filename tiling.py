@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Tiled, bounded-memory walkability processing for very large study areas
+
+The bounding box of the study area is split into square tiles aligned on
+the grid. Each tile loads the POIs of its own area plus a halo as wide as
+the largest distance threshold through the POI store, which answers from
+the responses already covering it and only downloads the rest, scores its
+cells and writes them to disk before the next tile starts, so peak memory
+depends on the tile size and not on the size of the region.
+"""
+
+import glob
+import os
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from shapely.geometry import box
+
+from boundaries import get_boundary
+from grid import clip_cells, grid_cells, grid_shape
+from poi_store import features_from_polygon
+from scoring import THRESHOLDS, score_cells
+from transport_pois import TRANSPORT_TAGS, filter_transport_pois
+
+
+def _tile_pois(polygon):
+    """Transport POIs of a polygon in EPSG:3857, through the POI store"""
+    polygon = gpd.GeoSeries([polygon], crs="EPSG:3857").to_crs(epsg=4326).iloc[0]
+    # Overpass queries take (Multi)Polygons only
+    parts = [part for part in shapely.get_parts(polygon) if part.geom_type == "Polygon"]
+    polygon = shapely.MultiPolygon(parts) if len(parts) > 1 else parts[0]
+    pois = features_from_polygon(polygon, TRANSPORT_TAGS)
+    return np.asarray(filter_transport_pois(pois).to_crs(epsg=3857).geometry, dtype=object)
+
+
+def calculate_walkability_tiled(place_name, output_dir, grid_size=500, tile_size=20000, study_area=None,
+                                region_pois=False):
+    """
+    Calculate walkability tile by tile, streaming the results to disk
+
+    Gives the same scores as `calculate_walkability`: cells are aligned on
+    the same grid and POIs are still restricted to the study area.
+
+    Parameters:
+    -----------
+    place_name : str
+        Name of the place to analyze
+    output_dir : str
+        Folder receiving one GeoPackage per tile (tile_<col>_<row>.gpkg)
+    grid_size : int
+        Size of grid cells in meters (default: 500)
+    tile_size : int
+        Approximate size of tiles in meters, rounded down to a whole number
+        of cells (default: 20000)
+    study_area : GeoDataFrame, optional
+        Boundary to use instead of geocoding `place_name` (e.g. read from
+        a shapefile)
+    region_pois : bool
+        Load and index the POIs of the whole study area once instead of
+        tile by tile: faster when they fit in memory (default: False)
+
+    Returns:
+    --------
+    tile_paths : list of str
+        Written tiles, with `raw_score` and `WAS` columns
+    """
+    print(f"Processing {place_name} by tiles...")
+
+    # Get the study area
+    if study_area is None:
+        study_area = get_boundary(place_name)
+    study_area = study_area.to_crs(epsg=3857)
+    boundary = study_area.geometry.union_all()
+
+    bounds = study_area.total_bounds
+    minx, miny = bounds[0], bounds[1]
+    n_cols, n_rows = grid_shape(bounds, grid_size)
+    cells_per_tile = max(int(tile_size // grid_size), 1)
+    halo = max(THRESHOLDS)
+
+    # Start from an empty folder so tiles of an earlier run are not mixed in
+    os.makedirs(output_dir, exist_ok=True)
+    for path in glob.glob(os.path.join(output_dir, "tile_*.gpkg")):
+        os.remove(path)
+    tile_paths = []
+    min_score, max_score = float('inf'), float('-inf')
+
+    if region_pois:
+        poi_geoms = _tile_pois(boundary)
+        poi_tree = shapely.STRtree(poi_geoms)
+
+    # First pass: score each tile and write its raw scores
+    for col in range(0, n_cols, cells_per_tile):
+        for row in range(0, n_rows, cells_per_tile):
+            cols = range(col, min(col + cells_per_tile, n_cols))
+            rows = range(row, min(row + cells_per_tile, n_rows))
+            tile_box = box(
+                minx + cols.start * grid_size, miny + rows.start * grid_size,
+                minx + cols.stop * grid_size, miny + rows.stop * grid_size
+            )
+            if not tile_box.intersects(boundary):
+                continue
+
+            cells = clip_cells(grid_cells(bounds, grid_size, cols, rows), boundary)
+            if len(cells) == 0:
+                continue
+            tile = gpd.GeoDataFrame({'geometry': cells}, crs=study_area.crs)
+
+            # POIs of the tile and its halo in the study area: every POI
+            # close enough to score one of its cells
+            reach = tile_box.buffer(halo)
+            if region_pois:
+                nearby = poi_geoms[np.sort(poi_tree.query(reach, predicate="intersects"))]
+            else:
+                nearby = _tile_pois(reach.intersection(boundary))
+            tile['raw_score'] = score_cells(tile.geometry.centroid, nearby)
+            min_score = min(min_score, tile['raw_score'].min())
+            max_score = max(max_score, tile['raw_score'].max())
+
+            path = os.path.join(output_dir, f"tile_{col // cells_per_tile:04d}_{row // cells_per_tile:04d}.gpkg")
+            tile.to_file(path, driver="GPKG")
+            tile_paths.append(path)
+
+    # Second pass: normalize scores to 0-100 with the min/max of all tiles
+    n_cells, total = 0, 0.0
+    for path in tile_paths:
+        tile = gpd.read_file(path)
+        if max_score > min_score:
+            tile["WAS"] = 100 * (tile['raw_score'] - min_score) / (max_score - min_score)
+        else:
+            tile["WAS"] = 0.0
+        tile.to_file(path, driver="GPKG")
+        n_cells += len(tile)
+        total += tile["WAS"].sum()
+
+    avg = total / n_cells if n_cells else 0.0
+    print(f"  ✓ {place_name}: {n_cells} cells in {len(tile_paths)} tiles, avg WAS = {avg:.2f}")
+
+    return tile_paths
+
+
+def read_tiles(output_dir):
+    """
+    Read back all the tiles written by `calculate_walkability_tiled`
+
+    Only for areas whose full grid fits in memory.
+
+    Parameters:
+    -----------
+    output_dir : str
+        Folder holding the tiles
+
+    Returns:
+    --------
+    grid : GeoDataFrame
+        All the cells of the study area
+    """
+    paths = sorted(glob.glob(os.path.join(output_dir, "tile_*.gpkg")))
+    return gpd.GeoDataFrame(pd.concat([gpd.read_file(path) for path in paths], ignore_index=True))
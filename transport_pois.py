@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+Public transport POIs used by the walkability score
+
+Tags queried from OpenStreetMap and the filtering applied to the features
+returned, shared by every way of computing the score.
+"""
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+# Define public transport amenities
+TRANSPORT_TAGS = {
+    "public_transport": ["station", "stop_position", "stop_area"],
+    "railway": ["station", "halt", "tram_stop", "subway_entrance"],
+    "amenity": ["bus_station", "ferry_terminal"]
+}
+
+# Feature kept to represent a cluster of stops, best first; features
+# matching none of these come last
+STOP_PRIORITY = [
+    ("public_transport", "station"),
+    ("railway", "station"),
+    ("amenity", "bus_station"),
+    ("amenity", "ferry_terminal"),
+    ("railway", "halt"),
+    ("public_transport", "stop_area"),
+    ("railway", "tram_stop"),
+    ("highway", "bus_stop"),
+    ("public_transport", "platform"),
+    ("public_transport", "stop_position"),
+    ("railway", "subway_entrance"),
+]
+
+
+def filter_transport_pois(pois, tags=TRANSPORT_TAGS):
+    """
+    Keep the features whose tags match `tags`, without duplicates
+
+    Parameters:
+    -----------
+    pois : GeoDataFrame
+        Features returned by `features_from_polygon`
+    tags : dict
+        Tag values to keep, by tag key
+
+    Returns:
+    --------
+    pois : GeoDataFrame
+        Relevant public transport features
+    """
+    # Filter relevant public transport features
+    valid_pois = []
+
+    # Check every tag key present in the features
+    for key, values in tags.items():
+        if key in pois.columns:
+            valid_pois.append(pois[pois[key].isin(values)])
+
+    # Combine all valid POIs and remove duplicates
+    if valid_pois:
+        return pd.concat(valid_pois).drop_duplicates(subset=['geometry'])
+
+    # Create empty GeoDataFrame with same CRS if no POIs found
+    return gpd.GeoDataFrame(geometry=[], crs=pois.crs)
+
+
+def collapse_stops(pois, distance=50, stop_areas=True):
+    """
+    Merge the features of a same stop into one POI
+
+    A station is usually mapped several times: a `stop_area`, a `station`
+    node, its `stop_position`s and `subway_entrance`s. Features closer
+    than `distance` to each other (chained: A-B and B-C put A, B and C
+    together), and with `stop_areas` the features lying in a `stop_area`
+    polygon, form a cluster; each cluster keeps its best feature
+    according to `STOP_PRIORITY`.
+
+    Parameters:
+    -----------
+    pois : GeoDataFrame
+        Filtered POIs, in a projected CRS (meters)
+    distance : float
+        Largest distance in meters between features of a same stop
+        (default: 50)
+    stop_areas : bool
+        Also merge the features inside each `stop_area` polygon
+
+    Returns:
+    --------
+    pois : GeoDataFrame
+        One feature per cluster, in the original order, with the number of
+        features it stands for in `n_merged`
+    """
+    if pois.crs is not None and pois.crs.is_geographic:
+        raise ValueError("collapse_stops needs POIs in a projected CRS (meters)")
+    if len(pois) == 0:
+        return pois.assign(n_merged=np.array([], dtype=np.int64))
+
+    geoms = np.asarray(pois.geometry, dtype=object)
+    points = shapely.point_on_surface(geoms)
+
+    # Pairs of features of a same stop, from one batched STRtree query
+    tree = shapely.STRtree(points)
+    left, right = tree.query(points, predicate="dwithin", distance=distance)
+    if stop_areas and "public_transport" in pois.columns:
+        areas = np.flatnonzero(
+            (pois["public_transport"] == "stop_area").to_numpy(dtype=bool)
+            & np.isin(shapely.get_type_id(geoms), (3, 6))  # (Multi)Polygon
+        )
+        if len(areas):
+            area_idx, member = tree.query(geoms[areas], predicate="intersects")
+            left = np.concatenate([left, areas[area_idx]])
+            right = np.concatenate([right, member])
+
+    n = len(pois)
+    graph = coo_matrix((np.ones(len(left), dtype=np.int8), (left, right)), shape=(n, n))
+    n_clusters, cluster = connected_components(graph, directed=False)
+
+    # Rank of each feature, then the best (first on ties) of each cluster
+    rank = np.full(n, len(STOP_PRIORITY))
+    for position, (key, value) in reversed(list(enumerate(STOP_PRIORITY))):
+        if key in pois.columns:
+            rank[(pois[key] == value).to_numpy(dtype=bool)] = position
+    order = np.lexsort((np.arange(n), rank, cluster))
+    first = np.r_[True, cluster[order][1:] != cluster[order][:-1]]
+    keep = np.sort(order[first])
+
+    collapsed = pois.iloc[keep].copy()
+    collapsed["n_merged"] = np.bincount(cluster, minlength=n_clusters)[cluster[keep]]
+    return collapsed
+
+
+def normalize_pois(pois, entrances=False):
+    """
+    Replace every POI by a point, once
+
+    Stations and stop areas come back from OSM as polygons, multipolygons
+    or lines; measuring cells against their outline costs far more than a
+    point distance, and the maps only draw points. Each non-point feature
+    is replaced by its representative point (a point inside it).
+
+    Parameters:
+    -----------
+    pois : GeoDataFrame
+        Filtered POIs
+    entrances : bool
+        Represent the stations whose outline holds `subway_entrance` POIs
+        by these entrances instead: the station feature is dropped and its
+        entrances, already POIs themselves, stand for it
+
+    Returns:
+    --------
+    pois : GeoDataFrame
+        Same rows (minus the stations replaced by their entrances), with
+        Point geometries and the original geometry type in
+        `original_geom_type`
+    """
+    geoms = np.asarray(pois.geometry, dtype=object)
+    geom_type = shapely.get_type_id(geoms)
+    pois = pois.assign(original_geom_type=pois.geometry.geom_type)
+
+    if entrances and "railway" in pois.columns:
+        is_entrance = (pois["railway"] == "subway_entrance").to_numpy(dtype=bool) & (geom_type == 0)
+        outlined = np.flatnonzero(geom_type != 0)
+        if is_entrance.any() and len(outlined):
+            tree = shapely.STRtree(geoms[is_entrance])
+            holder, _ = tree.query(geoms[outlined], predicate="intersects")
+            keep = np.ones(len(pois), dtype=bool)
+            keep[outlined[np.unique(holder)]] = False
+            pois, geoms, geom_type = pois[keep], geoms[keep], geom_type[keep]
+
+    points = np.where(geom_type == 0, geoms, shapely.point_on_surface(geoms))
+    return pois.set_geometry(gpd.GeoSeries(points, index=pois.index, crs=pois.crs))
+
+
+def poi_coordinates(pois):
+    """
+    Coordinates of point POIs as a float array
+
+    Parameters:
+    -----------
+    pois : GeoDataFrame or array-like of shapely Points
+        POIs normalized by `normalize_pois`
+
+    Returns:
+    --------
+    xy : ndarray
+        (n, 2) float64 array of x, y
+    """
+    geoms = np.asarray(getattr(pois, "geometry", pois), dtype=object)
+    if len(geoms) and not (shapely.get_type_id(geoms) == 0).all():
+        raise ValueError("poi_coordinates expects Point geometries; normalize the POIs first")
+    return shapely.get_coordinates(geoms).reshape(-1, 2)
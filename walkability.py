@@ -5,25 +5,36 @@ Created on Tue Nov  4 09:39:09 2025
 @author: Kalma Hazara
 """
 
-import osmnx as ox
+import os
 import folium
-import geopandas as gpd
-from shapely.geometry import box 
-from shapely.geometry import Point 
 import pandas as pd
 import utm
 import branca.colormap as cm
+from boundaries import get_boundary
+from grid import build_grid
+from instrumentation import Trace
+from poi_store import features_from_polygon
+from rendering import export_tile_pyramid, grid_layer, tile_layer
+from scoring import score_cells
+from transport_pois import normalize_pois
 
 ###############################################################################
 ## ETAPE 1 : DEFINIR NOTRE VILLE ##
 
 ville = "Paris, France"
 
+# Suivi de chaque étape : durée, mémoire utilisée et nombre de lignes
+# (affiché au fur et à mesure et sauvegardé en JSON à la fin)
+suivi = Trace(ville, verbose=True)
+
 ###############################################################################
 ## ETAPE 2 : VISUALISATION DU CONTOUR DE LA VILLE ##
 
-# Transformer notre polygone OSM en geodataframe
-gdf = ox.geocode_to_gdf(ville)
+suivi.start("ETAPE 2 : contour de la ville")
+
+# Transformer notre polygone OSM en geodataframe : le contour est gardé dans
+# cache/boundaries.gpkg, seule la première exécution interroge Nominatim
+gdf = get_boundary(ville)
 
 # Obtenir les coordonnées centrales de la ville
 lat, lon = gdf.geometry.centroid.y[0], gdf.geometry.centroid.x[0]
@@ -36,12 +47,16 @@ folium.GeoJson(gdf).add_to(contour_ville)
 
 # Sauvegarder et visualiser la carte
 contour_ville.save(r"C:\Users\Pc\Downloads\marchabilite.html")
+suivi.stop(rows_out=len(gdf))
 
 ###############################################################################
 ## ETAPE 3 : CREATION DES CARROYAGES POUR CARTE ##
 
-# Je rappelle la polygone de la ville d'Open Street Map
-ville_etude = ox.geocode_to_gdf(ville)
+suivi.start("ETAPE 3 : carroyage")
+
+# Je reprends la polygone de la ville obtenue à l'étape 2 (pas besoin de
+# la redemander à Open Street Map)
+ville_etude = gdf.copy()
 
 # Je détermine un epsg précis d'un pays donné   
 utm_zone = utm.from_latlon(lat, lon)[2]
@@ -51,28 +66,18 @@ ville_etude = ville_etude.to_crs (epsg=epsg)
 # Déterminer la taille de nos carrés
 grid_size = 500 # 500m x 500m
 
-# Dessiner une boîte autour de notre ville d'étude
-minx, miny, maxx, maxy = ville_etude.total_bounds
-
-# Créer les carrés automatiquement à l'intérieur de notre boîte
-grid_cells = []
-x = minx
-while x < maxx :
-    y = miny
-    while y < maxy :
-        grid_cells.append(box(x, y, x + grid_size, y + grid_size))
-        y += grid_size
-    x += grid_size
-    
-# Convertir nos carrés en géodataframe grâce à Geopandas
-grid = gpd.GeoDataFrame({'geometry': grid_cells}, crs = ville_etude.crs)
-
-# Découper notre carte carroyé selon la forme de notre polygone de la ville
-grid = gpd.overlay(grid, ville_etude, how = 'intersection')
+# Créer tous les carrés d'un coup dans la boîte autour de notre ville d'étude,
+# puis les découper selon la forme de notre polygone de la ville.
+# Les carrés entièrement à l'intérieur de la ville sont gardés tels quels,
+# seuls ceux qui touchent la limite sont réellement découpés.
+grid = build_grid(ville_etude, grid_size)
+suivi.stop(rows_out=len(grid))
 
 ###############################################################################
 ## ETAPE 4 : RECUPERATION LES POIs D'OPEN STREET MAP
 
+suivi.start("ETAPE 4 : POIs")
+
 # M'assurer que ma couche de ville n'est pas segmenté
 polygon = gdf.geometry.union_all()
 
@@ -82,8 +87,12 @@ tags = {
     "railway": ["station", "halt", "tram_stop", "subway_entrance"],
     "highway": ["bus_stop"]}
 
-# Télécharger les POIs d'Open Street Map
-pois = ox.features_from_polygon(polygon, tags)
+# Récupérer les POIs d'Open Street Map : les réponses déjà téléchargées par le
+# PoiStore sont réutilisées si elles couvrent notre ville (même pour un
+# quartier d'une ville déjà téléchargée), seul le reste est téléchargé. Les
+# réponses mises en cache par osmnx ne servent que pour exactement la même
+# requête (même polygone, mêmes tags)
+pois = features_from_polygon(polygon, tags)
 
 # Retirer les lignes vides
 pois = pois.dropna(subset=["public_transport", "railway", "highway"], how="all")
@@ -91,50 +100,55 @@ pois = pois.dropna(subset=["public_transport", "railway", "highway"], how="all")
 # Reprojection vers l’UTM du grid carroyé
 pois = pois.to_crs(epsg=epsg)
 
+# Les gares et zones d'arrêt arrivent en polygones : on les remplace une
+# seule fois par un point à l'intérieur, les distances deviennent des
+# distances entre points et tous les arrêts apparaissent sur la carte
+pois = normalize_pois(pois)
+suivi.stop(rows_out=len(pois))
+
 ###############################################################################
 ## ETAPE 5 : CALCULER LE SCORE DE MARCHABILITE ##
 
+suivi.start("ETAPE 5 : score", rows_in=len(pois))
+
 # Créer un centroide sur chaque carreau pour pouvoir messurer les distances aux POIs
 grid['centroid'] = grid.geometry.centroid
 
 # Créer des seuils de distance pour la marchabilité
 seuils = [400, 800, 1200] # ce sont des valeurs en mètres
 
-# Création d'une colonne vide pour le score de la marchabilité de chaque carreau
-grid['raw_score'] = 0
-
-# Boucle de calcul de distance pour chaque centroïde du carré 
-for i, centroid in grid['centroid'].items():
-    # Mesurer la distance entre le centroïde et les POIs
-    dists = pois.geometry.distance(centroid)
-    
-    # Reinitialise le score du carré
-    score = 0
-    
-    # Selon sa distance, on lui attribue un score
-    for d in dists:
-        if d <= 400:
-            score += 3 # Ajouter 3 points si très proche (inférieur ou égale à 400m)
-        elif d <= 800:
-            score += 2 # Ajouter 2 points si moyennement proche (entre 400 et 800m)
-        elif d <= 1200:
-            score += 1 # Ajouter 1 points si moins proche (entre 800 et 1200)
-        else:
-            score += 0 # Si la distance est au delà de 1200m, ajouter 0 point
-            
-    # Ajouter le score au carré
-    grid.at[i, 'score_brut'] = score
+# Calcul vectorisé du score : les POIs sont indexés une seule fois (STRtree)
+# puis tous les centroïdes sont interrogés en même temps.
+# Chaque POI rapporte 3 points à moins de 400m, 2 points entre 400 et 800m,
+# 1 point entre 800 et 1200m et 0 point au delà.
+grid['score_brut'] = score_cells(grid['centroid'], pois.geometry, seuils, (3, 2, 1))
+suivi.stop(rows_out=len(grid))
 
 ###############################################################################
 ## ETAPE 6 : CONVERTIR EN VALEUR ENTRE 0 et 100
 
+suivi.start("ETAPE 6 : normalisation", rows_in=len(grid))
+
 # Normalisation du résultat
 # Inspiré de ce code : https://scikit-learn.org/stable/modules/generated/sklearn.preprocessing.MinMaxScaler.html
 grid["score_final"] = 100 * (grid['score_brut']-grid['score_brut'].min()) / (grid["score_brut"].max()-grid["score_brut"].min())
+suivi.stop(rows_out=len(grid))
 
 ###############################################################################
 ## ETAPE 7 : VISUALISATION DE LA CARTE FINALE AVEC FOLIUM ##
 
+suivi.start("ETAPE 7 : carte finale", rows_in=len(grid))
+
+# Fichier HTML de la carte finale
+chemin_sortie = r"C:\Users\Pc\Downloads\carte_marchabilite_finale.html"
+
+# Pour une grande métropole avec des petits carrés, le fichier HTML devient
+# trop lourd pour le navigateur. On peut alors exporter les carrés et les
+# arrêts en tuiles d'images (dossier z/x/y à côté du fichier HTML) : le
+# navigateur ne charge que les tuiles visibles à l'écran.
+export_tuiles = False
+dossier_tuiles = "tuiles_marchabilite" # relatif au fichier HTML
+
 # Conversion des crs au WG84 pour folium
 grid_wgs84 = grid.to_crs(epsg=4326)
 pois_wgs84 = pois.to_crs(epsg=4326)
@@ -180,56 +194,52 @@ colormap = cm.LinearColormap(
 )
 
 # Ajout des carreaux (grid) à la carte
-# Je l'ajoute dans un Feature group pour que l'utilisateur puisse cocher/décocher cette couche
-groupe_carreaux = folium.FeatureGroup(name='🟦 Score de Marchabilité', show=True)
-
-# Parcours chaque carré de notre tableau de données pour l'ajouter à la carte
-for idx, row in grid_wgs84.iterrows():
-    # On récupère le score et la géométrie du carré
-    score = row['score_final']
-    geometry = row['geometry']
-    
-    # On détermine la couleur du carré grâce à notre palette (colormap) définie plus haut
-    couleur_carre = colormap(score)
-    
-    # On ajoute le carré sous forme de GeoJson
-    folium.GeoJson(
-        geometry,
-        style_function=lambda x, color=couleur_carre: {
-            'fillColor': color,      # Couleur de remplissage selon le score
-            'color': 'white',        # Couleur de la bordure du carré (blanc pour faire propre)
-            'weight': 0.5,           # Épaisseur de la bordure
-            'fillOpacity': 0.6       # légèrement transparent
-        },
-        # L'infobulle (tooltip) s'affiche au survol de la souris
-        tooltip=f"Score: {score:.1f} / 100"
-    ).add_to(groupe_carreaux)
-
-# Une fois tous les carrés ajoutés au groupe, on ajoute le groupe à la carte principale
+# Tous les carrés sont ajoutés dans une seule couche GeoJSON : la couleur et
+# l'infobulle de chaque carré sont calculées à l'avance comme propriétés,
+# au lieu de créer une couche par carré (très lent pour une grande ville).
+# La couche peut être cochée/décochée par l'utilisateur.
+# En mode tuiles, la carte lit les images des tuiles au lieu des carrés.
+if export_tuiles:
+    # Couleur de chaque arrêt selon le type de transport (même code couleur que les marqueurs)
+    types = pois_wgs84.reindex(columns=['public_transport', 'railway'])
+    couleurs_pois = ['#3498db' if pd.notna(pt) else '#e74c3c' if pd.notna(rw) else '#2ecc71'
+                     for pt, rw in zip(types['public_transport'], types['railway'])]
+    # La grille est passée dans sa projection d'origine (UTM), où les carrés
+    # sont alignés : chaque pixel des tuiles y trouve son carré par calcul
+    export_tile_pyramid(grid, 'score_final', colormap,
+                        os.path.join(os.path.dirname(chemin_sortie), dossier_tuiles),
+                        pois=pois_wgs84, poi_colors=couleurs_pois)
+    groupe_carreaux = tile_layer(dossier_tuiles + "/grid/{z}/{x}/{y}.png", name='🟦 Score de Marchabilité')
+else:
+    groupe_carreaux = grid_layer(grid_wgs84, 'score_final', colormap, name='🟦 Score de Marchabilité', show=True)
+
+# On ajoute la couche des carrés à la carte principale
 groupe_carreaux.add_to(carte_marchabilite)
 
 # On fait la même chose pour les arrêts de transport
-groupe_pois = folium.FeatureGroup(name='Arrêts de Transport', show=True)
-
-# Parcours chaque point d'intérêt trouvé
-for idx, row in pois_wgs84.iterrows():
-    # On essaie de récupérer le nom de l'arrêt, sinon on met "Transport" par défaut
-    nom = row.get('name', 'Transport')
+if export_tuiles:
+    groupe_pois = tile_layer(dossier_tuiles + "/pois/{z}/{x}/{y}.png", name='Arrêts de Transport')
+else:
+    groupe_pois = folium.FeatureGroup(name='Arrêts de Transport', show=True)
+
+    # Parcours chaque point d'intérêt trouvé
+    for idx, row in pois_wgs84.iterrows():
+        # On essaie de récupérer le nom de l'arrêt, sinon on met "Transport" par défaut
+        nom = row.get('name', 'Transport')
     
-    # On personnalise la couleur et l'icône selon le type de transport
-    # Cela rend la carte plus lisible et informative
-    if pd.notna(row.get('public_transport')):
-        couleur = '#3498db' # Bleu pour les bus/trams génériques
-        type_transport = "Transport Public"
-    elif pd.notna(row.get('railway')):
-        couleur = '#e74c3c' # Rouge pour les trains/métros
-        type_transport = "Ferroviaire"
-    else:
-        couleur = '#2ecc71' # Vert pour les autres (arrêts de bus simples)
-        type_transport = "Arrêt de Bus"
+        # On personnalise la couleur et l'icône selon le type de transport
+        # Cela rend la carte plus lisible et informative
+        if pd.notna(row.get('public_transport')):
+            couleur = '#3498db' # Bleu pour les bus/trams génériques
+            type_transport = "Transport Public"
+        elif pd.notna(row.get('railway')):
+            couleur = '#e74c3c' # Rouge pour les trains/métros
+            type_transport = "Ferroviaire"
+        else:
+            couleur = '#2ecc71' # Vert pour les autres (arrêts de bus simples)
+            type_transport = "Arrêt de Bus"
     
-    # On veut récupérer que les points
-    if row.geometry.geom_type == 'Point':
+        # Tous les POIs sont des points depuis l'étape 4 (gares comprises)
         # On ajoute un marqueur circulaire
         folium.CircleMarker(
             location=[row.geometry.y, row.geometry.x], # Latitude, Longitude
@@ -252,5 +262,8 @@ colormap.add_to(carte_marchabilite)
 folium.LayerControl(collapsed=False).add_to(carte_marchabilite)
 
 # Enfin, on sauvegarde le résultat dans un fichier HTML interactif
-chemin_sortie = r"C:\Users\Pc\Downloads\carte_marchabilite_finale.html"
-carte_marchabilite.save(chemin_sortie)
\ No newline at end of file
+carte_marchabilite.save(chemin_sortie)
+suivi.stop()
+
+# Sauvegarde du suivi des étapes à côté de la carte
+suivi.save(os.path.join(os.path.dirname(chemin_sortie), "suivi_marchabilite.json"))
\ No newline at end of file
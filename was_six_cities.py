@@ -6,13 +6,13 @@ Created on Thu Nov  6 15:17:04 2025
 """
 
 import os
-import osmnx as ox
-import geopandas as gpd
-from shapely.geometry import box
-import pandas as pd
-import matplotlib.pyplot as plt
-import contextily as ctx
 import warnings
+from concurrent.futures import ProcessPoolExecutor
+from instrumentation import Trace
+from pipeline import DEFAULT_CACHE_DIR, WalkabilityPipeline
+from rendering import comparison_figure
+from results import ScoredGrid
+from transport_pois import TRANSPORT_TAGS
 warnings.filterwarnings('ignore')
 
 # ============================================================================
@@ -45,7 +45,35 @@ warnings.filterwarnings('ignore')
 # ============================================================================
 
 
-def calculate_walkability_from_shapefile(shapefile_path, place_name, grid_size=500):
+def _run_pipeline(place_name, shapefile_path, grid_size, min_grid_size, walk_graph, trace_path, hooks, cache_dir,
+                  scoring, kernel, merge_distance, poi_points):
+    """Run the walkability pipeline for one place, reporting errors like the batch expects"""
+    trace = Trace(place_name, hooks)
+    pipeline = WalkabilityPipeline(
+        grid_size, min_grid_size, walk_graph, tags=TRANSPORT_TAGS, cache_dir=cache_dir, trace=trace,
+        scoring=scoring, kernel=kernel, merge_distance=merge_distance, poi_points=poi_points
+    )
+    
+    try:
+        grid, pois = pipeline.run(place_name, shapefile_path)
+        
+        print(f"  ✓ {place_name}: {len(pois)} transport POIs found, avg WAS = {grid['WAS'].mean():.2f}")
+        
+        return grid, pois
+    
+    except Exception as e:
+        print(f"  ✗ Error processing {place_name}: {str(e)}")
+        return None, None
+    
+    finally:
+        if trace_path:
+            trace.save(trace_path)
+
+
+def calculate_walkability_from_shapefile(shapefile_path, place_name, grid_size=500, min_grid_size=None,
+                                         walk_graph=None, trace_path=None, hooks=(),
+                                         cache_dir=DEFAULT_CACHE_DIR, scoring="vector", kernel=None,
+                                         merge_distance=None, poi_points=None):
     """
     Calculate walkability score using a shapefile boundary
     
@@ -57,120 +85,55 @@ def calculate_walkability_from_shapefile(shapefile_path, place_name, grid_size=5
         Name for display purposes
     grid_size : int
         Size of grid cells in meters (default: 500)
+    min_grid_size : int
+        If given, build an adaptive grid: cells start at grid_size and are
+        split where POIs or score changes call for it, down to this size
+    walk_graph : str
+        GraphML walking network (e.g. saved by `ox.save_graphml`); if
+        given, distances are measured along it instead of as the crow
+        flies (uniform grid only)
+    trace_path : str
+        If given, write the per-stage trace as a JSON file there
+    hooks : sequence of callable
+        Called as hook(place_name, record) at the end of every stage, e.g.
+        to forward the records to a metrics system
+    cache_dir : str
+        Folder of the cached pipeline stages (None: no cache); a rerun
+        only recomputes the stages whose parameters changed
+    scoring : str
+        "vector" (exact, default) or "raster": FFT convolution on the grid
+        lattice, much faster for 50 m or 25 m grids over metro areas, with
+        the accuracy documented in `raster`
+    kernel : Kernel, optional
+        Scoring kernel (see `scoring`), e.g. a distance decay or per-tag
+        weights; default: 3 / 2 / 1 points within 400 / 800 / 1200 m
+    merge_distance : float
+        If given, count a stop mapped several times (stop area, station,
+        stop positions, entrances) once: features closer than this many
+        meters, or in a same stop area, are merged
+    poi_points : str
+        If given, score POIs as points: "representative" (a point inside
+        each station or stop area polygon) or "entrances" (stations by
+        their subway entrances); much cheaper than polygon distances
     
     Returns:
     --------
     grid : GeoDataFrame
-        Grid with walkability scores
+        Grid with walkability scores; the per-stage trace (time, memory,
+        rows) is in `grid.attrs['trace']`
     pois : GeoDataFrame
         Points of interest
     """
     print(f"Processing {place_name} from shapefile...")
-    
-    try:
-        # Read shapefile
-        study_area = gpd.read_file(shapefile_path)
-        
-        # Ensure it's in Web Mercator for distance calculations
-        if study_area.crs != 'EPSG:3857':
-            study_area = study_area.to_crs(epsg=3857)
-        
-        # If multiple polygons, union them
-        if len(study_area) > 1:
-            study_area = study_area.dissolve()
-        
-        # Generate grid cells
-        minx, miny, maxx, maxy = study_area.total_bounds
-        
-        grid_cells = []
-        x = minx
-        while x < maxx:
-            y = miny
-            while y < maxy:
-                grid_cells.append(box(x, y, x + grid_size, y + grid_size))
-                y += grid_size
-            x += grid_size
-        
-        # Convert to GeoDataFrame and clip to study area
-        grid = gpd.GeoDataFrame({'geometry': grid_cells}, crs=study_area.crs)
-        grid = gpd.overlay(grid, study_area, how='intersection')
-        
-        # Download POIs - convert to WGS84 for OSM query
-        polygon = study_area.to_crs(epsg=4326).geometry.union_all()
-        
-        # Define public transport amenities
-        transport_tags = {
-            "public_transport": ["station", "stop_position", "stop_area"],
-            "railway": ["station", "halt", "tram_stop", "subway_entrance"],
-            "amenity": ["bus_station", "ferry_terminal"]
-        }
-        
-        pois = ox.features_from_polygon(polygon, transport_tags)
-        
-        # Filter relevant public transport features
-        valid_pois = []
-        
-        # Check for public_transport tag
-        if 'public_transport' in pois.columns:
-            public_transport_pois = pois[pois['public_transport'].isin(['station', 'stop_position', 'stop_area'])]
-            valid_pois.append(public_transport_pois)
-        
-        # Check for railway tag
-        if 'railway' in pois.columns:
-            railway_pois = pois[pois['railway'].isin(['station', 'halt', 'tram_stop', 'subway_entrance'])]
-            valid_pois.append(railway_pois)
-        
-        # Check for amenity tag
-        if 'amenity' in pois.columns:
-            amenity_pois = pois[pois['amenity'].isin(['bus_station', 'ferry_terminal'])]
-            valid_pois.append(amenity_pois)
-        
-        # Combine all valid POIs and remove duplicates
-        if valid_pois:
-            pois = pd.concat(valid_pois).drop_duplicates(subset=['geometry'])
-        else:
-            # Create empty GeoDataFrame with same CRS if no POIs found
-            pois = gpd.GeoDataFrame(geometry=[], crs=pois.crs)
-        
-        # Reproject POIs to match grid
-        pois = pois.to_crs(epsg=3857)
-        
-        # Calculate walkability scores
-        grid['centroid'] = grid.geometry.centroid
-        grid['raw_score'] = 0
-        
-        for i, centroid in grid['centroid'].items():
-            if len(pois) > 0:
-                dists = pois.geometry.distance(centroid)
-                score = 0
-                
-                for d in dists:
-                    if d <= 400:  # 5-minute walk
-                        score += 3
-                    elif d <= 800:  # 10-minute walk
-                        score += 2
-                    elif d <= 1200:  # 15-minute walk
-                        score += 1
-                
-                grid.at[i, 'raw_score'] = score
-        
-        # Normalize scores to 0-100
-        if len(pois) > 0 and grid['raw_score'].max() > grid['raw_score'].min():
-            grid["WAS"] = 100 * (grid['raw_score'] - grid['raw_score'].min()) / \
-                          (grid['raw_score'].max() - grid['raw_score'].min())
-        else:
-            grid["WAS"] = 0
-        
-        print(f"  ✓ {place_name}: {len(pois)} transport POIs found, avg WAS = {grid['WAS'].mean():.2f}")
-        
-        return grid, pois
-    
-    except Exception as e:
-        print(f"  ✗ Error processing {place_name}: {str(e)}")
-        return None, None
+    return _run_pipeline(
+        place_name, shapefile_path, grid_size, min_grid_size, walk_graph, trace_path, hooks, cache_dir, scoring,
+        kernel, merge_distance, poi_points
+    )
 
 
-def calculate_walkability(place_name, grid_size=500):
+def calculate_walkability(place_name, grid_size=500, min_grid_size=None, walk_graph=None,
+                          trace_path=None, hooks=(), cache_dir=DEFAULT_CACHE_DIR, scoring="vector", kernel=None,
+                          merge_distance=None, poi_points=None):
     """
     Calculate walkability score for a given place using geocoding
     
@@ -180,218 +143,220 @@ def calculate_walkability(place_name, grid_size=500):
         Name of the place to analyze
     grid_size : int
         Size of grid cells in meters (default: 500)
+    min_grid_size : int
+        If given, build an adaptive grid: cells start at grid_size and are
+        split where POIs or score changes call for it, down to this size
+    walk_graph : str
+        GraphML walking network (e.g. saved by `ox.save_graphml`); if
+        given, distances are measured along it instead of as the crow
+        flies (uniform grid only)
+    trace_path : str
+        If given, write the per-stage trace as a JSON file there
+    hooks : sequence of callable
+        Called as hook(place_name, record) at the end of every stage, e.g.
+        to forward the records to a metrics system
+    cache_dir : str
+        Folder of the cached pipeline stages (None: no cache); a rerun
+        only recomputes the stages whose parameters changed
+    scoring : str
+        "vector" (exact, default) or "raster": FFT convolution on the grid
+        lattice, much faster for 50 m or 25 m grids over metro areas, with
+        the accuracy documented in `raster`
+    kernel : Kernel, optional
+        Scoring kernel (see `scoring`), e.g. a distance decay or per-tag
+        weights; default: 3 / 2 / 1 points within 400 / 800 / 1200 m
+    merge_distance : float
+        If given, count a stop mapped several times (stop area, station,
+        stop positions, entrances) once: features closer than this many
+        meters, or in a same stop area, are merged
+    poi_points : str
+        If given, score POIs as points: "representative" (a point inside
+        each station or stop area polygon) or "entrances" (stations by
+        their subway entrances); much cheaper than polygon distances
     
     Returns:
     --------
     grid : GeoDataFrame
-        Grid with walkability scores
+        Grid with walkability scores; the per-stage trace (time, memory,
+        rows) is in `grid.attrs['trace']`
     pois : GeoDataFrame
         Points of interest
     """
     print(f"Processing {place_name}...")
+    return _run_pipeline(
+        place_name, None, grid_size, min_grid_size, walk_graph, trace_path, hooks, cache_dir, scoring, kernel,
+        merge_distance, poi_points
+    )
+
+
+def _calculate_compact(place_name, grid_size, min_grid_size, **options):
+    """`calculate_walkability` returning a ScoredGrid, converted in the worker"""
+    grid, pois = calculate_walkability(place_name, grid_size, min_grid_size, **options)
+    if grid is not None:
+        grid = ScoredGrid.from_geodataframe(grid, None if min_grid_size else grid_size)
+    return grid, pois
+
+
+def calculate_walkability_batch(cities, grid_size=500, min_grid_size=None, max_workers=None, trace_dir=None,
+                                compact=False):
+    """
+    Calculate walkability for several cities in parallel
     
-    try:
-        # Get the study area
-        study_area = ox.geocode_to_gdf(place_name)
-        study_area = study_area.to_crs(epsg=3857)
-        
-        # Generate grid cells
-        minx, miny, maxx, maxy = study_area.total_bounds
-        
-        grid_cells = []
-        x = minx
-        while x < maxx:
-            y = miny
-            while y < maxy:
-                grid_cells.append(box(x, y, x + grid_size, y + grid_size))
-                y += grid_size
-            x += grid_size
-        
-        grid = gpd.GeoDataFrame({'geometry': grid_cells}, crs=study_area.crs)
-        grid = gpd.overlay(grid, study_area, how='intersection')
-        
-        polygon = study_area.to_crs(epsg=4326).geometry.union_all()
-        
-        # Define public transport amenities
-        transport_tags = {
-            "public_transport": ["station", "stop_position", "stop_area"],
-            "railway": ["station", "halt", "tram_stop", "subway_entrance"],
-            "amenity": ["bus_station", "ferry_terminal"]
+    Each city runs `calculate_walkability` in its own worker process, so
+    the batch takes about as long as the slowest city.
+    
+    Parameters:
+    -----------
+    cities : dict
+        Place names to analyze, mapped to their continent
+    grid_size : int
+        Size of grid cells in meters (default: 500)
+    min_grid_size : int
+        Smallest cell size of an adaptive grid (default: uniform grid)
+    max_workers : int
+        Number of worker processes (default: one per city, up to the
+        number of CPU cores)
+    trace_dir : str
+        If given, write the per-stage trace of every city there, as
+        <place_name>.json
+    compact : bool
+        Return each grid as a `results.ScoredGrid` (numpy arrays, a few
+        times lighter to send back and to keep); see
+        `results.save_results` to store them as GeoParquet
+    
+    Returns:
+    --------
+    results : dict
+        {place_name: {'grid', 'pois', 'continent'}} for every city that
+        succeeded, in the order of `cities`
+    """
+    results = {}
+    if not cities:
+        return results
+    
+    if max_workers is None:
+        max_workers = min(len(cities), os.cpu_count() or 1)
+    
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            city: executor.submit(
+                _calculate_compact if compact else calculate_walkability, city, grid_size, min_grid_size,
+                trace_path=os.path.join(trace_dir, f"{city}.json") if trace_dir else None
+            )
+            for city in cities
         }
         
-        pois = ox.features_from_polygon(polygon, transport_tags)
-        
-        # Filter relevant public transport features
-        valid_pois = []
-        
-        # Check for public_transport tag
-        if 'public_transport' in pois.columns:
-            public_transport_pois = pois[pois['public_transport'].isin(['station', 'stop_position', 'stop_area'])]
-            valid_pois.append(public_transport_pois)
-        
-        # Check for railway tag
-        if 'railway' in pois.columns:
-            railway_pois = pois[pois['railway'].isin(['station', 'halt', 'tram_stop', 'subway_entrance'])]
-            valid_pois.append(railway_pois)
-        
-        # Check for amenity tag
-        if 'amenity' in pois.columns:
-            amenity_pois = pois[pois['amenity'].isin(['bus_station', 'ferry_terminal'])]
-            valid_pois.append(amenity_pois)
-        
-        # Combine all valid POIs and remove duplicates
-        if valid_pois:
-            pois = pd.concat(valid_pois).drop_duplicates(subset=['geometry'])
-        else:
-            # Create empty GeoDataFrame with same CRS if no POIs found
-            pois = gpd.GeoDataFrame(geometry=[], crs=pois.crs)
-        
-        # Reproject POIs to match grid
-        pois = pois.to_crs(epsg=3857)
-        
-        # Calculate walkability scores
-        grid['centroid'] = grid.geometry.centroid
-        grid['raw_score'] = 0
-        
-        for i, centroid in grid['centroid'].items():
-            if len(pois) > 0:
-                dists = pois.geometry.distance(centroid)
-                score = 0
-                
-                for d in dists:
-                    if d <= 400:  # 5-minute walk
-                        score += 3
-                    elif d <= 800:  # 10-minute walk
-                        score += 2
-                    elif d <= 1200:  # 15-minute walk
-                        score += 1
-                
-                grid.at[i, 'raw_score'] = score
-        
-        # Normalize scores to 0-100
-        if len(pois) > 0 and grid['raw_score'].max() > grid['raw_score'].min():
-            grid["WAS"] = 100 * (grid['raw_score'] - grid['raw_score'].min()) / \
-                          (grid['raw_score'].max() - grid['raw_score'].min())
-        else:
-            grid["WAS"] = 0
-        
-        print(f"  ✓ {place_name}: {len(pois)} transport POIs found, avg WAS = {grid['WAS'].mean():.2f}")
-        
-        return grid, pois
+        # Collect in the input order so the comparison plot stays stable
+        for city, continent in cities.items():
+            try:
+                grid, pois = futures[city].result()
+            except Exception as e:
+                # The worker itself failed (crash, result not picklable...)
+                print(f"  ✗ Error processing {city}: {str(e)}")
+                continue
+            
+            if grid is not None:
+                results[city] = {'grid': grid, 'pois': pois, 'continent': continent}
     
-    except Exception as e:
-        print(f"  ✗ Error processing {place_name}: {str(e)}")
-        return None, None
+    return results
 
 
-# ============================================================================
-# CHOOSE YOUR APPROACH
-# ============================================================================
+if __name__ == "__main__":
+    # ============================================================================
+    # CHOOSE YOUR APPROACH
+    # ============================================================================
 
-# APPROACH 1: Using shapefiles for specific cities
-#cities_with_shapefiles = {
-#   'Sao Paolo': {
-#        'shapefile': r"C:\Users\I84584\Downloads\sao_paolo.geojson",
-#        'continent': 'South America'
-#    }
-#}
+    # APPROACH 1: Using shapefiles for specific cities (empty: none)
+    # For long city lists, prefer the resumable runner: python batch.py cities.csv results/
+    cities_with_shapefiles = {}
+    #cities_with_shapefiles = {
+    #   'Sao Paolo': {
+    #        'shapefile': r"C:\Users\I84584\Downloads\sao_paolo.geojson",
+    #        'continent': 'South America'
+    #    }
+    #}
 
-# APPROACH 2: Using improved place names
-cities_with_names = {
-    'Sao Paolo, Brazil' : 'South America',
-    'Dakar, Senegal': 'Africa',
-    'Los Angeles, California, USA': 'North America',
-    'Jakarta, Indonesia': 'Asia',
-    'Paris, France': 'Europe',
-    'Sydney, Australia': 'Oceania'
-}
+    # APPROACH 2: Using improved place names
+    cities_with_names = {
+        'Sao Paolo, Brazil' : 'South America',
+        'Dakar, Senegal': 'Africa',
+        'Los Angeles, California, USA': 'North America',
+        'Jakarta, Indonesia': 'Asia',
+        'Paris, France': 'Europe',
+        'Sydney, Australia': 'Oceania'
+    }
 
-# Calculate walkability for all cities
-results = {}
+    # Number of cities processed at the same time (None = one process per
+    # city, up to the number of CPU cores)
+    MAX_WORKERS = None
 
-# Process cities with shapefiles
-for city_name, config in cities_with_shapefiles.items():
-    grid, pois = calculate_walkability_from_shapefile(
-        config['shapefile'], 
-        city_name, 
-        grid_size=500
-    )
-    if grid is not None:
-        results[city_name] = {
-            'grid': grid, 
-            'pois': pois, 
-            'continent': config['continent']
-        }
+    # Drawing of the grids in the comparison figure: "image" (one image per
+    # city, fast whatever the number of cells) or "polygons" (one outlined
+    # patch per cell)
+    FIGURE_MODE = "image"
 
-# Process cities with place names
-for city, continent in cities_with_names.items():
-    grid, pois = calculate_walkability(city, grid_size=500)
-    if grid is not None:
-        results[city] = {'grid': grid, 'pois': pois, 'continent': continent}
+    # Basemap tiles are cached in cache/basemap_tiles.sqlite; offline, the
+    # figure only uses the cached tiles
+    BASEMAP_OFFLINE = False
+    
+    # Calculate walkability for all cities
+    results = {}
 
-# Create comparison plot
-fig, axes = plt.subplots(2, 3, figsize=(20, 14))
-axes = axes.flatten()
+    # Process cities with shapefiles
+    for city_name, config in cities_with_shapefiles.items():
+        grid, pois = calculate_walkability_from_shapefile(
+            config['shapefile'], 
+            city_name, 
+            grid_size=500
+        )
+        if grid is not None:
+            results[city_name] = {
+                'grid': grid, 
+                'pois': pois, 
+                'continent': config['continent']
+            }
 
-for idx, (city, data) in enumerate(results.items()):
-    ax = axes[idx]
-    grid = data['grid']
-    continent = data['continent']
-    
-    grid.plot(
-        column="WAS",
-        cmap="RdYlGn",
-        legend=True,
-        ax=ax,
-        alpha=0.7,
-        edgecolor='black',
-        linewidth=0.3,
-        vmin=0,
-        vmax=100,
-        legend_kwds={'label': 'Walkability Score', 'shrink': 0.8}
-    )
-    
-    try:
-        ctx.add_basemap(ax, source=ctx.providers.CartoDB.Positron, alpha=0.5)
-    except:
-        pass
-    
-    avg_score = grid['WAS'].mean()
-    city_name = city.split(',')[0]
-    ax.set_title(
-        f"{city_name} ({continent})\nWAS Moyen: {avg_score:.1f} | POIs: {len(data['pois'])}",
-        fontsize=12,
-        fontweight='bold'
-    )
-    
-    ax.set_xlabel("Easting (m)", fontsize=9)
-    ax.set_ylabel("Northing (m)", fontsize=9)
-    ax.tick_params(labelsize=8)
+    # Process cities with place names, in parallel
+    results.update(calculate_walkability_batch(
+        cities_with_names,
+        grid_size=500,
+        max_workers=MAX_WORKERS
+    ))
 
-fig.suptitle(
-    "Walkability Accessibility Score (WAS) - Comparaison des villes de chaque continent\n" + 
-    "Accès aux transports publics",
-    fontsize=16,
-    fontweight='bold',
-    y=0.995
-)
+    # Create comparison plot: each city is drawn as one image (not one
+    # patch per cell) in its own process, then the panels are composited
+    panels = []
+    for city, data in results.items():
+        grid = data['grid']
+        city_name = city.split(',')[0]
+        title = f"{city_name} ({data['continent']})\nWAS Moyen: {grid['WAS'].mean():.1f} | POIs: {len(data['pois'])}"
+        panels.append((ScoredGrid.from_geodataframe(grid), title))
 
-plt.tight_layout()
-plt.savefig('walkability_comparison_6cities_transport.png', dpi=300, bbox_inches='tight')
-print("\n✓ Comparison plot saved as 'walkability_comparison_6cities_transport.png'")
-plt.show()
+    comparison_figure(
+        panels,
+        'walkability_comparison_6cities_transport.png',
+        ncols=3,
+        title="Walkability Accessibility Score (WAS) - Comparaison des villes de chaque continent\n" +
+              "Accès aux transports publics",
+        max_workers=MAX_WORKERS,
+        mode=FIGURE_MODE,
+        offline=BASEMAP_OFFLINE,
+        figsize=(20 / 3, 7),
+        dpi=300,
+    )
+    print("\n✓ Comparison plot saved as 'walkability_comparison_6cities_transport.png'")
 
-# Print summary statistics
-print("\n" + "="*70)
-print("WALKABILITY SUMMARY STATISTICS (Public Transport)")
-print("="*70)
-for city, data in results.items():
-    grid = data['grid']
-    continent = data['continent']
-    print(f"\n{city} ({continent}):")
-    print(f"  Average WAS: {grid['WAS'].mean():.2f}")
-    print(f"  Median WAS:  {grid['WAS'].median():.2f}")
-    print(f"  Max WAS:     {grid['WAS'].max():.2f}")
-    print(f"  Min WAS:     {grid['WAS'].min():.2f}")
-    print(f"  Transport POI Count: {len(data['pois'])}")
-    print(f"  Grid Cells:  {len(grid)}")
\ No newline at end of file
+    # Print summary statistics
+    print("\n" + "="*70)
+    print("WALKABILITY SUMMARY STATISTICS (Public Transport)")
+    print("="*70)
+    for city, data in results.items():
+        grid = data['grid']
+        continent = data['continent']
+        print(f"\n{city} ({continent}):")
+        print(f"  Average WAS: {grid['WAS'].mean():.2f}")
+        print(f"  Median WAS:  {grid['WAS'].median():.2f}")
+        print(f"  Max WAS:     {grid['WAS'].max():.2f}")
+        print(f"  Min WAS:     {grid['WAS'].min():.2f}")
+        print(f"  Transport POI Count: {len(data['pois'])}")
+        print(f"  Grid Cells:  {len(grid)}")
\ No newline at end of file